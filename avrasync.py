@@ -0,0 +1,459 @@
+"""
+	avrasync.py
+	AVR109 bootloader commands as coroutines, so that one thread can
+	drive many ports at once.
+
+	A coroutine is a generator. It writes to its port directly and
+	yields Read(port, count) to wait for a reply, which is sent back
+	into it; fewer bytes come back if the port timeout passes first. It
+	yields another coroutine to call it and Return(value) to return a
+	value to its caller. Errors are raised into the caller as usual.
+	Loop runs any number of them on select().
+"""
+import sys
+import time
+import types
+import select
+import hex_util
+
+class Read:
+	"""
+		Read class.
+		Yielded by a coroutine to wait for count bytes from port.
+	"""
+	def __init__(self, port, count):
+
+		self.port = port
+		self.count = count
+
+
+class Return:
+	"""
+		Return class.
+		Yielded by a coroutine to return value to its caller.
+	"""
+	def __init__(self, value=None):
+
+		self.value = value
+
+
+class Task:
+	"""
+		Task class.
+		A coroutine run by Loop with the coroutines it called. Once done,
+		result holds what it returned, or error the exception it raised.
+	"""
+	def __init__(self, coroutine, name=''):
+
+		self.name = name
+		self.done = False
+		self.result = None
+		self.error = None
+		self.started = time.time()
+		self.elapsed = 0.0
+		self.read = None				# the Read waited for
+		self.deadline = 0.0
+		self.__data = ''
+		self.__stack = [coroutine]
+
+
+	def needed(self):
+
+		return self.read.count - len(self.__data)
+
+
+	def feed(self, data):
+		"""
+			Adds data read for the Read waited for and resumes the task
+			once all of it is there.
+		"""
+
+		self.__data += data
+		if len(self.__data) >= self.read.count:
+			self.resume()
+
+
+	def resume(self, value=None, error=None):
+		"""
+			Runs the task until it waits for a read or is done. Without
+			value the data read so far is sent.
+		"""
+
+		if value == None and self.read != None:
+			value = self.__data
+		self.read = None
+		self.__data = ''
+
+		while True:
+			coroutine = self.__stack[-1]
+			try:
+				if error != None:
+					request = coroutine.throw(*error)
+				else:
+					request = coroutine.send(value)
+			except StopIteration:
+				request = Return()
+			except Exception:
+				error = sys.exc_info()
+				self.__stack.pop()
+				if len(self.__stack) == 0:
+					self._finish(None, error[1])
+					return
+				continue
+
+			value = None
+			error = None
+			if isinstance(request, Return):
+				coroutine.close()
+				self.__stack.pop()
+				if len(self.__stack) == 0:
+					self._finish(request.value, None)
+					return
+				value = request.value
+			elif isinstance(request, types.GeneratorType):
+				self.__stack.append(request)
+			elif isinstance(request, Read):
+				self.read = request
+				self.deadline = time.time() + request.port.timeout
+				return
+			else:
+				try:
+					raise RuntimeError('Coroutine yielded %r.' % (request,))
+				except RuntimeError:
+					error = sys.exc_info()
+
+
+	def _finish(self, result, error):
+
+		self.done = True
+		self.result = result
+		self.error = error
+		self.elapsed = time.time() - self.started
+
+
+class Loop:
+	"""
+		Loop class.
+		Runs tasks until all of them are done, waiting on all their
+		ports with one select() call.
+	"""
+	def __init__(self):
+
+		self.tasks = []
+
+
+	def spawn(self, coroutine, name=''):
+
+		task = Task(coroutine, name)
+		self.tasks.append(task)
+		return task
+
+
+	def run(self):
+
+		for task in self.tasks:
+			if not task.done and task.read == None:
+				task.resume()
+
+		while True:
+			waiting = [task for task in self.tasks if not task.done]
+			if len(waiting) == 0:
+				return
+
+			descriptors = []
+			timeout = None
+			now = time.time()
+			for task in waiting:
+				fd = task.read.port.fileno()
+				if fd == None:
+					timeout = 0				# answered in memory, no need to wait
+				else:
+					descriptors.append(fd)
+				if timeout == None or task.deadline - now < timeout:
+					timeout = max(task.deadline - now, 0)
+
+			readable = []
+			if len(descriptors) > 0:
+				readable, writable, failed = select.select(descriptors, [], [], timeout)
+
+			for task in waiting:
+				port = task.read.port
+				fd = port.fileno()
+				if fd == None or fd in readable:
+					data = port.read_available(task.needed())
+					if len(data) == 0:
+						task.resume()		# closed, or nothing will come from memory
+						continue
+					task.feed(data)
+				if not task.done and task.read != None and time.time() >= task.deadline:
+					task.resume()			# timed out, send what came
+
+
+class AsyncBootloader:
+	"""
+		AsyncBootloader class.
+		The AVRBootloader commands as coroutines, for bootloaders with
+		block mode. Like AVRBootloader it probes the block size and
+		autoincrement once and skips setting an address the device
+		already points at.
+	"""
+	def __init__(self, port):
+
+		self.port = port
+		self.programmer_id = ''
+		self.block_size = 0
+		self.auto_increment = False
+		self.skipped_addresses = 0
+		self.__pointer = -1				# device address register, -1 if unknown
+
+
+	def connect(self):
+		"""
+			Syncs with the bootloader and probes it.
+		"""
+
+		self.port.write(chr(27) * 10 + 'S')
+		self.programmer_id = yield Read(self.port, 7)
+		if self.programmer_id != 'AVRBOOT':
+			raise RuntimeError('AVR programmer not found.')
+
+		self.port.write('b')
+		if (yield Read(self.port, 1)) == 'Y':
+			size = yield Read(self.port, 2)
+			if len(size) != 2:
+				raise RuntimeError('Programmer did not return the block size.')
+			self.block_size = (ord(size[0]) << 8) | ord(size[1])
+
+		self.port.write('a')
+		self.auto_increment = (yield Read(self.port, 1)) == 'Y'
+		yield Return(True)
+
+
+	def _command(self, command, error):
+
+		self.port.write(command)
+		if (yield Read(self.port, 1)) != '\r':
+			self.__pointer = -1
+			raise RuntimeError('%s Programmer did not ack.' % error)
+		yield Return(True)
+
+
+	def _query(self, command, count):
+
+		self.port.write(command)
+		reply = yield Read(self.port, count)
+		if len(reply) != count:
+			raise RuntimeError("Programmer returned %d of %d bytes for '%s'." %
+			                   (len(reply), count, command[0]))
+		yield Return(reply)
+
+
+	def set_address(self, address):
+
+		if address == self.__pointer:
+			self.skipped_addresses += 1		# the device is already there
+			yield Return(True)
+
+		if address < 0x10000:
+			command = 'A%c%c' % ((address >> 8) & 0xff, address & 0xff)
+		else:
+			command = 'H%c%c%c' % ((address >> 16) & 0xff, (address >> 8) & 0xff,
+			                       address & 0xff)
+		yield self._command(command, 'Setting address failed!')
+		self.__pointer = address
+		yield Return(True)
+
+
+	def chip_erase(self):
+
+		yield self._command('e', 'Chip erase failed!')
+		yield Return(True)
+
+
+	def read_signature(self):
+
+		sigs = yield self._query('s', 3)
+		yield Return((ord(sigs[2]), ord(sigs[1]), ord(sigs[0])))
+
+
+	def write_lock_bits(self, value):
+
+		bits = yield self._query('l%c' % (value & 0xff), 1)
+		yield Return((True, bits))
+
+
+	def read_lock_bits(self):
+
+		bits = yield self._query('r', 1)
+		yield Return((True, ord(bits)))
+
+
+	def read_fuse_bits(self):
+
+		highfuse = yield self._query('N', 1)
+		lowfuse = yield self._query('F', 1)
+		yield Return((True, (ord(highfuse) << 8) | ord(lowfuse)))
+
+
+	def read_extended_fuse_bits(self):
+
+		bits = yield self._query('Q', 1)
+		yield Return((True, ord(bits)))
+
+
+	def write_block(self, memory, address, data):
+		"""
+			Writes data, a whole number of words for flash, at the byte
+			address of memory 'F' or 'E' with a B command.
+		"""
+
+		yield self.set_address(self._word_address(memory, address))
+		frame = bytearray('B%c%c%s' % ((len(data) >> 8) & 0xff, len(data) & 0xff, memory))
+		frame.extend(data)
+		yield self._command(frame, 'Writing %s block failed!' % _memory_name(memory))
+		self._advance(memory, len(data))
+		yield Return(True)
+
+
+	def read_block(self, memory, address, byte_count):
+		"""
+			Reads byte_count bytes, a whole number of words for flash,
+			from the byte address of memory 'F' or 'E' with a g command.
+		"""
+
+		yield self.set_address(self._word_address(memory, address))
+		self.port.write('g%c%c%s' % ((byte_count >> 8) & 0xff, byte_count & 0xff, memory))
+		data = yield Read(self.port, byte_count)
+		if len(data) != byte_count:
+			self.__pointer = -1
+			raise RuntimeError('Reading %s block failed! ' % _memory_name(memory) +
+			                   'Programmer returned %d of %d bytes.' %
+			                   (len(data), byte_count))
+		self._advance(memory, byte_count)
+		yield Return(data)
+
+
+	def write_memory(self, memory, hex_file):
+		"""
+			Writes the populated segments of hex_file to memory in
+			blocks. Flash blocks are padded with 0xff to whole words.
+		"""
+
+		for address, last, parts in self._blocks(memory, hex_file):
+			data = bytearray(chr(0xff) * (last - address + 1))
+			for start, end in parts:
+				data[start - address:end - address + 1] = hex_file.get_range(start, end).tobytes()
+			if memory == 'F' and len(data) & 1:
+				data.append(0xff)
+			yield self.write_block(memory, address, data)
+		yield Return(True)
+
+
+	def verify_memory(self, memory, hex_file, fail_fast=True):
+		"""
+			Compares memory with the populated segments of hex_file one
+			block at a time. Returns the mismatching ranges as (start,
+			end, count) tuples, up to the first bad block with fail_fast.
+		"""
+
+		mismatches = []
+		for address, last, parts in self._blocks(memory, hex_file):
+			count = last - address + 1
+			if memory == 'F':
+				count += count & 1			# whole words, drop the pad byte
+			data = yield self.read_block(memory, address, count)
+
+			for start, end in parts:
+				actual = data[start - address:end - address + 1]
+				expected = hex_file.get_range(start, end).tobytes()
+				if actual == expected:
+					continue
+				for r in hex_util.difference_ranges(expected, actual, start,
+				                                    hex_util.MISMATCH_GAP):
+					if len(mismatches) > 0 and \
+					   r[0] - mismatches[-1][1] <= hex_util.MISMATCH_GAP:
+						mismatches[-1] = (mismatches[-1][0], r[1], mismatches[-1][2] + r[2])
+					else:
+						mismatches.append(r)
+
+			if fail_fast and len(mismatches) > 0:
+				break
+		yield Return(mismatches)
+
+
+	def _blocks(self, memory, hex_file):
+		"""
+			Returns the blocks that cover the populated segments of
+			hex_file, aligned to the block size as AVRBootloader does, as
+			(first, last, parts) with parts the (start, end) populated
+			ranges in the block. Flash blocks start on a word.
+		"""
+
+		if self.block_size == 0:
+			raise RuntimeError('%s needs a bootloader with block mode.' %
+			                   self.__class__.__name__)
+
+		blocks = []
+		for start, end in hex_file.get_segments():
+			address = start
+			while address <= end:
+				first = address
+				if memory == 'F':
+					first &= ~1
+				last = min(address - address % self.block_size + self.block_size - 1, end)
+				if len(blocks) > 0 and first <= blocks[-1][1]:
+					blocks[-1][1] = last			# segments sharing a word
+					blocks[-1][2].append((address, last))
+				else:
+					blocks.append([first, last, [(address, last)]])
+				address = last + 1
+		return blocks
+
+
+	def _word_address(self, memory, address):
+
+		if memory == 'F':
+			return address >> 1				# flash operations use word addresses
+		return address
+
+
+	def _advance(self, memory, byte_count):
+
+		if memory == 'F':
+			byte_count >>= 1
+		if self.__pointer != -1:
+			self.__pointer += byte_count
+
+
+def _memory_name(memory):
+
+	if memory == 'F':
+		return 'Flash'
+	return 'EEPROM'
+
+
+def program_device(prog, device, erase=False, write=(), verify=(), fail_fast=True):
+	"""
+		A coroutine that connects prog, checks the signature of the
+		AVRDevice device, erases the chip if asked and writes and then
+		verifies memories. write and verify are lists of (memory,
+		hex_file) pairs, memory being 'F' or 'E'. Returns the mismatches
+		of each memory verified in a dictionary.
+	"""
+
+	yield prog.connect()
+
+	signature = yield prog.read_signature()
+	if signature != tuple(device.get_signature()):
+		raise RuntimeError('Signature does not match device %s.' % device.get_device_name())
+
+	if erase:
+		yield prog.chip_erase()
+
+	for memory, hex_file in write:
+		yield prog.write_memory(memory, hex_file)
+
+	mismatches = {}
+	for memory, hex_file in verify:
+		mismatches[memory] = yield prog.verify_memory(memory, hex_file, fail_fast)
+	yield Return(mismatches)
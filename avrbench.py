@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+"""
+	avrbench.py
+	Throughput benchmarks for the programming paths.
+"""
+import os
+import sys
+import time
+import json
+import getopt
+import random
+import multiprocessing
+import shutil
+import tempfile
+import avrlog
+import avrprog
+import avrsim
+import avrtransport
+import xtea
+import hex_util
+from hex_util import HexFile, SparseHexFile, LazyHexFile, EncryptedHexFile, EncryptedHexRecord
+from hex_cache import HexCache
+
+class ModelPort:
+	"""
+		ModelPort class.
+		A stand-in for a USB-serial port that answers every read with a
+		CR ack and accumulates the time the traffic would take on the
+		wire: a fixed cost for each write() call plus ten bit times for
+		every byte sent or received.
+	"""
+	def __init__(self, baud, write_overhead=0.001):
+
+		self.__baud = baud
+		self.__write_overhead = write_overhead
+		self.__replies = ''
+		self.writes = 0
+		self.bytes_out = 0
+		self.bytes_in = 0
+
+
+	def queue_reply(self, data):
+
+		self.__replies += data
+
+
+	def write(self, data):
+
+		self.writes += 1
+		self.bytes_out += len(data)
+
+
+	def flush(self):
+
+		pass
+
+
+	def read(self, count):
+
+		data = self.__replies[:count]
+		self.__replies = self.__replies[count:]
+		data += '\r' * (count - len(data))
+		self.bytes_in += count
+		return data
+
+
+	def get_wire_time(self):
+
+		return self.writes * self.__write_overhead + \
+		       (self.bytes_out + self.bytes_in) * 10.0 / self.__baud
+
+
+class PerBytePort(ModelPort):
+	"""
+		PerBytePort class.
+		Splits every write into single byte writes to model the
+		byte-at-a-time framing used before block frames were coalesced.
+	"""
+	def write(self, data):
+
+		for i in range(0, len(data)):
+			ModelPort.write(self, data[i:i + 1])
+
+
+class CountingPort:
+	"""
+		CountingPort class.
+		Wraps the port to a simulated bootloader. Every read is a round
+		trip: it is counted and adds the injected round-trip latency to
+		the virtual clock of the simulator.
+	"""
+	def __init__(self, port, sim, latency):
+
+		self.__port = port
+		self.__sim = sim
+		self.__latency = latency
+		self.reads = 0
+		self.writes = 0
+
+
+	def read(self, count):
+
+		self.reads += 1
+		self.__sim.elapsed += self.__latency
+		return self.__port.read(count)
+
+
+	def readinto(self, view):
+
+		self.reads += 1
+		self.__sim.elapsed += self.__latency
+		return self.__port.readinto(view)
+
+
+	def write(self, data):
+
+		self.writes += 1
+		return self.__port.write(data)
+
+
+	def flush(self):
+
+		self.__port.flush()
+
+
+	def flushInput(self):
+
+		self.__port.flushInput()
+
+
+# programming paths measured by the sweep, and whether they use block mode
+SWEEP_PATHS = (
+	('write_flash', False),
+	('write_flash_block', True),
+	('read_flash_block', True),
+	('write_eeprom', True),
+	('verify_stream', True),
+	('verify_readback', True),
+)
+
+SWEEP_PAGE_SIZE = 128
+
+
+def _new_bootloader(port, page_size, block_size):
+
+	# AVRBootloader is a singleton, reset it for every run.
+	avrprog.AVRBootloader._AVRBootloader__instance = None
+	prog = avrprog.AVRBootloader.instance(port)
+	prog.set_page_size(page_size)
+	prog.set_programmer_id('AVRBOOT')
+
+	# replies to the capability probe: 'V', 'b', 'a' and 't'
+	if block_size > 0:
+		port.queue_reply('12Y%c%cY\x00' % ((block_size >> 8) & 0xff, block_size & 0xff))
+	else:
+		port.queue_reply('12NY\x00')
+	return prog
+
+
+def bench_block_frames(baud, image_size, block_size, write_overhead):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+
+	results = []
+	for port_class in (PerBytePort, ModelPort):
+		port = port_class(baud, write_overhead)
+		prog = _new_bootloader(port, block_size, block_size)
+
+		cpu = time.clock()
+		prog.write_flash_block(hexf)
+		cpu = time.clock() - cpu
+
+		results.append((port.writes, image_size / (port.get_wire_time() + cpu)))
+
+	return results
+
+
+def bench_eeprom(baud, eeprom_size, block_size, write_overhead):
+
+	hexf = HexFile(eeprom_size)
+	hexf.set_used_range(0, eeprom_size - 1)
+
+	results = []
+	for size in (0, block_size):
+		port = ModelPort(baud, write_overhead)
+		prog = _new_bootloader(port, block_size, size)
+
+		cpu = time.clock()
+		prog.write_eeprom(hexf)
+		cpu = time.clock() - cpu
+
+		results.append((port.writes, port.get_wire_time() + cpu))
+
+	return results
+
+
+def _run_path(path, prog, hexf):
+
+	if path in ('write_flash', 'write_flash_block'):
+		prog.write_flash(hexf)
+	elif path == 'write_eeprom':
+		prog.write_eeprom(hexf)
+	elif path == 'verify_stream':
+		prog.verify_flash(hexf, False)
+	else:
+		hexv = SparseHexFile(hexf.get_size())
+		hexv.set_range(0, chr(0xff) * hexf.get_size())
+		hexv.set_used_range(0, hexf.get_size() - 1)
+		prog.read_flash(hexv)
+		if path == 'verify_readback':
+			hexf.get_differences(hexv, 0, hexf.get_size() - 1)
+
+
+def bench_path(path, image_size, block_size, baud, latency, use_pty=False):
+	"""
+		Runs one programming path against a simulated bootloader and
+		returns a dict of bytes/s, round trips per KB and CPU ms per KB.
+		The time is the virtual wire time of the simulator, the injected
+		round-trip latency and the CPU time, which includes the
+		simulator itself.
+	"""
+
+	data = bytearray(random.Random(image_size).getrandbits(8) for i in range(0, image_size))
+	hexf = HexFile(image_size)
+	hexf.set_range(0, data)
+	hexf.set_used_range(0, image_size - 1)
+
+	sim = avrsim.AVR109Simulator(image_size, image_size, SWEEP_PAGE_SIZE, block_size, baud=baud)
+	if path.startswith('read') or path.startswith('verify'):
+		sim.flash[:] = data
+
+	if use_pty:
+		link = avrtransport.PtyTransport(avrsim.serve_pty(sim), 5.0)
+	else:
+		link = avrtransport.MemoryTransport(sim)
+	port = CountingPort(link, sim, latency)
+
+	avrprog.AVRBootloader._AVRBootloader__instance = None
+	prog = avrprog.AVRBootloader.instance(port)
+	prog.set_page_size(SWEEP_PAGE_SIZE)
+	prog.set_programmer_id('AVRBOOT')
+	prog.probe()
+
+	reads = port.reads
+	elapsed = sim.elapsed
+	cpu = time.clock()
+	_run_path(path, prog, hexf)
+	cpu = time.clock() - cpu
+	elapsed = sim.elapsed - elapsed
+	if use_pty:
+		link.close()
+
+	kb = image_size / 1024.0
+	return {'bytes_per_s': image_size / (elapsed + cpu),
+	        'round_trips_per_kb': (port.reads - reads) / kb,
+	        'cpu_ms_per_kb': cpu * 1000.0 / kb}
+
+
+def bench_sweep(sizes, block_sizes, bauds, latencies, use_pty=False):
+	"""
+		Runs every path for every combination of image size, block
+		size, baud rate and round-trip latency (s). Returns a dict of
+		results keyed by 'path size block baud latency_ms'. Paths
+		without block mode are run once per size, baud and latency.
+	"""
+
+	results = {}
+	for path, block_mode in SWEEP_PATHS:
+		for size in sizes:
+			for block_size in (block_sizes if block_mode else (0,)):
+				for baud in bauds:
+					for latency in latencies:
+						key = '%s %d %d %d %g' % (path, size, block_size, baud, latency * 1000)
+						results[key] = bench_path(path, size, block_size, baud, latency, use_pty)
+
+	return results
+
+
+def compare_baseline(results, baseline, tolerance):
+	"""
+		Returns the results that regressed against baseline: more
+		round trips per KB, or bytes/s more than tolerance percent lower.
+	"""
+
+	regressions = []
+	for key in sorted(results):
+		if key not in baseline:
+			continue
+		new = results[key]
+		old = baseline[key]
+		if new['round_trips_per_kb'] > old['round_trips_per_kb'] + 1e-6:
+			regressions.append('%s: %.1f round trips/KB, was %.1f' %
+			                   (key, new['round_trips_per_kb'], old['round_trips_per_kb']))
+		elif new['bytes_per_s'] < old['bytes_per_s'] * (1.0 - tolerance / 100.0):
+			regressions.append('%s: %.0f bytes/s, was %.0f' %
+			                   (key, new['bytes_per_s'], old['bytes_per_s']))
+
+	return regressions
+
+
+def _int_list(text):
+
+	return [int(item, 0) for item in text.split(',')]
+
+
+def bench_parse(image_size):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+	hexf.set_range(0, bytearray([random.randint(0, 255) for i in range(0, image_size)]))
+
+	(fd, file_name) = tempfile.mkstemp('.hex')
+	os.close(fd)
+	try:
+		hexf.write_file(file_name)
+
+		fp = open(file_name, 'r')
+		lines = [line.strip() for line in fp.read().splitlines()]
+		fp.close()
+
+		cpu = time.clock()
+		hexf._parse_lines(lines)
+		slow = time.clock() - cpu
+
+		cpu = time.clock()
+		HexFile(image_size).read_file(file_name)
+		fast = time.clock() - cpu
+	finally:
+		os.remove(file_name)
+
+	return (slow, fast)
+
+
+def bench_cache(image_size):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+	hexf.set_range(0, bytearray([random.randint(0, 255) for i in range(0, image_size)]))
+
+	(fd, file_name) = tempfile.mkstemp('.hex')
+	os.close(fd)
+	cache_path = tempfile.mkdtemp()
+	try:
+		hexf.write_file(file_name)
+
+		cpu = time.clock()
+		HexFile(image_size).read_file(file_name)
+		parse = time.clock() - cpu
+
+		hex_util.set_cache(HexCache(cache_path))
+		HexFile(image_size).read_file(file_name)
+
+		cpu = time.clock()
+		HexFile(image_size).read_file(file_name)
+		cached = time.clock() - cpu
+	finally:
+		hex_util.set_cache(None)
+		shutil.rmtree(cache_path)
+		os.remove(file_name)
+
+	return (parse, cached)
+
+
+def bench_encrypted(image_size):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+	hexf.set_range(0, bytearray([random.randint(0, 255) for i in range(0, image_size)]))
+
+	(fd, file_name) = tempfile.mkstemp('.hex')
+	os.close(fd)
+	try:
+		hexf.write_encrypted(file_name)
+
+		# one record at a time, the way the old implementation worked
+		fp = open(file_name, 'r')
+		lines = [line.strip() for line in fp.read().splitlines()]
+		fp.close()
+
+		cpu = time.clock()
+		for line in lines:
+			rec = EncryptedHexRecord()
+			rec.from_string(line)
+		per_record = time.clock() - cpu
+
+		results = [per_record]
+		for use_numpy in (False, True):
+			if use_numpy and xtea.numpy == None:
+				break
+			saved = xtea.numpy
+			if not use_numpy:
+				xtea.numpy = None
+			try:
+				cpu = time.clock()
+				encf = EncryptedHexFile(image_size)
+				encf.read_file(file_name)
+				encf.write_file(file_name + '.out')
+				results.append(time.clock() - cpu)
+			finally:
+				xtea.numpy = saved
+	finally:
+		os.remove(file_name)
+		if os.path.exists(file_name + '.out'):
+			os.remove(file_name + '.out')
+
+	return results
+
+
+def bench_jobs(image_size, job_counts):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+	hexf.set_range(0, bytearray(os.urandom(image_size)))
+
+	(fd, file_name) = tempfile.mkstemp('.hex')
+	os.close(fd)
+	results = []
+	try:
+		hexf.write_file(file_name)
+		for jobs in job_counts:
+			start = time.time()
+			HexFile(image_size).read_file(file_name, jobs)
+			results.append((jobs, time.time() - start))
+	finally:
+		os.remove(file_name)
+
+	return results
+
+
+def bench_lazy(image_size, reads):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+	hexf.set_range(0, bytearray(os.urandom(image_size)))
+
+	(fd, file_name) = tempfile.mkstemp('.hex')
+	os.close(fd)
+	try:
+		hexf.write_file(file_name)
+		addresses = [random.randrange(image_size) for i in range(0, reads)]
+
+		cpu = time.clock()
+		full = HexFile(image_size)
+		full.read_file(file_name, 1)
+		for address in addresses:
+			full.get_data(address)
+		parsed = time.clock() - cpu
+
+		cpu = time.clock()
+		lazy = LazyHexFile(image_size)
+		lazy.read_file(file_name)
+		for address in addresses:
+			lazy.get_data(address)
+		indexed = time.clock() - cpu
+		lazy.close()
+	finally:
+		os.remove(file_name)
+
+	return (parsed, indexed)
+
+
+def bench_write(image_size, record_sizes):
+
+	hexf = HexFile(image_size)
+	hexf.set_used_range(0, image_size - 1)
+	hexf.set_range(0, bytearray([random.randint(0, 255) for i in range(0, image_size)]))
+
+	(fd, file_name) = tempfile.mkstemp('.hex')
+	os.close(fd)
+	results = []
+	try:
+		for record_size in record_sizes:
+			cpu = time.clock()
+			hexf.write_file(file_name, record_size)
+			results.append((record_size, time.clock() - cpu))
+	finally:
+		os.remove(file_name)
+
+	return results
+
+
+def usage():
+
+	print 'avrbench.py [-s image size] [-k block size] [-o write overhead (ms)] [frames] [eeprom] [parse] [write] [cache] [crypt] [jobs] [lazy]'
+	print 'avrbench.py sweep [--sizes n,...] [--blocks n,...] [--bauds n,...] [--latency ms,...]'
+	print '                  [--pty] [--save file] [--baseline file] [--tolerance percent]'
+
+
+if __name__ == "__main__":
+
+	image_size = 32768
+	block_size = 128
+	write_overhead = 1.0
+	sweep_sizes = [8192, 32768]
+	sweep_blocks = [64, 128, 256]
+	sweep_bauds = [57600, 115200]
+	sweep_latencies = [0.0, 0.001, 0.005]
+	use_pty = False
+	save_file = ''
+	baseline_file = ''
+	tolerance = 10.0
+	try:
+		optlist, args = getopt.gnu_getopt(sys.argv[1:], "s:k:o:h",
+		                              ['sizes=', 'blocks=', 'bauds=', 'latency=', 'pty',
+		                               'save=', 'baseline=', 'tolerance='])
+		for (x, y) in optlist:
+			if x == '-s':
+				image_size = int(y, 0)
+			elif x == '-k':
+				block_size = int(y, 0)
+			elif x == '-o':
+				write_overhead = float(y)
+			elif x == '--sizes':
+				sweep_sizes = _int_list(y)
+			elif x == '--blocks':
+				sweep_blocks = _int_list(y)
+			elif x == '--bauds':
+				sweep_bauds = _int_list(y)
+			elif x == '--latency':
+				sweep_latencies = [float(item) / 1000.0 for item in y.split(',')]
+			elif x == '--pty':
+				use_pty = True
+			elif x == '--save':
+				save_file = y
+			elif x == '--baseline':
+				baseline_file = y
+			elif x == '--tolerance':
+				tolerance = float(y)
+			else:
+				usage()
+				sys.exit(1)
+	except (getopt.GetoptError, ValueError):
+		usage()
+		sys.exit(1)
+
+	avrlog.set_progress(False)
+
+	if len(args) == 0:
+		args = ['frames', 'eeprom', 'parse', 'write', 'cache', 'crypt']
+
+	if 'frames' in args:
+		print 'B..F write, %d byte image, %d byte blocks, %.2f ms per write():' % \
+		      (image_size, block_size, write_overhead)
+		for baud in (57600, 115200):
+			before, after = bench_block_frames(baud, image_size, block_size,
+			                                   write_overhead / 1000.0)
+			print '%7d baud: %6d writes %8.0f bytes/s -> %6d writes %8.0f bytes/s' % \
+			      (baud, before[0], before[1], after[0], after[1])
+
+	if 'eeprom' in args:
+		eeprom_size = 4096
+		print 'EEPROM write, %d bytes, %d byte blocks, %.2f ms per write():' % \
+		      (eeprom_size, block_size, write_overhead)
+		for baud in (57600, 115200):
+			before, after = bench_eeprom(baud, eeprom_size, block_size,
+			                             write_overhead / 1000.0)
+			print '%7d baud: %6d writes %6.2f s (D) -> %6d writes %6.2f s (B..E)' % \
+			      (baud, before[0], before[1], after[0], after[1])
+
+	if 'parse' in args:
+		parse_size = max(image_size, 262144)
+		slow, fast = bench_parse(parse_size)
+		print 'Hex parse, %d byte image: %.3f s per line -> %.3f s bulk (%.1fx)' % \
+		      (parse_size, slow, fast, slow / max(fast, 1e-6))
+
+	if 'write' in args:
+		write_size = max(image_size, 262144)
+		print 'Hex write, %d byte image:' % write_size
+		for record_size, cpu in bench_write(write_size, (16, 32, 64, 255)):
+			print '%7d byte records: %.3f s' % (record_size, cpu)
+
+	if 'cache' in args:
+		cache_size = max(image_size, 262144)
+		parse, cached = bench_cache(cache_size)
+		print 'Hex load, %d byte image: %.3f s parsed -> %.3f s cached' % \
+		      (cache_size, parse, cached)
+
+	if 'crypt' in args:
+		crypt_size = max(image_size, 131072)
+		results = bench_encrypted(crypt_size)
+		print 'Encrypted hex, %d byte image:' % crypt_size
+		print '  decrypt per record:          %.3f s' % results[0]
+		print '  decrypt + encrypt, batched:  %.3f s' % results[1]
+		if len(results) > 2:
+			print '  decrypt + encrypt, numpy:    %.3f s' % results[2]
+
+	if 'jobs' in args:
+		jobs_size = max(image_size, 0x400000)
+		print 'Parallel hex parse, %d byte image, %d CPUs:' % \
+		      (jobs_size, multiprocessing.cpu_count())
+		for jobs, elapsed in bench_jobs(jobs_size, (1, 2, 4, 8)):
+			print '%7d jobs: %.3f s' % (jobs, elapsed)
+
+	if 'lazy' in args:
+		lazy_size = max(image_size, 0x400000)
+		parsed, indexed = bench_lazy(lazy_size, 16)
+		print 'Read 16 bytes of a %d byte image: %.3f s parsed -> %.3f s lazy' % \
+		      (lazy_size, parsed, indexed)
+
+	if 'sweep' in args:
+		results = bench_sweep(sweep_sizes, sweep_blocks, sweep_bauds, sweep_latencies, use_pty)
+		print '%-18s %7s %5s %7s %6s %10s %8s %9s' % \
+		      ('path', 'size', 'block', 'baud', 'rtt ms', 'bytes/s', 'rt/KB', 'cpu ms/KB')
+		for key in sorted(results, key=lambda k: [int(f) if f.isdigit() else f
+		                                          for f in k.split()]):
+			path, size, block, baud, latency = key.split()
+			result = results[key]
+			print '%-18s %7s %5s %7s %6s %10.0f %8.1f %9.2f' % \
+			      (path, size, block, baud, latency, result['bytes_per_s'],
+			       result['round_trips_per_kb'], result['cpu_ms_per_kb'])
+
+		if len(save_file) > 0:
+			fp = open(save_file, 'w')
+			json.dump(results, fp, indent=1, sort_keys=True)
+			fp.close()
+
+		if len(baseline_file) > 0:
+			fp = open(baseline_file, 'r')
+			baseline = json.load(fp)
+			fp.close()
+			regressions = compare_baseline(results, baseline, tolerance)
+			for regression in regressions:
+				print 'REGRESSION %s' % regression
+			if len(regressions) > 0:
+				sys.exit(1)
+			print 'No regressions against %s.' % baseline_file
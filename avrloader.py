@@ -7,24 +7,15 @@ import sys
 import ConfigParser
 import traceback
 import avrlog
+import hex_util
+from hex_cache import HexCache
 from job_info import *
 
-"""
-	avrloader.py main.
-	This module is invoked from the command line to start the
-	application that interfaces with the AVR device bootloader.
-	See the JobInfo class for command line parameter documentation.
-"""
-if __name__ == "__main__":
-
-	avrlog.openlog('avrloader', avrlog.LOG_PID, avrlog.LOG_DAEMON)
-
-	home_dir = sys.argv[0]
-	slash_pos = sys.argv[0].rfind(os.sep)
-	if slash_pos == -1:
-		home_dir = '.'
-	else:
-		home_dir = sys.argv[0][:slash_pos]
+def read_config(home_dir):
+	"""
+		Reads avrloader.cfg from home_dir and sets up logging and the
+		hex cache from it. Returns the parser.
+	"""
 
 	parser = ConfigParser.ConfigParser()
 	cfg_file_name = '%s%savrloader.cfg' % (home_dir, os.sep)
@@ -37,18 +28,61 @@ if __name__ == "__main__":
 		traceback.print_exc()
 		avrlog.setlogmask(avrlog.LOG_UPTO(avrlog.LOG_ERR))
 
+	try:
+		if parser.has_option('Cache', 'path') and len(parser.get('Cache', 'path')) > 0:
+			max_size = 64
+			if parser.has_option('Cache', 'max_size'):
+				max_size = parser.getint('Cache', 'max_size')
+			hex_util.set_cache(HexCache(parser.get('Cache', 'path'), max_size * 1024 * 1024))
+	except (IOError, OSError):
+		avrlog.avrlog(avrlog.LOG_WARNING, 'Hex cache disabled, cannot use %s.' %
+		              parser.get('Cache', 'path'))
+
+	return parser
+
+
+def configure_job(j, parser):
+	"""
+		Applies the configuration file settings the command line of
+		JobInfo j did not override.
+	"""
+
+	if parser.has_option('Bootloader', 'profile'):
+		j.profile_file = parser.get('Bootloader', 'profile')
+	if len(j.com_port_name) == 0:
+		device = parser.get('Communication', 'device')
+		baud = parser.getint('Communication', 'baud')
+		timeout = parser.getfloat('Communication', 'timeout')
+		j.set_comms(device, baud, timeout)
+
+
+def home_directory():
+
+	slash_pos = sys.argv[0].rfind(os.sep)
+	if slash_pos == -1:
+		return '.'
+	return sys.argv[0][:slash_pos]
+
+
+"""
+	avrloader.py main.
+	This module is invoked from the command line to start the
+	application that interfaces with the AVR device bootloader.
+	See the JobInfo class for command line parameter documentation.
+"""
+if __name__ == "__main__":
+
+	avrlog.openlog('avrloader', avrlog.LOG_PID, avrlog.LOG_DAEMON)
+
+	parser = read_config(home_directory())
+
 	try:
 		j = JobInfo()
 		j.parse_command_line(sys.argv)
-		if len(j.com_port_name) == 0:
-			device = parser.get('Communication', 'device')
-			baud = parser.getint('Communication', 'baud')
-			timeout = parser.getfloat('Communication', 'timeout')
-			j.set_comms(device, baud, timeout)
+		configure_job(j, parser)
 		j.do_job()
 	except RuntimeError, r_exc:
 		avrlog.avrlog(avrlog.LOG_ERR, r_exc.message)
 	except:
 		avrlog.avrlog(avrlog.LOG_ERR, traceback.format_exc().replace('\n', '; '))
 	avrlog.closelog()
-
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+	avrloaderc.py
+	AVR Loader client. Sends its command line, the same switches as
+	avrloader.py, to a running avrloaderd.py and prints the output
+	of the job. Exits with the status of the job.
+"""
+import os
+import sys
+import json
+import socket
+import ConfigParser
+
+SOCKET_NAME = '/tmp/avrloader.sock'
+
+def socket_name():
+
+	home_dir = os.path.dirname(sys.argv[0]) or '.'
+	parser = ConfigParser.ConfigParser()
+	parser.read(os.path.join(home_dir, 'avrloader.cfg'))
+	if parser.has_option('Daemon', 'socket') and len(parser.get('Daemon', 'socket')) > 0:
+		return parser.get('Daemon', 'socket')
+	return SOCKET_NAME
+
+
+def send_job(name, argv, cwd):
+	"""
+		Sends the job to the daemon on socket name, copies its output
+		to stdout and returns its exit status.
+	"""
+
+	conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	conn.connect(name)
+	conn.sendall(json.dumps({'argv': argv, 'cwd': cwd}) + '\n')
+
+	tail = ''
+	while True:
+		data = conn.recv(4096)
+		if len(data) == 0:
+			break
+		data = tail + data
+		end = data.find('\x00')
+		if end != -1:
+			sys.stdout.write(data[:end])
+			tail = data[end:]
+		else:
+			sys.stdout.write(data)
+			tail = ''
+		sys.stdout.flush()
+	conn.close()
+
+	if not tail.startswith('\x00'):
+		sys.stderr.write('avrloaderd.py closed the connection.\n')
+		return 1
+	return int(tail[1:].strip() or 1)
+
+
+if __name__ == "__main__":
+
+	name = socket_name()
+	try:
+		status = send_job(name, sys.argv[1:], os.getcwd())
+	except socket.error, exc:
+		sys.stderr.write('Cannot reach avrloaderd.py on %s (%s).\n' % (name, exc))
+		status = 2
+	sys.exit(status)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+	avrloaderd.py
+	AVR Loader daemon. Runs the jobs that avrloaderc.py sends over a
+	Unix socket, keeping the ports, devices and input images of
+	earlier jobs so a job does not pay for them again.
+"""
+import os
+import sys
+import json
+import socket
+import signal
+import threading
+import traceback
+import avrlog
+import avrdev
+import avrprog
+import avrtransport
+import avrloader
+from job_info import JobInfo
+
+SOCKET_NAME = '/tmp/avrloader.sock'
+IMAGE_LIMIT = 16			# parsed images kept, the cache is dropped beyond
+
+class Output:
+	"""
+		Output class.
+		Stands in for sys.stdout, so the log and messages of a job go
+		to the client that sent it and everything else to the console.
+	"""
+	def __init__(self, console):
+
+		self.console = console
+		self.target = None
+
+
+	def write(self, text):
+
+		if self.target == None:
+			self.console.write(text)
+			return
+		try:
+			self.target.write(text)
+		except (IOError, socket.error):
+			self.target = None				# the client went away, finish quietly
+
+
+	def flush(self):
+
+		if self.target == None:
+			self.console.flush()
+
+
+class Sessions:
+	"""
+		Sessions class.
+		The open ports with their synced programmers, the devices read
+		and the input images parsed by earlier jobs. A port that takes
+		part in a failed job is closed and opened again by the next.
+	"""
+	def __init__(self):
+
+		self.images = {}
+		self.__ports = {}				# name: (port, programmer, (baud, timeout))
+		self.__devices = {}
+		self.__lock = threading.Lock()
+
+
+	def open(self, job):
+		"""
+			Returns the port and programmer for the port of job,
+			reusing the session of an earlier job if it still answers.
+		"""
+
+		self.__lock.acquire()
+		try:
+			session = self.__ports.pop(job.com_port_name, None)
+		finally:
+			self.__lock.release()
+
+		if session != None:
+			port, prog, settings = session
+			try:
+				if settings == (job.baud, job.timeout) and prog.resync():
+					avrlog.avrlog(avrlog.LOG_DEBUG, 'Reusing %s.' % job.com_port_name)
+					return port, prog
+			except (IOError, OSError, RuntimeError):
+				pass
+			port.close()
+
+		port = avrtransport.open_transport(job.com_port_name, job.baud, job.timeout,
+		                                   job.device_name, job.search_path)
+		try:
+			return port, avrprog.AVRProgrammer.connect(port)
+		except:
+			port.close()
+			raise
+
+
+	def release(self, job, port, prog, done):
+		"""
+			Keeps the port of job open for the next job if it succeeded.
+		"""
+
+		if not done:
+			port.close()
+			return
+
+		self.__lock.acquire()
+		try:
+			self.__ports[job.com_port_name] = (port, prog, (job.baud, job.timeout))
+		finally:
+			self.__lock.release()
+
+
+	def device(self, name, search_path):
+
+		self.__lock.acquire()
+		try:
+			key = (name, search_path)
+			if not key in self.__devices:
+				device = avrdev.AVRDevice(name)
+				device.read_avr_parameters(search_path)
+				self.__devices[key] = device
+			return self.__devices[key]
+		finally:
+			self.__lock.release()
+
+
+	def close(self):
+
+		self.__lock.acquire()
+		try:
+			for port, prog, settings in self.__ports.values():
+				port.close()
+			self.__ports = {}
+		finally:
+			self.__lock.release()
+
+
+class DaemonJob(JobInfo):
+	"""
+		DaemonJob class.
+		A JobInfo that takes its ports from the daemon sessions instead
+		of opening and syncing them for every job.
+	"""
+	def __init__(self, sessions):
+
+		JobInfo.__init__(self)
+		self.sessions = sessions
+
+
+	def _open_programmer(self):
+
+		return self.sessions.open(self)
+
+
+	def _close_programmer(self, port, prog, done):
+
+		self.sessions.release(self, port, prog, done)
+
+
+class Daemon:
+	"""
+		Daemon class.
+		Answers one client at a time. A client sends a JSON line with
+		the avrloader.py arguments and its working directory, receives
+		the output of the job and then a NUL byte and the exit status.
+	"""
+	def __init__(self, parser, output, socket_name=SOCKET_NAME):
+
+		self.parser = parser
+		self.output = output
+		self.socket_name = socket_name
+		self.sessions = Sessions()
+		self.home_dir = os.getcwd()
+		self.own_path = os.path.abspath(sys.argv[0])
+
+
+	def serve(self):
+
+		if os.path.exists(self.socket_name):
+			os.remove(self.socket_name)		# left by a daemon that did not stop cleanly
+
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.socket_name)
+		server.listen(5)
+		avrlog.avrlog(avrlog.LOG_INFO, 'Listening on %s.' % self.socket_name)
+		try:
+			while True:
+				conn, peer = server.accept()
+				try:
+					self.handle(conn)
+				except (IOError, socket.error, ValueError), exc:
+					avrlog.avrlog(avrlog.LOG_WARNING, 'Client dropped: %s' % exc)
+				conn.close()
+		finally:
+			server.close()
+			os.remove(self.socket_name)
+			self.sessions.close()
+
+
+	def handle(self, conn):
+
+		request = json.loads(conn.makefile('r').readline())
+		reply = conn.makefile('w', 0)
+
+		self.output.target = reply
+		try:
+			status = self.run(request['argv'], request.get('cwd', self.home_dir))
+		finally:
+			self.output.target = None
+
+		reply.write('\x00%d\n' % status)
+
+
+	def run(self, argv, cwd):
+		"""
+			Runs the job for the avrloader.py arguments argv in the
+			directory cwd and returns its exit status.
+		"""
+
+		avrlog.set_silent(False)
+		avrlog.set_progress(True)
+		if len(self.sessions.images) > IMAGE_LIMIT:
+			self.sessions.images.clear()
+
+		try:
+			os.chdir(cwd)
+			j = DaemonJob(self.sessions)
+			j.parse_command_line([self.own_path] + argv)
+			avrloader.configure_job(j, self.parser)
+			if len(j.device_name) > 0:
+				j.device = self.sessions.device(j.device_name, j.search_path)
+			j.image_cache = self.sessions.images
+			j.do_job()
+			if len(j.flash_mismatches) > 0 or len(j.eeprom_mismatches) > 0:
+				return 1
+			return 0
+		except RuntimeError, r_exc:
+			avrlog.avrlog(avrlog.LOG_ERR, r_exc.message)
+		except SystemExit, exc:
+			if exc.code == None:
+				return 0
+			if isinstance(exc.code, int):
+				return exc.code
+		except Exception:
+			avrlog.avrlog(avrlog.LOG_ERR, traceback.format_exc().replace('\n', '; '))
+		finally:
+			os.chdir(self.home_dir)
+		return 1
+
+
+def socket_name(parser):
+
+	if parser.has_option('Daemon', 'socket') and len(parser.get('Daemon', 'socket')) > 0:
+		return parser.get('Daemon', 'socket')
+	return SOCKET_NAME
+
+
+def _terminate(signum, frame):
+
+	raise KeyboardInterrupt()		# not caught by a running job, unlike SystemExit
+
+
+if __name__ == "__main__":
+
+	output = Output(sys.stdout)
+	sys.stdout = output				# before openlog, the log handler writes here
+	avrlog.openlog('avrloaderd', avrlog.LOG_PID, avrlog.LOG_DAEMON)
+
+	parser = avrloader.read_config(avrloader.home_directory())
+	signal.signal(signal.SIGTERM, _terminate)
+
+	try:
+		Daemon(parser, output, socket_name(parser)).serve()
+	except KeyboardInterrupt:
+		pass
+	avrlog.closelog()
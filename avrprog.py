@@ -2,8 +2,15 @@
 	avrprog.py
 	AVR programmer and bootloader
 """
-import avrlog
+import os
 import types
+import tempfile
+import threading
+import ConfigParser
+import avrlog
+import hex_util
+
+_profile_lock = threading.Lock()		# one profile update at a time, gang ports share it
 
 class AVRProgrammer:
 	"""
@@ -27,22 +34,36 @@ class AVRProgrammer:
 	def instance(port=None):
 
 		if AVRProgrammer.__instance is None:
-			for i in range(0, 10):				# sync with programmer
-				port.write(chr(27))
-				port.flush()
+			AVRProgrammer.__instance = AVRProgrammer.connect(port)
+			AVRBootloader.set_instance(AVRProgrammer.__instance)
+
+		return AVRProgrammer.__instance
+	instance = staticmethod(instance)
+
+
+	def connect(port):
+		"""
+			Syncs with the bootloader on port and returns a new
+			AVRBootloader for it. Unlike instance() this may be called
+			for any number of ports, one programmer each.
+		"""
 
-			port.write('S')						# get programmer ID
+		for i in range(0, 10):				# sync with programmer
+			port.write(chr(27))
 			port.flush()
 
-			pid = port.read(7)
-			avrlog.avrlog(avrlog.LOG_DEBUG, 'Read programmer ID: (%s)' % pid)
-			if pid == 'AVRBOOT':
-				AVRProgrammer.__instance = AVRBootloader.instance(port)
-			else:
-				raise RuntimeError('AVR programmer not found.')
+		port.write('S')						# get programmer ID
+		port.flush()
 
-		return AVRProgrammer.__instance
-	instance = staticmethod(instance)
+		pid = port.read(7)
+		avrlog.avrlog(avrlog.LOG_DEBUG, 'Read programmer ID: (%s)' % pid)
+		if pid != 'AVRBOOT':
+			raise RuntimeError('AVR programmer not found.')
+
+		prog = AVRBootloader(port)
+		prog.set_programmer_id(pid)
+		return prog
+	connect = staticmethod(connect)
 
 
 class AVRBootloader:
@@ -50,12 +71,22 @@ class AVRBootloader:
 	__instance = None
 	def __init__(self, port):
 
-		if AVRBootloader.__instance != None:
-			raise AVRProgrammer.__instance
-
-		AVRBootloader.__instance = self
 		self.__port = port
 		self.__page_size = -1
+		self.__pipeline_depth = 1
+		self.__pending = []				# (error, command, address) awaiting a CR
+		self.__sent = 0
+		self.__pointer = -1				# device address register, -1 if unknown
+		self.skipped_addresses = 0		# redundant set_address calls not sent
+
+		# capabilities, see probe()
+		self.__programmer_id = ''
+		self.__software_version = ''
+		self.__block_size = -1			# 0 without block support, -1 until probed
+		self.__auto_increment = False
+		self.__device_codes = []
+		self.__erases_pages = False		# only set from the profile
+		self.__profile = ''
 
 
 	def get_page_size(self):
@@ -68,6 +99,201 @@ class AVRBootloader:
 		self.__page_size = size
 
 
+	def get_pipeline_depth(self):
+
+		return self.__pipeline_depth
+
+
+	def set_pipeline_depth(self, depth):
+		"""
+			Sets how many CR acked commands may be sent before the oldest
+			ack is read. A depth of 1 waits for every ack. Larger depths
+			hide the link round trip but the bootloader must be able to
+			buffer that many commands.
+		"""
+
+		if depth < 1:
+			raise RuntimeError('Pipeline depth must be 1 or greater.')
+		self.check_acks()
+		self.__pipeline_depth = depth
+
+
+	def set_programmer_id(self, pid):
+
+		self.__programmer_id = pid
+
+
+	def get_programmer_id(self):
+
+		return self.__programmer_id
+
+
+	def get_block_size(self):
+
+		self.probe()
+		return self.__block_size
+
+
+	def get_auto_increment(self):
+
+		self.probe()
+		return self.__auto_increment
+
+
+	def get_device_codes(self):
+
+		self.probe()
+		return self.__device_codes
+
+
+	def get_erases_pages(self):
+		"""
+			Tells if the bootloader erases each flash page before it
+			writes it. AVR109 cannot report this, so it is taken from
+			the erases_pages setting of the profile; False without one.
+		"""
+
+		self.probe()
+		return self.__erases_pages
+
+
+	def set_profile(self, file_name):
+		"""
+			Sets the profile file that keeps the capabilities of each
+			programmer ID and software version seen, so later
+			connections can skip most of the probe.
+		"""
+
+		self.__profile = file_name
+
+
+	def probe(self):
+		"""
+			Queries the programmer ID, software version, block size,
+			autoincrement support and supported device codes, once per
+			connection. The programmer operations use the results
+			instead of asking again.
+		"""
+
+		if self.__block_size != -1:
+			return
+
+		if len(self.__programmer_id) == 0:
+			self.__programmer_id = self._query('S', 7)
+		self.__software_version = self._query('V', 2)
+
+		if self._load_profile():
+			return
+
+		self.__block_size = 0
+		if self._query('b', 1) == 'Y':
+			self.__block_size = self._read_block_size()
+		self.__auto_increment = self._query('a', 1) == 'Y'
+
+		self.check_acks()
+		self.__port.write('t')
+		self.__port.flush()
+		self.__device_codes = []
+		while len(self.__device_codes) < 256:
+			code = self.__port.read(1)
+			if len(code) == 0 or code == '\x00':
+				break
+			self.__device_codes.append(ord(code))
+
+		avrlog.avrlog(avrlog.LOG_DEBUG, 'Probed %s %s: block size %d, autoincrement %s' %
+		              (self.__programmer_id, self.__software_version,
+		               self.__block_size, self.__auto_increment))
+		self._store_profile()
+
+
+	def _profile_section(self):
+
+		return '%s %s' % (self.__programmer_id, self.__software_version)
+
+
+	def _load_profile(self):
+
+		if len(self.__profile) == 0:
+			return False
+
+		parser = ConfigParser.RawConfigParser()
+		try:
+			parser.read(self.__profile)
+			section = self._profile_section()
+			if not parser.has_section(section):
+				return False
+
+			block_size = parser.getint(section, 'block_size')
+			auto_increment = parser.getboolean(section, 'auto_increment')
+			device_codes = [int(code, 16) for code in
+			                parser.get(section, 'device_codes').split()]
+			erases_pages = parser.has_option(section, 'erases_pages') and \
+			               parser.getboolean(section, 'erases_pages')
+		except (ConfigParser.Error, ValueError), exc:
+			avrlog.avrlog(avrlog.LOG_DEBUG, 'Bootloader profile ignored: %s' % exc)
+			return False
+
+		self.__block_size = block_size
+		self.__auto_increment = auto_increment
+		self.__device_codes = device_codes
+		self.__erases_pages = erases_pages
+		avrlog.avrlog(avrlog.LOG_DEBUG, 'Using bootloader profile for %s.' % section)
+		return True
+
+
+	def _store_profile(self):
+
+		"""
+			Saves the probed capabilities in the profile file, unless it
+			already holds them. Only the options of this section are
+			changed, other lines and comments are kept, and the file is
+			replaced at once so a concurrent _load_profile never reads
+			it half written.
+		"""
+
+		if len(self.__profile) == 0:
+			return
+
+		section = self._profile_section()
+		values = [('block_size', str(self.__block_size)),
+		          ('auto_increment', str(self.__auto_increment)),
+		          ('device_codes', ' '.join(['%02x' % code for code in self.__device_codes]))]
+
+		_profile_lock.acquire()
+		try:
+			parser = ConfigParser.RawConfigParser()
+			parser.read(self.__profile)
+			if parser.has_section(section) and \
+			   [(name, parser.has_option(section, name) and parser.get(section, name))
+			    for name, value in values] == values:
+				return
+
+			lines = []
+			if os.path.exists(self.__profile):
+				fp = open(self.__profile, 'r')
+				lines = fp.readlines()
+				fp.close()
+			_replace_file(self.__profile, ''.join(_set_options(lines, section, values)))
+		except (ConfigParser.Error, IOError, OSError), exc:
+			avrlog.avrlog(avrlog.LOG_DEBUG, 'Bootloader profile not saved: %s' % exc)
+		finally:
+			_profile_lock.release()
+
+
+	def resync(self):
+		"""
+			Checks that a connection kept open between jobs still
+			answers with the same programmer ID. The board may have been
+			reset meanwhile, so the address register is taken as unknown.
+		"""
+
+		self.__pending = []
+		self.__pointer = -1
+		if hasattr(self.__port, 'flushInput'):
+			self.__port.flushInput()
+		return self._query('S', 7) == self.__programmer_id
+
+
 	def enter_programming_mode(self):
 
 		return True
@@ -75,20 +301,15 @@ class AVRBootloader:
 
 	def leave_programming_mode(self):
 
+		self.check_acks()
 		return True
 
 
 	def chip_erase(self):
 
-		result = True
-		self.__port.write('e')
-		self.__port.flush()
-
-		if self.__port.read(1) != '\r':
-			result = False
-			avrlog.avrlog(avrlog.LOG_ERR, 'Chip erase failed! Programmer did not ack.')
-
-		return result
+		self._command('e', 'Chip erase failed!')
+		self.check_acks()
+		return True
 
 
 	def rc_calibrate(self):
@@ -103,13 +324,10 @@ class AVRBootloader:
 
 	def read_signature(self):
 
-		self.__port.write('s')
-		self.__port.flush()
-
 		sig0 = None
 		sig1 = None
 		sig2 = None
-		sigs = self.__port.read(3)
+		sigs = self._query('s', 3)
 		if len(sigs) == 3:
 			sig2 = ord(sigs[0])
 			sig1 = ord(sigs[1])
@@ -145,6 +363,8 @@ class AVRBootloader:
 
 			self.set_address(address >> 1)
 			self.write_flash_page()
+			self.check_acks()
+			return True
 		else:
 			raise RuntimeError('AVRBootloader.write_flash_bytes received %s:%s, ' %
 			                   (str(type(address)), str(type(value))) +
@@ -156,17 +376,9 @@ class AVRBootloader:
 		if type(value) == types.IntType and value < 0x100 and \
 		   type(address) == types.IntType:
 			self.set_address(address)
-			result = True
-			self.__port.write('D')
-			self.__port.write(chr(value))
-			self.__port.flush()
-
-			if self.__port.read(1) != '\r':
-				result = False
-				avrlog.avrlog(avrlog.LOG_ERR, 'Write eeprom byte failed! ' +
-				              'Programmer did not ack.')
-
-			return result
+			self._command('D%c' % value, 'Write eeprom byte failed!')
+			self.check_acks()
+			return True
 		else:
 			raise RuntimeError('AVRBootloader.write_flash_bytes received %s:%s, ' %
 			                   (str(type(address)), str(type(value))) +
@@ -178,30 +390,118 @@ class AVRBootloader:
 		if self.__page_size == -1:
 			raise RuntimeError('Programmer page size not set!')
 
-		self.__port.write('b')
-		self.__port.flush()
-
-		if self.__port.read(1) == 'Y':
+		self.probe()
+		if self.__block_size > 0:
 			avrlog.avrlog(avrlog.LOG_DEBUG, 'Using block mode...')
 			return self.write_flash_block(hex_file)
 
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+		for start, end in hex_file.get_segments():
+			self._write_flash_bytes(hex_file, start, end, self.__auto_increment)
 
-		# check autoincrement support
-		self.__port.write('a')
-		self.__port.flush()
+		self.check_acks()
+		avrlog.progress('\n')
+		return True
+
+
+	def write_flash_block(self, hex_file):
+
+		block_size = self.get_block_size()
+
+		for start, end in hex_file.get_segments():
+			self._write_flash_blocks(hex_file, start, end, block_size)
+
+		self.check_acks()
+		avrlog.progress('\n')
+
+		return True
 
-		autoincrement = False
-		if self.__port.read(1) == 'Y':
-			autoincrement = true
+
+	def write_flash_pages(self, hex_file, pages):
+		"""
+			Programs only the listed flash pages, clipped to the
+			populated segments of hex_file. Runs of consecutive pages are
+			sent together.
+		"""
+
+		if self.__page_size == -1:
+			raise RuntimeError('Programmer page size not set!')
+
+		self.probe()
+		block_size = self.__block_size
+		segments = hex_file.get_segments()
+
+		i = 0
+		while i < len(pages):
+			first = pages[i]
+			while i + 1 < len(pages) and pages[i + 1] == pages[i] + 1:
+				i += 1
+
+			run_start = first * self.__page_size
+			run_end = (pages[i] + 1) * self.__page_size - 1
+			for seg_start, seg_end in segments:
+				start = max(run_start, seg_start)
+				end = min(run_end, seg_end)
+				if start > end:
+					continue
+
+				if block_size > 0:
+					self._write_flash_blocks(hex_file, start, end, block_size)
+				else:
+					self._write_flash_bytes(hex_file, start, end, self.__auto_increment)
+			i += 1
+
+		self.check_acks()
+		avrlog.progress('\n')
+
+		return True
+
+
+	def write_flash_diff(self, hex_file, shadow):
+		"""
+			Programs only the flash pages where hex_file differs from
+			shadow, a HexFile holding what the device currently contains.
+			Programming can only clear bits, so unless the profile says
+			the bootloader erases pages, a page that needs a bit set is
+			refused before anything is written. Returns the number of
+			populated pages written and skipped.
+		"""
+
+		if self.__page_size == -1:
+			raise RuntimeError('Programmer page size not set!')
+
+		pages = hex_file.get_changed_pages(shadow, self.__page_size)
+		total = len(hex_file.get_populated_pages(self.__page_size))
+
+		if not self.get_erases_pages():
+			unwritable = hex_file.get_unwritable_pages(shadow, self.__page_size)
+			if len(unwritable) > 0:
+				raise RuntimeError('%d changed flash pages need an erase, from 0x%X on. ' %
+				                   (len(unwritable), unwritable[0] * self.__page_size) +
+				                   'Program the full image with -e instead of --diff.')
+
+		if len(pages) > 0:
+			self.write_flash_pages(hex_file, pages)
+
+		return (len(pages), total - len(pages))
+
+
+	def _read_block_size(self):
+
+		size = self.__port.read(2)
+		if len(size) != 2:
+			raise RuntimeError('Programmer did not return the block size.')
+		return (ord(size[0]) << 8) | ord(size[1])
+
+
+	def _write_flash_bytes(self, hex_file, start, end, autoincrement):
 
 		self.set_address(start >> 1)	# flash operations use word addresses
 
+		data = bytearray(hex_file.get_range(start, end))
 		address = start
 		if address & 1:
 			self.write_flash_low_byte(0xff)
-			self.write_flash_high_byte(hex_file.get_data(address))
+			self.write_flash_high_byte(data[address - start])
 			address += 1
 			if address % self.__page_size == 0 or address > end:
 				self.set_address((address - 2) >> 1)
@@ -211,8 +511,8 @@ class AVRBootloader:
 		while (end - address + 1) >= 2:
 			if not autoincrement:
 				self.set_address(address >> 1)
-			self.write_flash_low_byte(hex_file.get_data(address))
-			self.write_flash_high_byte(hex_file.get_data(address + 1))
+			self.write_flash_low_byte(data[address - start])
+			self.write_flash_high_byte(data[address + 1 - start])
 			address += 2
 
 			if address % 256 == 0:
@@ -224,23 +524,16 @@ class AVRBootloader:
 				self.set_address(address >> 1)
 
 		if address == end:
-			self.write_flash_low_byte(hex_file.get_data(address))
+			if not autoincrement:
+				self.set_address(address >> 1)
+			self.write_flash_low_byte(data[address - start])
 			self.write_flash_high_byte(0xff)
 			address += 2
 			self.set_address((address - 2) >> 1)
 			self.write_flash_page()
 
-		avrlog.progress('\n')
-		return True
 
-
-	def write_flash_block(self, hex_file):
-
-		# Get block size assuming the 'b' command was just ack'ed with a 'Y'
-		block_size = (ord(self.__port.read(1)) << 8) | ord(self.__port.read(1))
-
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+	def _write_flash_blocks(self, hex_file, start, end, block_size):
 
 		address = start
 		if address & 1:
@@ -257,7 +550,7 @@ class AVRBootloader:
 				self.set_address(address >> 1)
 
 		if (address % block_size) > 0:
-			byte_count = block_size - (address & block_size)
+			byte_count = block_size - (address % block_size)
 
 			if (address + byte_count - 1) > end:
 				byte_count = end - address + 1
@@ -265,148 +558,219 @@ class AVRBootloader:
 
 			if byte_count > 0:
 				self.set_address(address >> 1)
-
-				self.__port.write('B')
-				self.__port.write(chr((byte_count >> 8) & 0xff))
-				self.__port.write(chr(byte_count & 0xff))
-				self.__port.write('F')
-
-				while byte_count > 0:
-					self.__port.write(hex_file.get_data(address))
-					address += 1
-					byte_count -= 1
-
-				if self.__port.read(1) != '\r':
-					raise RuntimeError('Writing Flash block failed! ' +
-					                   'Programmer did not return CR after B..F command')
+				self._write_block('F', hex_file.get_range(address, address + byte_count - 1),
+				                  byte_count)
+				address += byte_count
 				avrlog.progress('.')
 
 		while (end - address + 1) >= block_size:
 
-			byte_count = block_size
-
 			self.set_address(address >> 1)
-
-			self.__port.write('B')
-			self.__port.write(chr((byte_count >> 8) & 0xff))
-			self.__port.write(chr(byte_count & 0xff))
-			self.__port.write('F')
-
-			while byte_count > 0:
-				self.__port.write(chr(hex_file.get_data(address)))
-				address += 1
-				byte_count -= 1
-
-			if self.__port.read(1) != '\r':
-				raise RuntimeError('Writing Flash block failed! ' +
-				                   'Programmer did not return CR after B..F command')
+			self._write_block('F', hex_file.get_range(address, address + block_size - 1),
+			                  block_size)
+			address += block_size
 			avrlog.progress('.')
 
 		if (end - address + 1) >= 1:
 
 			byte_count = (end - address + 1)
 			if byte_count & 1:
-				byte_count += 1
+				byte_count += 1				# Pad with 0xff to a whole word
 
 			self.set_address(address >> 1)
+			self._write_block('F', hex_file.get_range(address, end), byte_count)
+			address += byte_count
+			avrlog.progress('.')
 
-			self.__port.write('B')
-			self.__port.write(chr((byte_count >> 8) & 0xff))
-			self.__port.write(chr(byte_count & 0xff))
-			self.__port.write('F')
 
-			while byte_count > 0:
-				if address > end:
-					self.__port.write(chr(0xff))
-				else:
-					self.__port.write(chr(hex_file.get_data(address)))
-				address += 1
-				byte_count -= 1
+	def _block_frame(self, memory, data, byte_count):
+		"""
+			Builds a complete B..F or B..E command as one buffer. Data
+			shorter than byte_count is padded with 0xff.
+		"""
 
-			if self.__port.read(1) != '\r':
-				raise RuntimeError('Writing Flash block failed! ' +
-				                   'Programmer did not return CR after B..F command')
-			avrlog.progress('.')
+		frame = bytearray(chr(0xff) * (byte_count + 4))
+		frame[0:4] = 'B%c%c%s' % ((byte_count >> 8) & 0xff, byte_count & 0xff, memory)
+		frame[4:4 + len(data)] = data
+		return frame
 
-		avrlog.progress('\n')
 
+	def _write_block(self, memory, data, byte_count):
+
+		if memory == 'F':
+			error = 'Writing Flash block failed!'
+		else:
+			error = 'Writing EEPROM block failed!'
+
+		self._command(self._block_frame(memory, data, byte_count), error)
+
+
+	def _command(self, command, error):
+		"""
+			Sends a command that the programmer acks with a CR. The
+			command is queued and the acks are checked, in order, once
+			the window is full or check_acks() is called, at once with a
+			pipeline depth of 1. A missing ack raises a RuntimeError
+			naming the command that failed, whatever the depth.
+		"""
+
+		self.__port.write(command)
+		self.__port.flush()
+		self.__sent += 1
+		address = self._track(command)
+
+		self.__pending.append((error, self.__sent, str(command[0:1]), address))
+		if len(self.__pending) >= self.__pipeline_depth:
+			self.check_acks(len(self.__pending) - self.__pipeline_depth + 1)
 		return True
 
 
+	def check_acks(self, count=-1):
+		"""
+			Reads the acks of the oldest count pipelined commands, or of
+			all of them when count is -1.
+		"""
+
+		if count == -1 or count > len(self.__pending):
+			count = len(self.__pending)
+		if count == 0:
+			return
+
+		acks = self.__port.read(count)
+		pending = self.__pending[:count]
+		del self.__pending[:count]
+
+		for i in range(0, count):
+			if i >= len(acks) or acks[i] != '\r':
+				error, number, command, address = pending[i]
+				if i >= len(acks):
+					reply = 'nothing'
+				else:
+					reply = '0x%02X' % ord(acks[i])
+				if address == -1:
+					where = 'address unknown'
+				else:
+					where = 'address 0x%X' % address
+				self.__pending = []
+				self.__pointer = -1
+				if hasattr(self.__port, 'flushInput'):
+					self.__port.flushInput()		# Drop acks of the commands behind it
+				raise RuntimeError('%s Programmer did not ack command #%d ' % (error, number) +
+				                   "('%s', %s), got %s." % (command, where, reply))
+
+
+	def _query(self, command, count):
+		"""
+			Sends a command and returns its count byte reply. Pending
+			acks are checked first so the reply is not mistaken for one.
+		"""
+
+		self.check_acks()
+		self.__port.write(command)
+		self.__port.flush()
+		self._track(command)
+		return self.__port.read(count)
+
+
+	def _read_block(self, memory, view, byte_count):
+		"""
+			Sends a g..F or g..E command and reads the response straight
+			into view. Bytes beyond the end of view are read and dropped.
+		"""
+
+		self.check_acks()
+		command = 'g%c%c%s' % ((byte_count >> 8) & 0xff, byte_count & 0xff, memory)
+		self.__port.write(command)
+		self.__port.flush()
+		self._track(command)
+
+		if hasattr(self.__port, 'readinto'):
+			count = self.__port.readinto(view)
+		else:
+			data = self.__port.read(len(view))
+			count = len(data)
+			view[0:count] = data
+
+		if byte_count > len(view):
+			count += len(self.__port.read(byte_count - len(view)))
+
+		if count != byte_count:
+			raise RuntimeError('Reading %s block failed! ' %
+			                   ('Flash' if memory == 'F' else 'EEPROM') +
+			                   'Programmer returned %d of %d bytes.' % (count, byte_count))
+
+
 	def read_flash(self, hex_file):
 
 		if self.__page_size == -1:
 			raise RuntimeError('Programmer page size is not set.')
 
-		self.__port.write('b')
-		self.__port.flush()
-
-		if self.__port.read(1) == 'Y':
+		self.probe()
+		if self.__block_size > 0:
 			avrlog.avrlog(avrlog.LOG_DEBUG, 'Read flash: using block mode...')
 			return self.read_flash_block(hex_file)
 
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+		for start, end in hex_file.get_segments():
+			hex_file.set_range(start, self._read_flash_bytes(start, end,
+			                                                 self.__auto_increment))
 
-		self.__port.write('a')
-		self.__port.flush()
+		avrlog.progress('\n')
+
+		return True
 
-		auto_increment = False
-		if self.__port.read(1) == 'Y':
-			auto_increment = True
+
+	def read_flash_block(self, hex_file):
+
+		block_size = self.get_block_size()
+
+		for start, end in hex_file.get_segments():
+			self._read_flash_blocks(hex_file, start, end, block_size)
+
+		avrlog.progress('\n')
+
+		return True
+
+
+	def _read_flash_bytes(self, start, end, auto_increment):
 
 		self.set_address(start >> 1)
 
+		data = bytearray(end - start + 1)
 		address = start
 		if address & 1:
-			self.__port.write('R')
-			self.__port.flush()
-
-			hex_file.set_data(address, self.__port.read(1))		# High byte
-			self.__port.read(1)									# Don't use low byte
+			word = self._query('R', 2)
+			data[address - start] = word[0]		# High byte, don't use low byte
 			address += 1
 
 		while (end - address + 1) >= 2:
 			if not auto_increment:
 				self.set_address(address >> 1)
 
-			self.__port.write('R')
-			self.__port.flush()
-
-			hex_file.set_data(address + 1, self.__port.read(1))
-			hex_file.set_data(address, self.__port.read(1))
+			word = self._query('R', 2)
+			data[address + 1 - start] = word[0]
+			data[address - start] = word[1]
 			address += 2
 			
 			if address % 256 == 0:
 				avrlog.progress('.')
 
 		if address == end:
-			self.__port.write('R')
-			self.__port.flush()
-
-			self.__port.read(1)
-			hex_file.set_data(address, self.__port.read(1))
-
-		avrlog.progress('\n')
+			if not auto_increment:
+				self.set_address(address >> 1)
+			word = self._query('R', 2)
+			data[address - start] = word[1]
 
+		return data
 
-	def read_flash_block(self, hex_file):
 
-		# Get block size assuming the 'b' command was just ack'ed with a 'Y'
-		block_size = (ord(self.__port.read(1)) << 8) | ord(self.__port.read(1))
-
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+	def _read_flash_blocks(self, hex_file, start, end, block_size):
 
 		address = start
 		if address & 1:
 			self.set_address(address >> 1)		# Flash operations use word addresses
 
-			self.__port.write('R')
-			self.__port.flush()
-
-			hex_file.set_data(address, self.__port.read(1))		# Save high byte
-			self.__port.read(1)									# Skip low byte
+			word = self._query('R', 2)
+			hex_file.set_data(address, word[0:1])		# Save high byte, skip low byte
 			address += 1
 
 		if (address % block_size) > 0:
@@ -418,105 +782,56 @@ class AVRBootloader:
 
 			if byte_count > 0:
 				self.set_address(address >> 1)
-
-				# Start Flash block read
-				self.__port.write('g')
-				self.__port.write(chr((byte_count >> 8) & 0xff))
-				self.__port.write(chr(byte_count & 0xff))
-				self.__port.write('F')
-
-				while byte_count > 0:
-					hex_file.set_data(address, self.__port.read(1))
-					address += 1
-					byte_count -= 1
-
+				self._read_block('F', hex_file.get_range(address, address + byte_count - 1),
+				                 byte_count)
+				address += byte_count
 				avrlog.progress('.')
 
 		while (end - address + 1) >= block_size:
-			byte_count = block_size
 
 			self.set_address(address >> 1)
-
-			# Start Flash block read
-			self.__port.write('g')
-			self.__port.write(chr((byte_count >> 8) & 0xff))
-			self.__port.write(chr(byte_count & 0xff))
-			self.__port.write('F')
-
-			while byte_count > 0:
-				hex_file.set_data(address, self.__port.read(1))
-				address += 1
-				byte_count -= 1
-
+			self._read_block('F', hex_file.get_range(address, address + block_size - 1),
+			                 block_size)
+			address += block_size
 			avrlog.progress('.')
 
 		if (end - address + 1) >= 1:
 			byte_count = (end - address + 1)
 			if byte_count & 1:
-				byte_count += 1
+				byte_count += 1				# Read a whole word, drop the pad byte
 
 			self.set_address(address >> 1)
-
-			# Start Flash block read
-			self.__port.write('g')
-			self.__port.write(chr((byte_count >> 8) & 0xff))
-			self.__port.write(chr(byte_count & 0xff))
-			self.__port.write('F')
-
-			while byte_count > 0:
-				if address > end:
-					self.__port.read(1)
-				else:
-					hex_file.set_data(address, self.__port.read(1))
-
-				address += 1
-				byte_count -= 1
-
+			self._read_block('F', hex_file.get_range(address, end), byte_count)
+			address += byte_count
 			avrlog.progress('.')
 
-		avrlog.progress('\n')
-
-		return True
-
 
 	def write_eeprom(self, hex_file):
 
-		self.__port.write('b')
-		self.__port.flush()
+		self.probe()
+		if self.__block_size > 0:
+			avrlog.avrlog(avrlog.LOG_DEBUG, 'Write EEPROM: using block mode...')
+			return self.write_eeprom_block(hex_file)
 
-		if self.__port.read(1) == 'Y':
-			avrlog.avrlog(avrlog.LOG_DEBUG, 'Write EEPROM using block mode...')
+		auto_increment = self.__auto_increment
+		for start, end in hex_file.get_segments():
 
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+			self.set_address(start)
 
-		self.__port.write('a')
-		self.__port.flush()
+			data = bytearray(hex_file.get_range(start, end))
+			address = start
+			while address <= end:
 
-		auto_increment = False
-		if self.__port.read(1) == 'Y':
-			auto_increment = True
+				if not auto_increment:
+					self.set_address(address)
 
-		self.set_address(start)
-
-		address = start
-		while address <= end:
-
-			if not auto_increment:
-				self.set_address(address)
-
-			self.__port.write('D')
-			self.__port.write(hex_file.get_data(address))
-			self.__port.flush()
+				self._command('D%c' % data[address - start], 'Writing byte to EEPROM failed!')
+				if address % 256 == 0:
+					avrlog.progress('.')
 
-			if self.__port.read(1) != '\r':
-				raise RuntimeError('Writing byte to EEPROM failed! ' +
-				                   'Programmer did not ack command.')
-			if address % 256 == 0:
-				avrlog.progress('.')
-
-			address += 1
+				address += 1
 
+		self.check_acks()
 		avrlog.progress('\n')
 
 		return True
@@ -524,38 +839,25 @@ class AVRBootloader:
 
 	def write_eeprom_block(self, hex_file):
 
-		# Get block size assuming the 'b' command was just ack'ed with a 'Y'
-		block_size = (self.__port.read(1) << 8) | self.__port.read(1)
-
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
-
-		address = start
-		while address <= end:
-			byte_count = block_size
-			if (address + byte_count - 1) > end:
-				byte_count = end - address + 1
-
-			self.set_address(address)
-
-			self.__port.write('B')
-			self.__port.write(chr((byte_count >> 8) & 0xff))
-			self.__port.write(chr(byte_count & 0xff))
-			self.__port.write('E')
+		block_size = self.get_block_size()
+		if block_size == 0:
+			raise RuntimeError('EEPROM block write is not supported by this programmer.')
 
-			while byte_count > 0:
-				self.__port.write(hex_file.get_data(address))
-				self.__port.flush()
-
-				address += 1
-				byte_count -= 1
+		for start, end in hex_file.get_segments():
 
-			if self.__port.read(1) != '\r':
-				raise RuntimeError('Writing EEPROM block failed! ' +
-				                   'Programmer did not ack B..E command.')
+			address = start
+			while address <= end:
+				byte_count = block_size
+				if (address + byte_count - 1) > end:
+					byte_count = end - address + 1
 
-			avrlog.progress('.')
+				self.set_address(address)
+				self._write_block('E', hex_file.get_range(address, address + byte_count - 1),
+				                  byte_count)
+				address += byte_count
+				avrlog.progress('.')
 
+		self.check_acks()
 		avrlog.progress('\n')
 
 		return True
@@ -563,87 +865,163 @@ class AVRBootloader:
 
 	def read_eeprom(self, hex_file):
 
-		self.__port.write('b')
-		self.__port.flush()
-
-		if self.__port.read(1) == 'Y':
+		self.probe()
+		if self.__block_size > 0:
 			avrlog.avrlog(avrlog.LOG_DEBUG, 'Read EEPROM: using block mode...')
 			return self.read_eeprom_block(hex_file)
 
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+		for start, end in hex_file.get_segments():
+			hex_file.set_range(start, self._read_eeprom_bytes(start, end,
+			                                                  self.__auto_increment))
+
+		avrlog.progress('\n')
+
+		return True
 
-		self.__port.write('a')
-		self.__port.flush()
 
-		auto_increment = False
-		if self.__port.read(1) == 'Y':
-			auto_increment = True
+	def _read_eeprom_bytes(self, start, end, auto_increment):
 
 		self.set_address(start)
 
+		data = bytearray(end - start + 1)
 		address = start
 		while address <= end:
 			if not auto_increment:
 				self.set_address(address)
 
-			self.__port.write('d')
-			self.__port.flush()
-
-			hex_file.set_data(address, self.__port.read(1))
+			data[address - start] = self._query('d', 1)
 
 			if address % 256 == 0:
 				avrlog.progress('.')
 
 			address += 1
 
+		return data
+
+
+	def read_eeprom_block(self, hex_file):
+
+		block_size = self.get_block_size()
+
+		for start, end in hex_file.get_segments():
+
+			address = start
+			while address <= end:
+				byte_count = block_size
+				if (address + byte_count - 1) > end:
+					byte_count = end - address + 1
+
+				self.set_address(address)
+				self._read_block('E', hex_file.get_range(address, address + byte_count - 1),
+				                 byte_count)
+				address += byte_count
+				avrlog.progress('.')
+
 		avrlog.progress('\n')
 
 		return True
 
 
-	def read_eeprom_block(self, hex_file):
+	def verify_flash(self, hex_file, fail_fast=True):
+		"""
+			Reads the flash back a block at a time and compares each block
+			with hex_file as it arrives. Returns the differing bytes as a
+			list of (start, end, count) tuples. With fail_fast, stops at
+			the first block that differs.
+		"""
 
-		# Get block size assuming the 'b' command was just ack'ed with a 'Y'
-		block_size = (ord(self.__port.read(1)) << 8) | ord(self.__port.read(1))
+		if self.__page_size == -1:
+			raise RuntimeError('Programmer page size is not set.')
 
-		start = hex_file.get_range_start()
-		end = hex_file.get_range_end()
+		return self._verify('F', hex_file, fail_fast)
 
-		address = start
-		while address <= end:
-			byte_count = block_size
-			if (address + byte_count - 1) > end:
-				byte_count = end - address + 1
 
-			self.set_address(address)
+	def verify_eeprom(self, hex_file, fail_fast=True):
+		"""
+			Like verify_flash, for the EEPROM.
+		"""
 
-			self.__port.write('g')
-			self.__port.write(chr((byte_count >> 8) & 0xff))
-			self.__port.write(chr(byte_count & 0xff))
-			self.__port.write('E')
+		return self._verify('E', hex_file, fail_fast)
 
-			while byte_count > 0:
-				hex_file.set_data(address, self.__port.read(1))
 
-				address += 1
-				byte_count -= 1
+	def _verify(self, memory, hex_file, fail_fast):
 
-			avrlog.progress('.')
+		self.probe()
+		block_size = self.__block_size
+		auto_increment = self.__auto_increment
+		chunk = block_size
+		if block_size == 0:
+			chunk = 256
+
+		buf = bytearray(chunk)
+		mismatches = []
+		for start, end in hex_file.get_segments():
+
+			address = start
+			if memory == 'F' and block_size > 0:
+				address &= ~1				# block reads start on a word
+
+			while address <= end:
+				last = min(address - address % chunk + chunk - 1, end)
+				data = self._read_chunk(memory, address, last, block_size,
+				                        auto_increment, buf)
+
+				first = max(address, start)
+				actual = data[first - address:].tobytes()
+				expected = hex_file.get_range(first, last).tobytes()
+				if actual != expected:
+					for r in hex_util.difference_ranges(expected, actual, first,
+					                                    hex_util.MISMATCH_GAP):
+						if len(mismatches) > 0 and \
+						   r[0] - mismatches[-1][1] <= hex_util.MISMATCH_GAP:
+							mismatches[-1] = (mismatches[-1][0], r[1],
+							                  mismatches[-1][2] + r[2])
+						else:
+							mismatches.append(r)
+
+					if fail_fast:
+						avrlog.progress('\n')
+						return mismatches
+
+				address = last + 1
+				if block_size > 0:
+					avrlog.progress('.')
 
 		avrlog.progress('\n')
+		return mismatches
 
-		return True
+
+	def _read_chunk(self, memory, address, end, block_size, auto_increment, buf):
+		"""
+			Reads the memory from address to end, inclusive, into buf and
+			returns a memoryview of it. Block mode flash reads must start
+			on an even address.
+		"""
+
+		count = end - address + 1
+		if block_size == 0:
+			if memory == 'F':
+				buf[0:count] = self._read_flash_bytes(address, end, auto_increment)
+			else:
+				buf[0:count] = self._read_eeprom_bytes(address, end, auto_increment)
+			return memoryview(buf)[0:count]
+
+		if memory == 'F':
+			self.set_address(address >> 1)
+			byte_count = count + (count & 1)		# whole words, drop the pad byte
+		else:
+			self.set_address(address)
+			byte_count = count
+
+		view = memoryview(buf)[0:count]
+		self._read_block(memory, view, byte_count)
+		return view
 
 
 	def write_lock_bits(self, value):
 
 		if type(value) == types.IntType and value < 0x100:
-			self.__port.write('l')
-			self.__port.write(chr(value & 0xff))
-			self.__port.flush()
-
-			bits = self.__port.read(1)
+			bits = self._query('l%c' % (value & 0xff), 1)
 
 			return(True, bits)
 		else:
@@ -654,10 +1032,7 @@ class AVRBootloader:
 
 	def read_lock_bits(self):
 
-		self.__port.write('r')
-		self.__port.flush()
-
-		bits = self.__port.read(1)
+		bits = self._query('r', 1)
 
 		return(True, ord(bits))
 
@@ -669,15 +1044,8 @@ class AVRBootloader:
 
 	def read_fuse_bits(self):
 
-		self.__port.write('N')
-		self.__port.flush()
-
-		highfuse = self.__port.read(1)
-
-		self.__port.write('F')
-		self.__port.flush()
-
-		lowfuse = self.__port.read(1)
+		highfuse = self._query('N', 1)
+		lowfuse = self._query('F', 1)
 
 		bits = (ord(highfuse) << 8) | ord(lowfuse)
 
@@ -692,22 +1060,18 @@ class AVRBootloader:
 	def read_extended_fuse_bits(self):
 
 		result = True
-		self.__port.write('Q')
-		self.__port.flush()
-
-		bits = self.__port.read(1)
+		bits = self._query('Q', 1)
 
 		return(True, ord(bits))
 
 
 	def programmer_software_version(self):
 
-		result = True
-		self.__port.write('V')
-		self.__port.flush()
-
-		major = self.__port.read(1)
-		minor = self.__port.read(1)
+		version = self.__software_version
+		if len(version) == 0:
+			version = self._query('V', 2)
+		major = version[0:1]
+		minor = version[1:2]
 
 		return(True, major, minor)
 
@@ -719,41 +1083,62 @@ class AVRBootloader:
 
 	def set_address(self, address):
 
-		result = True
+		if address == self.__pointer:
+			self.skipped_addresses += 1		# the device is already there
+			return True
+
 		if address < 0x10000:
-			self.__port.write('A')
-			self.__port.write(chr(((address >> 8) & 0xff)))
-			self.__port.write(chr(address & 0xff))
-			self.__port.flush()
+			command = 'A%c%c' % ((address >> 8) & 0xff, address & 0xff)
 		else:
-			self.__port.write('H')
-			self.__port.write(chr(((address >> 16) & 0xff)))
-			self.__port.write(chr(((address >> 8) & 0xff)))
-			self.__port.write(chr(address & 0xff))
-			self.__port.flush()
+			command = 'H%c%c%c' % ((address >> 16) & 0xff, (address >> 8) & 0xff,
+			                       address & 0xff)
 
-		if self.__port.read(1) != '\r':
-			result = False
-			avrlog.avrlog(avrlog.LOG_ERR, 'Setting address failed! ' +
-			              'Programmer did not ack.')
+		self._command(command, 'Setting address failed!')
+		self.__pointer = address
+		return True
 
-		return result
+
+	def _track(self, command):
+		"""
+			Follows the device address register through command. Word
+			and byte accesses advance it when autoincrement is on, block
+			accesses always do. It becomes unknown after any command not
+			known to leave it alone. Returns the address the command
+			acts on, the one it sets for A and H, or -1 if unknown.
+		"""
+
+		command = str(command[0:4])		# block frames are bytearrays
+		c = command[0]
+		address = self.__pointer
+		if c == 'A' and len(command) >= 3:
+			address = (ord(command[1]) << 8) | ord(command[2])
+		elif c == 'H' and len(command) >= 4:
+			address = (ord(command[1]) << 16) | (ord(command[2]) << 8) | ord(command[3])
+
+		if self.__pointer == -1 or c in 'AHcmsSVbatprNFQ\x1b':
+			return address
+
+		if c in 'CRdD':
+			if self.__block_size == -1:
+				self.__pointer = -1				# autoincrement not probed yet
+			elif self.__auto_increment:
+				self.__pointer += 1
+		elif c in 'Bg' and len(command) >= 4:
+			byte_count = (ord(command[1]) << 8) | ord(command[2])
+			if command[3] == 'F':
+				self.__pointer += byte_count >> 1
+			else:
+				self.__pointer += byte_count
+		else:
+			self.__pointer = -1
+		return address
 
 
 	def write_flash_low_byte(self, value):
 
 		if type(value) == types.IntType and value < 0x100:
-			result = True
-			self.__port.write('c')
-			self.__port.write(chr(value))
-			self.__port.flush()
-
-			if self.__port.read(1) != '\r':
-				result = False
-				avrlog.avrlog(avrlog.LOG_ERR, 'Write flash low byte failed! ' +
-				              'Programmer did not ack.')
-
-			return result
+			self._command('c%c' % value, 'Write flash low byte failed!')
+			return True
 		else:
 			raise RuntimeError('AVRBootloader.write_flash_low_byte received %s, ' %
 			                   str(type(value)) +
@@ -763,17 +1148,8 @@ class AVRBootloader:
 	def write_flash_high_byte(self, value):
 
 		if type(value) == types.IntType and value < 0x100:
-			result = True
-			self.__port.write('C')
-			self.__port.write(chr(value))
-			self.__port.flush()
-
-			if self.__port.read(1) != '\r':
-				result = False
-				avrlog.avrlog(avrlog.LOG_ERR, 'Write flash high byte failed! ' +
-				              'Programmer did not ack.')
-
-			return result
+			self._command('C%c' % value, 'Write flash high byte failed!')
+			return True
 		else:
 			raise RuntimeError('AVRBootloader.write_flash_high_byte received %s, ' %
 			                   str(type(value)) +
@@ -782,16 +1158,8 @@ class AVRBootloader:
 
 	def write_flash_page(self):
 
-		result = True
-		self.__port.write('m')
-		self.__port.flush()
-
-		if self.__port.read(1) != '\r':
-			result = False
-			avrlog.avrlog(avrlog.LOG_ERR,
-			              'Write flash page failed! Programmer did not ack.')
-
-		return result
+		self._command('m', 'Write flash page failed!')
+		return True
 
 
 	def instance(port=None):
@@ -802,7 +1170,76 @@ class AVRBootloader:
 	instance = staticmethod(instance)
 
 
+	def set_instance(prog):
+
+		AVRBootloader.__instance = prog
+	set_instance = staticmethod(set_instance)
+
 
 
 
 
+
+
+
+def _set_options(lines, section, values):
+	"""
+		Returns the lines of a ConfigParser file with the options in
+		values, (name, value) tuples, set in section. The section is
+		added if missing. All other lines, comments included, are kept.
+	"""
+
+	settings = dict(values)
+	missing = [name for name, value in values]
+	result = []
+	inside = False
+	last = -1						# index of the last line of the section
+
+	for line in lines + ['[]\n']:		# a sentinel header ends the last section
+		stripped = line.strip()
+		if stripped.startswith('['):
+			if inside:
+				result[last + 1:last + 1] = ['%s = %s\n' % (name, settings[name])
+				                             for name in missing]
+				missing = []
+			inside = stripped == '[%s]' % section
+			last = len(result)
+		elif inside and len(stripped) > 0 and stripped[0] not in '#;':
+			name = stripped.split('=')[0].split(':')[0].strip().lower()
+			if name in missing:
+				line = '%s = %s\n' % (name, settings[name])
+				missing.remove(name)
+			last = len(result)
+		result.append(line)
+
+	result.pop()
+	if len(missing) > 0:
+		if len(result) > 0:
+			if not result[-1].endswith('\n'):
+				result[-1] += '\n'
+			result.append('\n')
+		result.append('[%s]\n' % section)
+		result.extend(['%s = %s\n' % (name, settings[name]) for name in missing])
+	return result
+
+
+def _replace_file(file_name, data):
+	"""
+		Writes a file atomically, through a temporary file renamed over
+		it, so readers see either the old or the new contents.
+	"""
+
+	(fd, temp_name) = tempfile.mkstemp('.tmp', '', os.path.dirname(os.path.abspath(file_name)))
+	fp = os.fdopen(fd, 'w')
+	try:
+		fp.write(data)
+	finally:
+		fp.close()
+
+	try:
+		if os.name == 'nt' and os.path.exists(file_name):
+			os.remove(file_name)			# rename does not replace on Windows
+		os.rename(temp_name, file_name)
+	except OSError:
+		os.remove(temp_name)
+		raise
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+"""
+	avrsim.py
+	In-process AVR109 bootloader simulator.
+"""
+import os
+import sys
+import time
+import socket
+import getopt
+import threading
+import avrlog
+import avrdev
+
+try:
+	import tty
+except ImportError:
+	tty = None
+
+# commands that are only acked, or answered with a constant
+_SIMPLE_REPLIES = {
+	'P': '\r', 'L': '\r', 'E': '\r', 'x': '\r', 'y': '\r', 'T': '\r',
+	'p': 'S',
+}
+
+# number of argument bytes after the command character
+_ARGUMENTS = {
+	'A': 2, 'H': 3, 'c': 1, 'C': 1, 'D': 1, 'l': 1, 'T': 1, 'x': 1, 'y': 1,
+}
+
+
+class AVR109Simulator:
+	"""
+		AVR109Simulator class.
+		Answers AVR109 bootloader commands from memory as the reference
+		bootloader does. Flash is programmed through a page buffer and,
+		as on the device, programming can only clear bits; 'e' erases.
+		The simulator keeps a virtual clock of the time the traffic
+		would take: ten bit times per byte at baud, if baud is not 0,
+		plus latency seconds per command. With real_time it also sleeps
+		that long. If nak is not 0, the nak-th command acked with a CR
+		is answered with '?' instead, to test error handling.
+	"""
+	def __init__(self, flash_size=32768, eeprom_size=1024, page_size=128,
+	             block_size=128, auto_increment=True,
+	             signature=(0x1e, 0x95, 0x02), device_codes=(0x74,),
+	             baud=0, latency=0.0, real_time=False, nak=0):
+
+		self.flash = bytearray(chr(0xff) * flash_size)
+		self.eeprom = bytearray(chr(0xff) * eeprom_size)
+		self.page_size = page_size
+		self.block_size = block_size		# 0 for no block support
+		self.auto_increment = auto_increment
+		self.signature = signature
+		self.device_codes = device_codes
+		self.software_version = '10'
+		self.lock_bits = 0xff
+		self.fuse_bits = 0xffff
+		self.extended_fuse_bits = 0xff
+
+		self.baud = baud
+		self.latency = latency
+		self.real_time = real_time
+		self.elapsed = 0.0					# virtual seconds
+		self.commands = {}					# count per command character
+		self.nak = nak
+		self.acked = 0						# commands acked with a CR
+
+		self.__address = 0
+		self.__low_byte = 0xff
+		self.__page = bytearray(chr(0xff) * page_size)
+		self.__input = bytearray()
+		self.__output = bytearray()
+		self.__lock = threading.Lock()
+
+
+	def feed(self, data):
+		"""
+			Takes bytes sent by the programmer and answers every complete
+			command in them.
+		"""
+
+		self.__lock.acquire()
+		try:
+			self.__input.extend(data)
+			self.__spend(len(data), 0)
+			while self._process():
+				pass
+		finally:
+			self.__lock.release()
+
+
+	def take(self, count=-1):
+		"""
+			Returns up to count reply bytes, or all of them for -1.
+		"""
+
+		self.__lock.acquire()
+		try:
+			if count < 0 or count > len(self.__output):
+				count = len(self.__output)
+			data = str(self.__output[0:count])
+			del self.__output[0:count]
+			self.__spend(count, 0)
+			return data
+		finally:
+			self.__lock.release()
+
+
+	def pending(self):
+
+		return len(self.__output)
+
+
+	def serve(self, read, write):
+		"""
+			Answers commands read with read(size) and sends the replies
+			with write(data) until read returns nothing or fails.
+		"""
+
+		while True:
+			try:
+				data = read(4096)
+			except (OSError, IOError, socket.error):
+				break
+			if len(data) == 0:
+				break
+
+			self.feed(data)
+			reply = self.take()
+			if len(reply) > 0:
+				try:
+					write(reply)
+				except (OSError, IOError, socket.error):
+					break
+
+
+	def __spend(self, byte_count, command_count):
+
+		seconds = command_count * self.latency
+		if self.baud > 0:
+			seconds += byte_count * 10.0 / self.baud
+		self.elapsed += seconds
+		if self.real_time and seconds > 0:
+			time.sleep(seconds)
+
+
+	def _process(self):
+		"""
+			Answers the first command in the input, if it is complete.
+			Returns False when more input is needed.
+		"""
+
+		if len(self.__input) == 0:
+			return False
+
+		c = chr(self.__input[0])
+		length = 1 + _ARGUMENTS.get(c, 0)
+		if c in 'Bg':
+			if len(self.__input) < 4:
+				return False
+			length = 4
+			if c == 'B':
+				length += (self.__input[1] << 8) | self.__input[2]
+
+		if len(self.__input) < length:
+			return False
+
+		command = self.__input[0:length]
+		del self.__input[0:length]
+		self.commands[c] = self.commands.get(c, 0) + 1
+		self.__spend(0, 1)
+
+		reply = self._execute(c, command)
+		if reply == '\r':
+			self.acked += 1
+			if self.acked == self.nak:
+				reply = '?'
+		if reply != None:
+			self.__output.extend(reply)
+		return True
+
+
+	def _execute(self, c, command):
+
+		if c == '\x1b':					# sync, no reply
+			return None
+
+		if c in _SIMPLE_REPLIES:
+			return _SIMPLE_REPLIES[c]
+
+		if c == 'S':
+			return 'AVRBOOT'
+
+		if c == 'V':
+			return self.software_version
+
+		if c == 's':
+			return '%c%c%c' % (self.signature[2], self.signature[1], self.signature[0])
+
+		if c == 't':
+			return ''.join([chr(code) for code in self.device_codes]) + '\x00'
+
+		if c == 'a':
+			if self.auto_increment:
+				return 'Y'
+			return 'N'
+
+		if c == 'b':
+			if self.block_size > 0:
+				return 'Y%c%c' % ((self.block_size >> 8) & 0xff, self.block_size & 0xff)
+			return 'N'
+
+		if c == 'A':
+			self.__address = (command[1] << 8) | command[2]
+			return '\r'
+
+		if c == 'H':
+			self.__address = (command[1] << 16) | (command[2] << 8) | command[3]
+			return '\r'
+
+		if c == 'c':
+			self.__low_byte = command[1]
+			return '\r'
+
+		if c == 'C':
+			self._fill_word(self.__low_byte, command[1])
+			if self.auto_increment:
+				self.__address += 1
+			return '\r'
+
+		if c == 'm':
+			self._write_page(self.__address)
+			return '\r'
+
+		if c == 'R':
+			offset = (self.__address << 1) % len(self.flash)
+			word = '%c%c' % (self.flash[offset + 1], self.flash[offset])
+			if self.auto_increment:
+				self.__address += 1
+			return word
+
+		if c == 'e':
+			self.flash[:] = chr(0xff) * len(self.flash)
+			return '\r'
+
+		if c == 'D':
+			self.eeprom[self.__address % len(self.eeprom)] = command[1]
+			if self.auto_increment:
+				self.__address += 1
+			return '\r'
+
+		if c == 'd':
+			value = chr(self.eeprom[self.__address % len(self.eeprom)])
+			if self.auto_increment:
+				self.__address += 1
+			return value
+
+		if c == 'B':
+			return self._block_load(chr(command[3]), command[4:])
+
+		if c == 'g':
+			return self._block_read(chr(command[3]), (command[1] << 8) | command[2])
+
+		if c == 'l':
+			self.lock_bits = command[1]
+			return '\r'
+
+		if c == 'r':
+			return chr(self.lock_bits)
+
+		if c == 'N':
+			return chr(self.fuse_bits >> 8)
+
+		if c == 'F':
+			return chr(self.fuse_bits & 0xff)
+
+		if c == 'Q':
+			return chr(self.extended_fuse_bits)
+
+		return '?'
+
+
+	def _fill_word(self, low, high):
+
+		offset = (self.__address << 1) % self.page_size
+		self.__page[offset] = low
+		self.__page[offset + 1] = high
+
+
+	def _write_page(self, word_address):
+		"""
+			Programs the page buffer into the page holding word_address
+			and clears the buffer. Programming only clears bits.
+		"""
+
+		base = ((word_address << 1) % len(self.flash)) // self.page_size * self.page_size
+		for i in range(0, self.page_size):
+			self.flash[base + i] &= self.__page[i]
+		self.__page[:] = chr(0xff) * self.page_size
+
+
+	def _block_load(self, memory, data):
+
+		if memory == 'E':
+			for value in data:
+				self.eeprom[self.__address % len(self.eeprom)] = value
+				self.__address += 1
+			return '\r'
+
+		if memory != 'F' or self.block_size == 0:
+			return '?'
+
+		# the reference bootloader fills the page buffer a word at a time and
+		# programs the page once the block is loaded
+		page_address = self.__address
+		for i in range(0, len(data) - 1, 2):
+			if i > 0 and (self.__address << 1) % self.page_size == 0:
+				self._write_page(page_address)
+				page_address = self.__address
+			self._fill_word(data[i], data[i + 1])
+			self.__address += 1
+		self._write_page(page_address)
+		return '\r'
+
+
+	def _block_read(self, memory, byte_count):
+
+		if memory == 'E':
+			data = bytearray()
+			for i in range(0, byte_count):
+				data.append(self.eeprom[self.__address % len(self.eeprom)])
+				self.__address += 1
+			return data
+
+		if memory != 'F' or self.block_size == 0:
+			return '?'
+
+		offset = (self.__address << 1) % len(self.flash)
+		self.__address += byte_count >> 1
+		return self.flash[offset:offset + byte_count]
+
+
+def from_device(device, **options):
+	"""
+		Returns an AVR109Simulator with the flash, EEPROM and page sizes
+		and the signature of device, an AVRDevice with its parameters
+		read. Other options are passed to the simulator.
+	"""
+
+	if device.get_flash_size() <= 0 or device.get_eeprom_size() <= 0:
+		raise RuntimeError('No memory sizes for device %s.' % device.get_device_name())
+
+	sig0, sig1, sig2 = device.get_signature()
+	if sig0 >= 0 and sig1 >= 0 and sig2 >= 0:
+		options.setdefault('signature', (sig0, sig1, sig2))
+	if device.get_page_size() > 0:
+		options.setdefault('page_size', device.get_page_size())
+	options.setdefault('flash_size', device.get_flash_size())
+	options.setdefault('eeprom_size', device.get_eeprom_size())
+
+	return AVR109Simulator(**options)
+
+
+def serve_pty(sim):
+	"""
+		Runs sim on the master side of a new pseudo terminal in a
+		background thread and returns the name of the slave device.
+	"""
+
+	if tty == None:
+		raise RuntimeError('Pseudo terminals are not supported on this platform.')
+
+	master, slave = os.openpty()
+	tty.setraw(slave)
+
+	def write(data):
+		while len(data) > 0:
+			data = data[os.write(master, data):]
+
+	thread = threading.Thread(target=sim.serve, args=(lambda size: os.read(master, size), write))
+	thread.setDaemon(True)
+	thread.start()
+	return os.ttyname(slave)
+
+
+def serve_tcp(sim, port, host='localhost'):
+	"""
+		Answers one TCP connection at a time on host:port with sim, as
+		ser2net would with a real board. Does not return.
+	"""
+
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server.bind((host, port))
+	server.listen(1)
+	while True:
+		conn, peer = server.accept()
+		avrlog.avrlog(avrlog.LOG_INFO, 'Connection from %s:%d' % peer)
+		sim.serve(conn.recv, conn.sendall)
+		conn.close()
+
+
+def usage():
+
+	print 'avrsim.py [-d device] [-s search path] [-b baud] [-l latency (ms)] [-k block size] [-t tcp port]'
+	print 'Serves a simulated AVR109 bootloader on a pseudo terminal, or on a TCP port.'
+
+
+if __name__ == "__main__":
+
+	avrlog.openlog('avrsim')
+
+	device_name = ''
+	search_path = 'devices'
+	tcp_port = 0
+	options = {}
+	try:
+		optlist, args = getopt.getopt(sys.argv[1:], "d:s:b:l:k:t:h")
+		for (x, y) in optlist:
+			if x == '-d':
+				device_name = y
+			elif x == '-s':
+				search_path = y
+			elif x == '-b':
+				options['baud'] = int(y)
+				options['real_time'] = True
+			elif x == '-l':
+				options['latency'] = float(y) / 1000.0
+				options['real_time'] = True
+			elif x == '-k':
+				options['block_size'] = int(y, 0)
+			elif x == '-t':
+				tcp_port = int(y)
+			else:
+				usage()
+				sys.exit(1)
+	except getopt.GetoptError:
+		usage()
+		sys.exit(1)
+
+	if len(device_name) > 0:
+		device = avrdev.AVRDevice(device_name)
+		device.read_avr_parameters(search_path)
+		sim = from_device(device, **options)
+	else:
+		sim = AVR109Simulator(**options)
+
+	if tcp_port > 0:
+		serve_tcp(sim, tcp_port)
+	else:
+		print 'Serving on %s, press Ctrl-C to stop.' % serve_pty(sim)
+		try:
+			while True:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			pass
@@ -0,0 +1,366 @@
+"""
+	avrtransport.py
+	Links between the programmer and the bootloader: serial ports,
+	TCP (ser2net style), pseudo terminals and an in-memory simulator.
+"""
+import os
+import time
+import errno
+import select
+import socket
+import avrlog
+import avrdev
+import avrsim
+
+try:
+	import serial
+except ImportError:
+	serial = None
+
+try:
+	import termios
+	import tty
+except ImportError:
+	termios = None
+
+
+class Transport:
+	"""
+		Transport class.
+		The port interface AVRBootloader uses, a subset of pyserial:
+		read returns at most count bytes, fewer once the timeout passes.
+	"""
+	def __init__(self, timeout):
+
+		self.timeout = timeout
+
+
+	def read(self, count):
+
+		raise RuntimeError('Transport.read() is not implemented.')
+
+
+	def readinto(self, view):
+
+		data = self.read(len(view))
+		view[0:len(data)] = data
+		return len(data)
+
+
+	def read_available(self, count):
+		"""
+			Returns at most count bytes that can be read without waiting.
+		"""
+
+		raise RuntimeError('Transport.read_available() is not implemented.')
+
+
+	def fileno(self):
+		"""
+			Returns the descriptor to select() on before read_available,
+			or None if data, when there is any, is always available.
+		"""
+
+		return None
+
+
+	def write(self, data):
+
+		raise RuntimeError('Transport.write() is not implemented.')
+
+
+	def flush(self):
+
+		pass
+
+
+	def flushInput(self):
+
+		pass
+
+
+	def close(self):
+
+		pass
+
+
+class SerialTransport(Transport):
+	"""
+		SerialTransport class.
+		A serial port opened with pyserial.
+	"""
+	def __init__(self, name, baud, timeout):
+
+		Transport.__init__(self, timeout)
+		if serial == None:
+			raise RuntimeError('The pyserial module is needed for serial port %s.' % name)
+		self.__port = serial.Serial(port=name, baudrate=baud,
+		                            timeout=timeout, writeTimeout=timeout)
+
+
+	def read(self, count):
+
+		return self.__port.read(count)
+
+
+	def readinto(self, view):
+
+		if hasattr(self.__port, 'readinto'):
+			return self.__port.readinto(view)
+		return Transport.readinto(self, view)
+
+
+	def read_available(self, count):
+
+		waiting = self.__port.inWaiting()
+		if waiting == 0:
+			return ''
+		return self.__port.read(min(waiting, count))
+
+
+	def fileno(self):
+
+		return self.__port.fileno()
+
+
+	def write(self, data):
+
+		return self.__port.write(data)
+
+
+	def flush(self):
+
+		self.__port.flush()
+
+
+	def flushInput(self):
+
+		self.__port.flushInput()
+
+
+	def close(self):
+
+		self.__port.close()
+
+
+class _DescriptorTransport(Transport):
+	"""
+		Reads with a timeout from a file descriptor or socket that
+		select() accepts.
+	"""
+
+	def _wait(self, deadline):
+
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			return False
+		readable, writable, failed = select.select([self._fileno()], [], [], remaining)
+		return len(readable) > 0
+
+
+	def read(self, count):
+
+		deadline = time.time() + self.timeout
+		data = ''
+		while len(data) < count and self._wait(deadline):
+			chunk = self._receive(count - len(data))
+			if len(chunk) == 0:
+				break					# closed by the other side
+			data += chunk
+		return data
+
+
+	def read_available(self, count):
+
+		readable, writable, failed = select.select([self._fileno()], [], [], 0)
+		if len(readable) == 0:
+			return ''
+		return self._receive(count)
+
+
+	def fileno(self):
+
+		return self._fileno()
+
+
+	def flushInput(self):
+
+		while self._wait(time.time() + 0.01):
+			if len(self._receive(4096)) == 0:
+				break
+
+
+class TcpTransport(_DescriptorTransport):
+	"""
+		TcpTransport class.
+		A raw TCP connection to a serial port server such as ser2net.
+	"""
+	def __init__(self, host, port, timeout):
+
+		Transport.__init__(self, timeout)
+		try:
+			self.__socket = socket.create_connection((host, port), timeout)
+		except socket.error, exc:
+			raise RuntimeError('Cannot connect to %s:%d (%s).' % (host, port, exc))
+		self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+	def _fileno(self):
+
+		return self.__socket.fileno()
+
+
+	def _receive(self, count):
+
+		return self.__socket.recv(count)
+
+
+	def write(self, data):
+
+		self.__socket.sendall(str(data))
+		return len(data)
+
+
+	def close(self):
+
+		self.__socket.close()
+
+
+class PtyTransport(_DescriptorTransport):
+	"""
+		PtyTransport class.
+		A terminal device, such as the slave side of a pseudo terminal,
+		used in raw mode without pyserial.
+	"""
+	def __init__(self, name, timeout):
+
+		Transport.__init__(self, timeout)
+		if termios == None:
+			raise RuntimeError('Terminal devices are not supported on this platform.')
+		try:
+			self.__fd = os.open(name, os.O_RDWR | os.O_NOCTTY)
+		except OSError, exc:
+			raise RuntimeError('Cannot open %s (%s).' % (name, exc.strerror))
+		tty.setraw(self.__fd)
+
+
+	def _fileno(self):
+
+		return self.__fd
+
+
+	def _receive(self, count):
+
+		try:
+			return os.read(self.__fd, count)
+		except OSError, exc:
+			if exc.errno == errno.EIO:		# the master side was closed
+				return ''
+			raise
+
+
+	def write(self, data):
+
+		data = str(data)
+		while len(data) > 0:
+			data = data[os.write(self.__fd, data):]
+
+
+	def close(self):
+
+		os.close(self.__fd)
+
+
+class MemoryTransport(Transport):
+	"""
+		MemoryTransport class.
+		Connects straight to an AVR109Simulator in the same process.
+	"""
+	def __init__(self, sim, timeout=0.0):
+
+		Transport.__init__(self, timeout)
+		self.sim = sim
+
+
+	def read(self, count):
+
+		data = self.sim.take(count)
+		if len(data) < count:
+			self.sim.elapsed += self.timeout	# a real port would wait this long
+		return data
+
+
+	def read_available(self, count):
+
+		return self.sim.take(count)
+
+
+	def write(self, data):
+
+		self.sim.feed(data)
+		return len(data)
+
+
+	def flushInput(self):
+
+		self.sim.take()
+
+
+def _parse_options(text):
+
+	options = {}
+	for item in text.split('&'):
+		if len(item) == 0:
+			continue
+		key, sep, value = item.partition('=')
+		if key in ('baud', 'block_size', 'flash_size', 'eeprom_size', 'page_size', 'nak'):
+			options[key] = int(value, 0)
+		elif key == 'latency':
+			options[key] = float(value) / 1000.0
+		elif key in ('real_time', 'auto_increment'):
+			options[key] = value in ('1', 'yes', 'true')
+		else:
+			raise RuntimeError('Unknown simulator option %s.' % key)
+	return options
+
+
+def open_transport(name, baud, timeout, device_name='', search_path=''):
+	"""
+		Opens the transport named by name:
+		  tcp://host:port or socket://host:port   TCP connection
+		  pty:/dev/pts/N                          terminal device
+		  sim:[device][?option=value&...]          in-memory simulator
+		  anything else                           serial port
+		The simulator takes its memory sizes from the AVRDevice named
+		in the URL, or from device_name. Its options are baud,
+		latency (ms), block_size, auto_increment, real_time, nak and
+		the memory sizes flash_size, eeprom_size and page_size, which
+		override those of the device.
+	"""
+
+	if name.startswith('tcp://') or name.startswith('socket://'):
+		host, sep, port = name.split('://', 1)[1].rpartition(':')
+		if len(sep) == 0 or not port.isdigit():
+			raise RuntimeError('TCP transport needs host:port, got %s.' % name)
+		return TcpTransport(host, int(port), timeout)
+
+	if name.startswith('pty:'):
+		return PtyTransport(name[4:], timeout)
+
+	if name.startswith('sim:'):
+		device, sep, text = name[4:].partition('?')
+		options = _parse_options(text)
+		if len(device) == 0:
+			device = device_name
+
+		if len(device) > 0:
+			dev = avrdev.AVRDevice(device)
+			dev.read_avr_parameters(search_path)
+			sim = avrsim.from_device(dev, **options)
+		else:
+			sim = avrsim.AVR109Simulator(**options)
+
+		avrlog.avrlog(avrlog.LOG_DEBUG, 'Using simulated bootloader for %s.' % device)
+		return MemoryTransport(sim, timeout)
+
+	return SerialTransport(name, baud, timeout)
@@ -0,0 +1,93 @@
+"""
+	elf_util.py
+	AVR ELF file reader.
+"""
+import os
+import mmap
+import struct
+
+EM_AVR = 83
+
+PT_LOAD = 1
+SHT_PROGBITS = 1
+SHF_ALLOC = 0x2
+
+# AVR toolchains place data memory, EEPROM, fuses etc. at these offsets
+# in the ELF address space. Flash starts at 0.
+DATA_OFFSET = 0x800000
+EEPROM_OFFSET = 0x810000
+EEPROM_END = 0x820000
+
+
+def read_elf_records(file_name, eeprom=False):
+	"""
+		Returns the flash contents of an AVR ELF file, or the EEPROM
+		contents if eeprom is True, as a list of (address, data) tuples.
+		Flash sections such as .text and .data are placed at their load
+		addresses, .eeprom is moved down from 0x810000 to 0.
+		Sections are read from a memory map of the file.
+	"""
+
+	fp = open(file_name, 'rb')
+	try:
+		if os.fstat(fp.fileno()).st_size < 52:
+			raise RuntimeError('Not an ELF file (%s).' % file_name)
+
+		mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return _read_sections(mm, eeprom, file_name)
+		finally:
+			mm.close()
+	finally:
+		fp.close()
+
+
+def _read_sections(mm, eeprom, file_name):
+
+	if mm[0:4] != '\x7fELF':
+		raise RuntimeError('Not an ELF file (%s).' % file_name)
+
+	# 32-bit little endian files only
+	if mm[4] != '\x01' or mm[5] != '\x01':
+		raise RuntimeError('Unsupported ELF file, must be 32-bit little endian.')
+
+	(e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags,
+	 e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum,
+	 e_shstrndx) = struct.unpack_from('<HHIIIIIHHHHHH', mm, 16)
+
+	if e_machine != EM_AVR:
+		raise RuntimeError('ELF file is not built for AVR (machine %d).' % e_machine)
+
+	segments = []
+	for i in range(0, e_phnum):
+		(p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags,
+		 p_align) = struct.unpack_from('<IIIIIIII', mm, e_phoff + i * e_phentsize)
+		if p_type == PT_LOAD:
+			segments.append((p_offset, p_filesz, p_paddr))
+
+	records = []
+	for i in range(0, e_shnum):
+		(sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link,
+		 sh_info, sh_addralign, sh_entsize) = \
+			struct.unpack_from('<IIIIIIIIII', mm, e_shoff + i * e_shentsize)
+
+		if sh_type != SHT_PROGBITS or not sh_flags & SHF_ALLOC or sh_size == 0:
+			continue
+
+		# .data is linked to RAM but loaded from flash, use the load address
+		address = sh_addr
+		for p_offset, p_filesz, p_paddr in segments:
+			if p_offset <= sh_offset and sh_offset + sh_size <= p_offset + p_filesz:
+				address = p_paddr + sh_offset - p_offset
+				break
+
+		if sh_offset + sh_size > len(mm):
+			raise RuntimeError('ELF section extends past the end of the file.')
+
+		if eeprom and EEPROM_OFFSET <= address < EEPROM_END:
+			records.append((address - EEPROM_OFFSET, mm[sh_offset:sh_offset + sh_size]))
+		elif not eeprom and address < DATA_OFFSET:
+			records.append((address, mm[sh_offset:sh_offset + sh_size]))
+
+	records.sort()
+	return records
@@ -0,0 +1,209 @@
+"""
+	hex_cache.py
+	On-disk cache of parsed hex files.
+"""
+import os
+import glob
+import struct
+import hashlib
+import tempfile
+import avrlog
+
+CACHE_MAGIC = 'AVRC'
+CACHE_VERSION = 1
+
+class HexCache:
+	"""
+		HexCache class.
+		Keeps the data records of parsed hex files in a directory, keyed
+		by the SHA-1 of the file contents. An index entry per source path
+		holds its mtime, size and hash, so unchanged files are found
+		without being read. Images are stored as binary records with the
+		used range. The least recently used images are removed when the
+		cache grows beyond max_size bytes.
+	"""
+	def __init__(self, path, max_size=64 * 1024 * 1024):
+
+		self.__path = path
+		self.__max_size = max_size
+		self.hits = 0
+		self.misses = 0
+
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+
+	def get_path(self):
+
+		return self.__path
+
+
+	def get_max_size(self):
+
+		return self.__max_size
+
+
+	def load(self, file_name, kind='ihex'):
+		"""
+			Returns the cached records of file_name as a list of
+			(address, data) tuples, or None if it is not cached.
+		"""
+
+		try:
+			digest = self.__lookup(file_name, kind)
+			image_name = os.path.join(self.__path, digest + '.img')
+			if not os.path.exists(image_name):
+				self.misses += 1
+				return None
+
+			fp = open(image_name, 'rb')
+			image = fp.read()
+			fp.close()
+
+			records = self.__unpack(image)
+			os.utime(image_name, None)		# mark as recently used
+		except (IOError, OSError, struct.error, ValueError), exc:
+			avrlog.avrlog(avrlog.LOG_DEBUG, 'Hex cache read failed: %s' % exc)
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return records
+
+
+	def store(self, file_name, records, kind='ihex'):
+		"""
+			Stores the parsed records of file_name.
+		"""
+
+		try:
+			digest = self.__lookup(file_name, kind)
+			self.__write(os.path.join(self.__path, digest + '.img'),
+			             self.__pack(records))
+			self.__evict()
+		except (IOError, OSError), exc:
+			avrlog.avrlog(avrlog.LOG_DEBUG, 'Hex cache write failed: %s' % exc)
+
+
+	def __lookup(self, file_name, kind):
+		"""
+			Returns the content key of file_name. The file is only hashed
+			if its mtime or size differ from the index entry.
+		"""
+
+		file_name = os.path.abspath(file_name)
+		st = os.stat(file_name)
+		stamp = '%s %d %d' % (kind, int(st.st_mtime * 1000), st.st_size)
+
+		index_name = os.path.join(self.__path,
+		                          hashlib.sha1(file_name).hexdigest() + '.idx')
+		try:
+			fp = open(index_name, 'r')
+			entry = fp.read().split('\n')
+			fp.close()
+			if len(entry) >= 2 and entry[0] == stamp:
+				return entry[1]
+		except IOError:
+			pass
+
+		sha = hashlib.sha1(kind)
+		fp = open(file_name, 'rb')
+		while True:
+			chunk = fp.read(1 << 20)
+			if len(chunk) == 0:
+				break
+			sha.update(chunk)
+		fp.close()
+
+		digest = sha.hexdigest()
+		self.__write(index_name, '%s\n%s\n' % (stamp, digest))
+		return digest
+
+
+	def __pack(self, records):
+
+		start = -1
+		end = -1
+		if len(records) > 0:
+			start = min([address for address, data in records])
+			end = max([address + len(data) - 1 for address, data in records])
+
+		parts = [struct.pack('<4sHIii', CACHE_MAGIC, CACHE_VERSION, len(records),
+		                     start, end)]
+		for address, data in records:
+			parts.append(struct.pack('<II', address, len(data)))
+			parts.append(str(data))
+		return ''.join(parts)
+
+
+	def __unpack(self, image):
+
+		(magic, version, count, start, end) = struct.unpack_from('<4sHIii', image, 0)
+		if magic != CACHE_MAGIC or version != CACHE_VERSION:
+			raise ValueError('unknown cache image format')
+
+		records = []
+		offset = struct.calcsize('<4sHIii')
+		for i in range(0, count):
+			(address, length) = struct.unpack_from('<II', image, offset)
+			offset += 8
+			if offset + length > len(image):
+				raise ValueError('truncated cache image')
+			records.append((address, image[offset:offset + length]))
+			offset += length
+
+		# the used range guards against a damaged record table
+		if len(records) > 0 and \
+		   (start != min([address for address, data in records]) or
+		    end != max([address + len(data) - 1 for address, data in records])):
+			raise ValueError('cache image range mismatch')
+
+		return records
+
+
+	def __write(self, file_name, data):
+		"""
+			Writes a cache file atomically, so concurrent loaders never
+			see a partial file.
+		"""
+
+		(fd, temp_name) = tempfile.mkstemp('.tmp', '', self.__path)
+		fp = os.fdopen(fd, 'wb')
+		try:
+			fp.write(data)
+		finally:
+			fp.close()
+
+		try:
+			if os.name == 'nt' and os.path.exists(file_name):
+				os.remove(file_name)			# rename does not replace on Windows
+			os.rename(temp_name, file_name)
+		except OSError:
+			os.remove(temp_name)
+			raise
+
+
+	def __evict(self):
+		"""
+			Removes the least recently used images until the cache fits
+			in max_size bytes.
+		"""
+
+		images = []
+		total = 0
+		for image_name in glob.glob(os.path.join(self.__path, '*.img')):
+			try:
+				st = os.stat(image_name)
+			except OSError:
+				continue
+			images.append((st.st_mtime, st.st_size, image_name))
+			total += st.st_size
+
+		images.sort()
+		while total > self.__max_size and len(images) > 0:
+			(mtime, size, image_name) = images.pop(0)
+			try:
+				os.remove(image_name)
+			except OSError:
+				pass
+			total -= size
@@ -5,8 +5,25 @@
 import binascii
 import bisect
 import avrlog
+import elf_util
+import xtea
 import types
 import array
+import struct
+import os
+import mmap
+import collections
+import multiprocessing
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+ENCRYPTION_KEY = 0xffff			# default key of encrypted hex files
+PARALLEL_MIN_SIZE = 0x400000	# hex files this large are parsed in parallel
+COMPARE_WINDOW = 0x10000		# bytes compared at a time by find_first_difference
+MISMATCH_GAP = 16				# mismatches closer than this share one range
 
 class HexRecord():
 	"""
@@ -124,12 +141,9 @@ class HexRecord():
 			raise RuntimeError('Incorrect Hex file format, invalid data. ' +
 			                   'Line from file (%s)' % (hex_line.strip()))
 
-		bdata = binascii.a2b_hex(adata)
-		j = 0
-		for b in bdata:
-			checksum += ord(b)
-			self._data[j] = b
-			j += 1
+		bdata = bytearray(binascii.a2b_hex(adata))
+		checksum += sum(bdata)
+		self._data[0:len(bdata)] = bdata
 
 		checksum += int(hex_line[-2:], 16)
 		checksum &= 0xff
@@ -145,8 +159,7 @@ class HexRecord():
 
 		result = ''
 
-		if self._checksum == -1:
-			self.checksum()
+		self.checksum()			# The record may have been reused since it was computed
 
 		result = ':%02X%04X%02X' % (self._length, self._offset, self._type)
 
@@ -161,13 +174,15 @@ class EncryptedHexRecord(HexRecord):
 	"""
 		EncryptedHexRecord class.
 		Represents a line, or hex record, of a hex file in encrypted form.
+		Every field is stored as a 16-bit word and the words are
+		enciphered in pairs: (length, offset), (type, 0xff), the data
+		bytes two at a time padded with 0xff, and (checksum, 0xff).
 	"""
 
-	def __init__(self):
+	def __init__(self, key=ENCRYPTION_KEY):
 		HexRecord.__init__(self)
 
-		raise RuntimeError('Encrypted Hex file not implemented.')
-		import xtea
+		self.__key = key
 
 
 	def from_record(self, hex_rec):
@@ -175,103 +190,530 @@ class EncryptedHexRecord(HexRecord):
 		self._length = hex_rec.get_length()
 		self._offset = hex_rec.get_offset()
 		self._type = hex_rec.get_type()
-		self._data = hex_rec.get_data()
+		self._data = bytearray(hex_rec.get_data())
 		self._checksum = -1
 
 
 	def from_string(self, hex_line):
 
-		if len(hex_line) < 11:
-			raise RuntimeError('Incorrect Hex file format, missing fields. ' +
-			                   'Line from file (%s)' % (hex_line.strip()))
+		records = _decode_encrypted_lines([hex_line.strip()], self.__key, True)
+		(self._type, self._offset, data) = records[0]
+		self._length = len(data)
+		self._data = bytearray(data)
+		self._checksum = -1
 
-		if hex_line[0] != ':':
-			raise RuntimeError('Incorrect Hex file format, does not start with a colon. ' +
-			                   'Line from file (%s)' % (hex_line.strip()))
 
-		length = long(hex_line[1:5], 16)
-		offset = long(hex_line[5:9], 16)
-		v = [length, offset]
-		self._length, self._offset = xtea.decipher(v, 0xffffL)
+	def __str__(self):
+		"""
+			Returns an encrypted hex file line string.
+		"""
 
-		rtype = long(hex_line[9:13], 16)
-		tmp = long(hex_line[13:17], 16)
-		v = [rtype, tmp]
-		self._type, tmp = xtea.decipher(v, 0xffffL)
+		return _format_encrypted_records([(self._type, self._offset,
+		                                   self._data[0:self._length])],
+		                                 self.__key)[0]
 
-		if len(hex_line) < (self._length * 4 + 25):
-			raise RuntimeError('Incorrect Hex file format, missing field. ' +
-			                   'Line from file (%s)' % (hex_line.strip()))
 
-		adata = hex_line[17:-8]
+_cache = None
 
-		if len(adata) % 8 != 0:
-			raise RuntimeError('Incorrect Hex file format, invalid data. ' +
-			                   'Line from file (%s)' % (hex_line.strip()))
+def set_cache(cache):
+	"""
+		Sets the hex_cache.HexCache used by HexFile.read_file, or None
+		to parse every file.
+	"""
+	global _cache
+	_cache = cache
 
-		j = 0
-		for i in range(0, len(adata), 8):
-			pair = adata[i:i+8]
 
-			d1 = long(pair[0:4], 16)
-			d2 = long(pair[4:8], 16)
+def get_cache():
 
-			v = [d1, d2]
+	return _cache
 
-			l0, l1 = xtea.decipher(v, 0xffffL)
-			self._data[j] = chr(l0 & 0xff)
-			j += 1
-			if j < self._length:
-				self._data[j] = chr(l1 & 0xff)
-				j += 1
 
-		chk = hex_line.strip()[-8:]
-		d1 = long(chk[0:4], 16)
-		d2 = long(chk[4:8], 16)
-		v = [d1, d2]
-		v0, tmp = xtea.decipher(v, 0xffffL)
+def needs_erase(new, old):
+	"""
+		Tells if programming the bytes new over old has to set a bit,
+		which takes an erase. The whole run is compared at once, with
+		numpy when it is available: it can be programmed if new is the
+		bitwise and of new and old.
+	"""
 
-		checksum = v0 & 0xff
+	if len(new) == 0:
+		return False
+	if numpy != None:
+		return bool((numpy.frombuffer(new, dtype=numpy.uint8) &
+		             ~numpy.frombuffer(old, dtype=numpy.uint8)).any())
+	value = long(binascii.hexlify(new), 16)
+	return value & long(binascii.hexlify(old), 16) != value
 
-		if checksum != self.checksum():
-			raise RuntimeError('Incorrect Hex file format, invalid checksum. ' +
-			                   'Line from file (%s)' % (hex_line.strip()))
 
+def _decode_lines(lines):
+	"""
+		Decodes stripped Intel HEX lines with one a2b_hex call and checks
+		all record lengths and checksums in one pass, using numpy when it
+		is available. Returns the data records as (address, data) tuples
+		with consecutive records joined, or None if any line up to the
+		EOF record is malformed or no EOF record is found.
+	"""
 
-	def __str__(self):
-		"""
-			Returns an encrypted hex file line string.
-		"""
+	result = _decode_chunk_lines(lines, 0)
+	if result == None or not result[2]:
+		return None
+	return result[0]
 
-		result = ''
 
-		if self._checksum == -1:
-			checksum = self.checksum()
+def _decode_chunk_lines(lines, base_address):
+	"""
+		Decodes a run of lines like _decode_lines, starting with the
+		given base address. Returns (records, base_address, eof) with the
+		base address in effect after the last line and whether an EOF
+		record ended the run, or None if a line is malformed.
+	"""
+
+	sizes = [len(line) for line in lines]
+	if len(lines) == 0 or min(sizes) < 11 or \
+	   [line[0:1] for line in lines].count(':') != len(lines):
+		return None
+
+	sizes = [(size - 1) >> 1 for size in sizes]
+	try:
+		blob = binascii.a2b_hex(''.join(lines).replace(':', ''))
+	except (TypeError, ValueError):
+		return None
+
+	if len(blob) != sum(sizes):
+		return None						# A line with an odd number of digits
+
+	# record start offsets in blob
+	starts = [0] * len(sizes)
+	for i in range(1, len(sizes)):
+		starts[i] = starts[i - 1] + sizes[i - 1]
+
+	if numpy != None:
+		data = numpy.frombuffer(blob, dtype=numpy.uint8)
+		offsets = numpy.array(starts, dtype=numpy.intp)
+		if not numpy.array_equal(data[offsets].astype(numpy.intp) + 5, sizes):
+			return None
+		sums = numpy.add.reduceat(data, offsets, dtype=numpy.uint32)
+		bad = numpy.flatnonzero(sums & 0xff)
+		first_bad = len(lines)
+		if len(bad) > 0:
+			first_bad = int(bad[0])
+	else:
+		first_bad = len(lines)
+		for i in range(0, len(lines)):
+			record = bytearray(blob[starts[i]:starts[i] + sizes[i]])
+			if record[0] + 5 != sizes[i]:
+				return None
+			if sum(record) & 0xff:
+				first_bad = i
+				break
+
+	records = []
+	pieces = []
+	first_address = -1
+	next_address = -1
+	for i in range(0, len(lines)):
+
+		start = starts[i]
+		length = ord(blob[start])
+		rec_type = ord(blob[start + 3])
+
+		if i % 256 == 0:
+			avrlog.progress('.')
+
+		if i >= first_bad:
+			return None
+		elif rec_type == 0x00:
+			address = base_address + (ord(blob[start + 1]) << 8) + ord(blob[start + 2])
+			if address != next_address:
+				if len(pieces) > 0:
+					records.append((first_address, ''.join(pieces)))
+				first_address = address
+				pieces = []
+			pieces.append(blob[start + 4:start + 4 + length])
+			next_address = address + length
+		elif rec_type == 0x01:
+			if len(pieces) > 0:
+				records.append((first_address, ''.join(pieces)))
+			return (records, base_address, True)
+		elif rec_type == 0x02 or rec_type == 0x04:
+			if length != 2:
+				return None
+			base_address = (ord(blob[start + 4]) << 8) | ord(blob[start + 5])
+			if rec_type == 0x02:
+				base_address <<= 4
+			else:
+				base_address <<= 16
+		elif rec_type != 0x03 and rec_type != 0x05:
+			return None
+
+	if len(pieces) > 0:
+		records.append((first_address, ''.join(pieces)))
+	return (records, base_address, False)
+
+
+def _decode_chunk(job):
+	"""
+		Process pool worker. Decodes the lines between two byte offsets
+		of a hex file. Data records before the first address record of
+		the chunk get offsets only, as the base address in effect there
+		is not known yet. Returns (head, tail, base_address, eof), where
+		base_address is None if the chunk holds no address record, or
+		None if a line is malformed.
+	"""
+
+	(file_name, start, end) = job
+	avrlog.set_progress(False)
+
+	fp = open(file_name, 'rb')
+	fp.seek(start)
+	lines = [line.strip() for line in fp.read(end - start).splitlines()]
+	fp.close()
+
+	split = len(lines)
+	for i in range(0, len(lines)):
+		if lines[i][7:9] == '02' or lines[i][7:9] == '04':
+			split = i
+			break
+
+	head = ([], 0, False)
+	if split > 0:
+		head = _decode_chunk_lines(lines[:split], 0)
+		if head == None:
+			return None
+		if head[2] or split == len(lines):
+			return (head[0], [], None, head[2])
+
+	tail = _decode_chunk_lines(lines[split:], 0)
+	if tail == None:
+		return None
+	return (head[0], tail[0], tail[1], tail[2])
+
+
+def _index_lines_numpy(text, size):
+	"""
+		Indexes the data records of a mapped hex file with numpy, reading
+		only the record headers. Returns (addresses, lengths, offsets) as
+		arrays in file order up to the EOF record, or None if any line
+		before it is malformed, so the caller can report the error.
+	"""
+
+	chars = numpy.frombuffer(text, dtype=numpy.uint8)
+	starts = numpy.concatenate(([0], numpy.flatnonzero(chars == 0x0a) + 1))
+	ends = numpy.concatenate((starts[1:] - 1, [size]))
+	keep = starts < size
+	starts = starts[keep]
+	ends = ends[keep]
+	if len(starts) == 0 or numpy.any(ends - starts < 11) or \
+	   numpy.any(chars[starts] != ord(':')):
+		return None
+
+	# hex digits to nibbles, 0xff for anything else
+	nibbles = numpy.zeros(256, dtype=numpy.uint8) + 0xff
+	for digit in '0123456789abcdefABCDEF':
+		nibbles[ord(digit)] = int(digit, 16)
+
+	# digits 9-12 hold the value of address records, clip them for shorter lines
+	digits = nibbles[chars[numpy.minimum(starts[:, None] + numpy.arange(1, 13), size - 1)]]
+	header = digits[:, 0:8:2].astype(numpy.uint32) * 16 + digits[:, 1:8:2]
+	if numpy.any(digits[:, 0:8] == 0xff):
+		return None
+
+	lengths = header[:, 0]
+	types = header[:, 3]
+	eof = numpy.flatnonzero(types == 0x01)
+	if len(eof) == 0:
+		return None
+	n = int(eof[0])
+	(starts, ends, header, lengths, types, digits) = \
+		(starts[:n], ends[:n], header[:n], lengths[:n], types[:n], digits[:n])
+
+	if numpy.any(ends - starts < lengths * 2 + 11) or \
+	   numpy.any((types != 0x00) & (types != 0x02) & (types != 0x03) &
+	             (types != 0x04) & (types != 0x05)):
+		return None
+
+	# base address of every line from the last type 02 or 04 record before it
+	is_base = (types == 0x02) | (types == 0x04)
+	if numpy.any(is_base & ((lengths != 2) | numpy.any(digits[:, 8:12] == 0xff, axis=1))):
+		return None
+	value = (digits[:, 8].astype(numpy.uint32) << 12) | (digits[:, 9].astype(numpy.uint32) << 8) | \
+	        (digits[:, 10].astype(numpy.uint32) << 4) | digits[:, 11]
+	value = numpy.where(types == 0x02, value << 4, value << 16)
+	last_base = numpy.maximum.accumulate(numpy.where(is_base, numpy.arange(n), -1))
+	bases = numpy.where(last_base >= 0, value[numpy.maximum(last_base, 0)], 0)
+
+	data = types == 0x00
+	addresses = bases[data] + header[data, 1] * 256 + header[data, 2]
+	return (addresses, lengths[data], starts[data])
+
+
+def _first_difference(a, b):
+	"""
+		Returns the index of the first byte where the strings a and b,
+		of equal length, differ, or -1.
+	"""
+
+	if numpy != None:
+		diff = numpy.flatnonzero(numpy.frombuffer(a, dtype=numpy.uint8) !=
+		                         numpy.frombuffer(b, dtype=numpy.uint8))
+		if len(diff) == 0:
+			return -1
+		return int(diff[0])
+
+	if a == b:
+		return -1
+
+	# halve the window until the differing byte is found
+	lo = 0
+	hi = len(a)
+	while hi - lo > 1:
+		mid = (lo + hi) // 2
+		if a[lo:mid] != b[lo:mid]:
+			hi = mid
+		else:
+			lo = mid
+	return lo
+
+
+def difference_ranges(a, b, base, gap):
+	"""
+		Returns the bytes where the strings a and b, of equal length,
+		differ as a list of (start, end, count) tuples, with start and
+		end offset by base. Differences less than gap bytes apart are
+		joined into one range; count is the number of differing bytes.
+	"""
 
-		v = [long(self._length), long(self._offset)]
-		v0, v1 = xtea.encipher(v, 0xffffL)
-		result = ':%04X%04X' % (v0, v1)
-		v[0] = long(self._type)
-		v[1] = 0xffL
-		v0, v1 = xtea.encipher(v, 0xffffL)
-		result += '%04X%04X' % (v0, v1)
+	if numpy != None:
+		diff = numpy.flatnonzero(numpy.frombuffer(a, dtype=numpy.uint8) !=
+		                         numpy.frombuffer(b, dtype=numpy.uint8))
+		if len(diff) == 0:
+			return []
+
+		breaks = numpy.flatnonzero(numpy.diff(diff) > gap)
+		firsts = numpy.concatenate(([0], breaks + 1))
+		lasts = numpy.concatenate((breaks, [len(diff) - 1]))
+		return [(base + int(diff[f]), base + int(diff[l]), int(l - f + 1))
+		        for f, l in zip(firsts, lasts)]
+
+	ranges = []
+	for i in xrange(0, len(a)):
+		if a[i] != b[i]:
+			if len(ranges) > 0 and base + i - ranges[-1][1] <= gap:
+				ranges[-1] = (ranges[-1][0], base + i, ranges[-1][2] + 1)
+			else:
+				ranges.append((base + i, base + i, 1))
+	return ranges
+
+
+def _format_record(rec_type, offset, data):
+	"""
+		Returns one Intel HEX line for a record holding data.
+	"""
+
+	header = struct.pack('>BHB', len(data), offset, rec_type)
+	checksum = -(sum(bytearray(header)) + sum(bytearray(data))) & 0xff
+	return ':%s%s%02X\n' % (binascii.b2a_hex(header).upper(),
+	                        binascii.b2a_hex(data).upper(), checksum)
+
+
+def _format_block(offset, data, record_size):
+	"""
+		Returns the Intel HEX data record lines for data starting at
+		offset inside a 64K block. Checksums of all records are computed
+		in one pass, using numpy when it is available.
+	"""
+
+	starts = range(0, len(data), record_size)
+	lengths = [min(record_size, len(data) - start) for start in starts]
+
+	if numpy != None:
+		sums = numpy.add.reduceat(numpy.frombuffer(data, dtype=numpy.uint8),
+		                          starts, dtype=numpy.uint32).tolist()
+	else:
+		sums = [sum(bytearray(data[start:start + record_size])) for start in starts]
+
+	hex_data = binascii.b2a_hex(data).upper()
+
+	lines = []
+	for i in range(0, len(starts)):
+		address = offset + starts[i]
+		checksum = -(lengths[i] + (address >> 8) + (address & 0xff) + sums[i]) & 0xff
+		lines.append(':%02X%04X00%s%02X\n' % (lengths[i], address,
+		             hex_data[starts[i] << 1:(starts[i] + lengths[i]) << 1], checksum))
+
+	return ''.join(lines)
+
+
+def _format_srec(rec_type, address, address_size, data):
+	"""
+		Returns one S-record line of type rec_type holding data.
+	"""
+
+	record = bytearray([address_size + len(data) + 1])
+	record += struct.pack('>I', address)[4 - address_size:]
+	record += data
+	return 'S%d%s%02X\n' % (rec_type, binascii.b2a_hex(str(record)).upper(),
+	                        ~sum(record) & 0xff)
+
+
+_IMAGE_EXTENSIONS = {
+	'.hex': 'ihex', '.ihx': 'ihex', '.ihex': 'ihex', '.eep': 'ihex',
+	'.elf': 'elf',
+	'.bin': 'binary', '.raw': 'binary',
+	'.srec': 'srec', '.s19': 'srec', '.s28': 'srec', '.s37': 'srec', '.mot': 'srec',
+}
+
+
+def _image_format(file_name, detect):
+	"""
+		Returns 'ihex', 'srec', 'elf' or 'binary' for a file name, by its
+		extension. If the extension is not known and detect is True, the
+		first bytes of the file are checked; otherwise 'ihex' is returned.
+	"""
+
+	image_format = _IMAGE_EXTENSIONS.get(os.path.splitext(file_name)[1].lower())
+	if image_format != None:
+		return image_format
+	if not detect:
+		return 'ihex'
+
+	fp = open(file_name, 'rb')
+	magic = fp.read(4)
+	fp.close()
+
+	if magic == '\x7fELF':
+		return 'elf'
+	elif magic[0:1] == ':':
+		return 'ihex'
+	elif magic[0:1] == 'S' and magic[1:2].isdigit():
+		return 'srec'
+	return 'binary'
+
+
+def _decode_encrypted_lines(lines, key, raw=False):
+	"""
+		Decodes encrypted hex lines. All lines are hex-decoded in one call
+		and all word pairs are deciphered in one batch. Returns the data
+		records as (address, data) tuples with consecutive records joined,
+		or if raw is True every record as a (type, offset, data) tuple.
+	"""
+
+	lines = [line for line in lines if len(line) > 0]
+	for line in lines:
+		if len(line) < 25:
+			raise RuntimeError('Incorrect Hex file format, missing fields. ' +
+			                   'Line from file (%s)' % (line))
+		if line[0] != ':':
+			raise RuntimeError('Incorrect Hex file format, does not start with a colon. ' +
+			                   'Line from file (%s)' % (line))
+		if (len(line) - 1) % 8 != 0:
+			raise RuntimeError('Incorrect Hex file format, invalid data. ' +
+			                   'Line from file (%s)' % (line))
 
-		for i in range(0, self._length, 2):
+	try:
+		blob = binascii.a2b_hex(''.join([line[1:] for line in lines]))
+	except (TypeError, ValueError):
+		for line in lines:
 			try:
-				v = [long(self._data[i]), long(self._data[i+1])]
-				v0, v1 = xtea.encipher(v, 0xffffL)
-				result += '%04X%04X' % (v0, v1)
-			except IndexError:
-				v = [self._data[-1], 0xffL]
-				v0, v1 = xtea.encipher(v, 0xffffL)
-				result += '%04X%04X' % (v0, v1)
-
-		v[0] = long(self._checksum)
-		v[1] = 0xffL
-		v0, v1 = xtea.encipher(v, 0xffffL)
-		result += '%04X%04X' % (v0, v1)
+				binascii.a2b_hex(line[1:])
+			except (TypeError, ValueError):
+				raise RuntimeError('Incorrect Hex file format, invalid data. ' +
+				                   'Line from file (%s)' % (line))
+		raise
+
+	words = xtea.decipher_words(struct.unpack('>%dH' % (len(blob) >> 1), blob), key)
+
+	base_address = 0
+	records = []
+	pieces = []
+	first_address = -1
+	next_address = -1
+	position = 0
+	for i in range(0, len(lines)):
+
+		line = lines[i]
+		count = (len(line) - 1) >> 2
+		rec = words[position:position + count]
+		position += count
+
+		if i % 256 == 0:
+			avrlog.progress('.')
 
-		return result
+		(length, offset, rec_type) = (rec[0], rec[1], rec[2] & 0xff)
+		if count != 6 + 2 * ((length + 1) >> 1):
+			raise RuntimeError('Incorrect Hex file format, missing field. ' +
+			                   'Line from file (%s)' % (line))
+
+		data = bytearray([word & 0xff for word in rec[4:4 + length]])
+		if -(length + (offset >> 8) + (offset & 0xff) + rec_type + sum(data)) & 0xff != \
+		   rec[-2] & 0xff:
+			raise RuntimeError('Incorrect Hex file format, invalid checksum. ' +
+			                   'Line from file (%s)' % (line))
+
+		if raw:
+			records.append((rec_type, offset, str(data)))
+		elif rec_type == 0x00:
+			address = base_address + offset
+			if address != next_address:
+				if len(pieces) > 0:
+					records.append((first_address, ''.join(pieces)))
+				first_address = address
+				pieces = []
+			pieces.append(str(data))
+			next_address = address + length
+		elif rec_type == 0x01:
+			if len(pieces) > 0:
+				records.append((first_address, ''.join(pieces)))
+			return records
+		elif rec_type == 0x02 or rec_type == 0x04:
+			if length != 2:
+				raise RuntimeError('Incorrect Hex file format, missing field. ' +
+				                   'Line from file (%s)' % (line))
+			base_address = (data[0] << 8) | data[1]
+			if rec_type == 0x02:
+				base_address <<= 4
+			else:
+				base_address <<= 16
+		elif rec_type != 0x03 and rec_type != 0x05:
+			raise RuntimeError('Incorrect Hex file format, unsupported format. ' +
+			                   'Line from file (%s)' % (line))
+
+	if raw:
+		return records
+	raise RuntimeError('Premature EOF encountered. ' +
+	                   'Make sure file contains an EOF record.')
+
+
+def _format_encrypted_records(records, key):
+	"""
+		Returns the encrypted hex lines, without line ends, for a list of
+		(type, offset, data) records. The words of all records are
+		enciphered in one batch.
+	"""
+
+	words = []
+	counts = []
+	for rec_type, offset, data in records:
+		data = bytearray(data)
+		checksum = -(len(data) + (offset >> 8) + (offset & 0xff) + rec_type + sum(data)) & 0xff
+		rec = [len(data), offset, rec_type, 0xff]
+		rec.extend(data)
+		if len(data) % 2:
+			rec.append(0xff)
+		rec.extend([checksum, 0xff])
+		words.extend(rec)
+		counts.append(len(rec))
+
+	words = xtea.encipher_words(words, key)
+	hex_words = binascii.b2a_hex(struct.pack('>%dH' % len(words), *words)).upper()
+
+	lines = []
+	position = 0
+	for count in counts:
+		lines.append(':' + hex_words[position << 2:(position + count) << 2])
+		position += count
+	return lines
 
 
 class HexFile():
@@ -290,7 +732,7 @@ class HexFile():
 
 	def _write_record(self, fp, hex_rec):
 
-		fp.write('%02X\n' % str(hex_rec))
+		fp.write('%s\n' % str(hex_rec))
 
 
 	def _parse_record(self, hex_line):	# returns HexRecord
@@ -300,35 +742,101 @@ class HexFile():
 		return hex_rec
 
 
-	def read_file(self, file_name):
+	def _read_records(self, file_name, jobs=1):
+		"""
+			Parses a hex file and returns its data records as a list of
+			(address, data) tuples in file order. Consecutive records are
+			joined. The file is decoded in bulk; if that fails it is parsed
+			again line by line to report the offending line.
+		"""
+
+		if jobs == 0:
+			jobs = 1
+			if os.path.getsize(file_name) >= PARALLEL_MIN_SIZE:
+				jobs = multiprocessing.cpu_count()
+
+		if jobs > 1:
+			records = self._read_records_parallel(file_name, jobs)
+			if records != None:
+				avrlog.progress('\n')
+				return records
 
 		fp = open(file_name, 'r')
-		base_address = 0
-		self.__start = self.__size
-		self.__end = 0
-		lines = fp.readlines()
-		for line in lines:
+		lines = [line.strip() for line in fp.read().splitlines()]
+		fp.close()
 
-			avrlog.progress('.')
+		records = _decode_lines(lines)
+		if records is None:
+			records = self._parse_lines(lines)
 
-			rec = self._parse_record(line.strip())
-			if rec.get_type() == 0x00:
-				if (base_address + rec.get_offset() + rec.get_length()) > self.__size:
-					raise RuntimeError('Hex file defines data outside buffer limits.')
+		avrlog.progress('\n')
+		return records
+
+
+	def _read_records_parallel(self, file_name, jobs):
+		"""
+			Parses line-aligned chunks of a hex file in a pool of jobs
+			processes. The base address in effect at the start of each
+			chunk comes from the address records of the chunks before it,
+			so the results are merged in file order. Returns the same
+			records as the serial parser, or None if a chunk holds a
+			malformed line or the file has no EOF record.
+		"""
+
+		size = os.path.getsize(file_name)
+
+		# a few chunks per process evens out the load
+		bounds = [0]
+		fp = open(file_name, 'rb')
+		for i in range(1, jobs * 4):
+			fp.seek(max(size * i // (jobs * 4), bounds[-1]))
+			fp.readline()
+			if fp.tell() < size and fp.tell() > bounds[-1]:
+				bounds.append(fp.tell())
+		fp.close()
+		bounds.append(size)
+
+		chunks = [(file_name, bounds[i], bounds[i + 1]) for i in range(0, len(bounds) - 1)]
+
+		pool = multiprocessing.Pool(jobs)
+		try:
+			base_address = 0
+			records = []
+			for result in pool.imap(_decode_chunk, chunks):
+
+				avrlog.progress('.')
 
-				for data_pos in range(0, rec.get_length()):
-					self.__data[base_address + rec.get_offset() + data_pos] = rec._data[data_pos]
+				if result == None:
+					return None
 
-				if base_address + rec.get_offset() < self.__start:
-					self.__start = base_address + rec.get_offset()
+				(head, tail, chunk_base, eof) = result
+				records.extend([(base_address + address, data) for address, data in head])
+				records.extend(tail)
+				if chunk_base != None:
+					base_address = chunk_base
+				if eof:
+					return records
+		finally:
+			pool.terminate()
+			pool.join()
 
-				if base_address + rec.get_offset() + rec.get_length() > self.__end:
-					self.__end = base_address + rec.get_offset() + rec.get_length() - 1
+		return None
 
+
+	def _parse_lines(self, lines):
+
+		base_address = 0
+		records = []
+		for line in lines:
+
+			avrlog.progress('.')
+
+			rec = self._parse_record(line)
+			if rec.get_type() == 0x00:
+				records.append((base_address + rec.get_offset(),
+				                rec._data[0:rec.get_length()]))
 			elif rec.get_type() == 0x01:
-				fp.close()
-				avrlog.progress('\n')
-				return
+				return records
 			elif rec.get_type() == 0x02:
 				base_address =  (rec._data[0] << 8) | rec._data[1]
 				base_address <<= 4
@@ -341,80 +849,342 @@ class HexFile():
 				pass
 			else:
 				raise RuntimeError('Incorrect Hex file format, unsupported format. ' +
-				                   'Line from file (%s)' % (hex_line))
+				                   'Line from file (%s)' % (line))
 
 		raise RuntimeError('Premature EOF encountered. ' +
 		                   'Make sure file contains an EOF record.')
 
 
-	def write_file(self, file_name):
+	def read_file(self, file_name, jobs=1):
+		"""
+			Reads an Intel HEX file, from the parse cache if one is set
+			and holds the file. The file is parsed by jobs processes; 0
+			uses all CPUs for files of PARALLEL_MIN_SIZE bytes or more,
+			which stays serial on a single CPU.
+		"""
+
+		records = None
+		if _cache != None:
+			records = _cache.load(file_name)
+
+		if records == None:
+			records = self._read_records(file_name, jobs)
+			if _cache != None:
+				_cache.store(file_name, records)
+
+		self._load_records(records)
+
+
+	def read_elf(self, file_name, eeprom=False):
+		"""
+			Reads the flash sections of an AVR ELF file, or its .eeprom
+			section if eeprom is True.
+		"""
+
+		self._load_records(elf_util.read_elf_records(file_name, eeprom))
+
+
+	def read_binary(self, file_name, address=0):
+		"""
+			Reads a raw binary image to address. The file is memory mapped
+			and copied into the buffer in one slice, without parsing.
+		"""
+
+		fp = open(file_name, 'rb')
+		try:
+			if os.fstat(fp.fileno()).st_size == 0:
+				self._load_records([])
+				return
+
+			mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				self._load_records([(address, mm)])
+			finally:
+				mm.close()
+		finally:
+			fp.close()
+
+
+	def read_srec(self, file_name):
+
+		self._load_records(self._read_srec_records(file_name))
+
+
+	def read_image(self, file_name, eeprom=False, jobs=1):
+		"""
+			Reads an Intel HEX, S-record, AVR ELF or raw binary file. The
+			format is taken from the file name extension, or from the
+			first bytes of the file if the extension is not known. jobs
+			is passed on to read_file for Intel HEX files.
+		"""
+
+		image_format = _image_format(file_name, True)
+		if image_format == 'elf':
+			self.read_elf(file_name, eeprom)
+		elif image_format == 'srec':
+			self.read_srec(file_name)
+		elif image_format == 'binary':
+			self.read_binary(file_name)
+		else:
+			self.read_file(file_name, jobs)
+
+
+	def read_encrypted(self, file_name, key=ENCRYPTION_KEY):
+		"""
+			Reads an encrypted hex file. Decrypted data never goes to the
+			parse cache.
+		"""
+
+		fp = open(file_name, 'r')
+		lines = [line.strip() for line in fp.read().splitlines()]
+		fp.close()
+
+		records = _decode_encrypted_lines(lines, key)
+		avrlog.progress('\n')
+		self._load_records(records)
+
+
+	def _read_srec_records(self, file_name):
+		"""
+			Parses a Motorola S-record file and returns its data records
+			as a list of (address, data) tuples in file order. Consecutive
+			records are joined.
+		"""
+
+		fp = open(file_name, 'r')
+		lines = [line.strip() for line in fp.read().splitlines()]
+		fp.close()
+
+		records = []
+		pieces = []
+		first_address = -1
+		next_address = -1
+		for i in range(0, len(lines)):
+
+			line = lines[i]
+			if len(line) == 0:
+				continue
+
+			if i % 256 == 0:
+				avrlog.progress('.')
+
+			try:
+				if line[0] != 'S' or len(line) < 10:
+					raise ValueError
+				rec_type = line[1]
+				record = bytearray(binascii.a2b_hex(line[2:]))
+			except (TypeError, ValueError):
+				raise RuntimeError('Incorrect S-record file format, missing fields. ' +
+				                   'Line from file (%s)' % (line))
+
+			if record[0] != len(record) - 1:
+				raise RuntimeError('Incorrect S-record file format, record length mismatch. ' +
+				                   'Line from file (%s)' % (line))
+
+			if sum(record) & 0xff != 0xff:
+				raise RuntimeError('Incorrect S-record file format, invalid checksum. ' +
+				                   'Line from file (%s)' % (line))
+
+			if rec_type in '123':
+				address_size = ord(rec_type) - ord('0') + 1
+				address = 0
+				for b in record[1:1 + address_size]:
+					address = (address << 8) | b
+				data = str(record[1 + address_size:-1])
+
+				if address != next_address:
+					if len(pieces) > 0:
+						records.append((first_address, ''.join(pieces)))
+					first_address = address
+					pieces = []
+				pieces.append(data)
+				next_address = address + len(data)
+			elif rec_type in '789':
+				break
+			elif rec_type not in '0456':
+				raise RuntimeError('Incorrect S-record file format, unsupported format. ' +
+				                   'Line from file (%s)' % (line))
+
+		if len(pieces) > 0:
+			records.append((first_address, ''.join(pieces)))
+
+		avrlog.progress('\n')
+		return records
+
+
+	def _load_records(self, records):
+
+		self.__start = self.__size
+		self.__end = 0
+		for address, data in records:
+
+			if address + len(data) > self.__size:
+				raise RuntimeError('Hex file defines data outside buffer limits.')
+
+			self.__data[address:address + len(data)] = data
+
+			if address < self.__start:
+				self.__start = address
+
+			if address + len(data) - 1 > self.__end:
+				self.__end = address + len(data) - 1
+
+
+	def write_file(self, file_name, record_size=16):
+		"""
+			Writes the used range as Intel HEX with data records of up to
+			record_size bytes. Type 02 address records are used for images
+			up to 1 MB, type 04 records above that. Lines are formatted one
+			64K block at a time and written through a large file buffer.
+		"""
+
+		if record_size < 1 or record_size > 255:
+			raise RuntimeError('Invalid record size! Must be 1 to 255 bytes.')
+
+		fp = open(file_name, 'w', 1 << 20)
+
+		linear = False
+		for start, end in self.get_segments():
+			if end > 0xfffff:
+				linear = True
+
+		base_address = -1
+		for start, end in self.get_segments():
+
+			address = start
+			while address <= end:
+
+				# write a new base address record when entering another 64k block
+				if address & ~0xffff != base_address:
+					base_address = address & ~0xffff
+					if linear:
+						fp.write(_format_record(0x04, 0, struct.pack('>H', base_address >> 16)))
+					else:
+						fp.write(_format_record(0x02, 0, struct.pack('>H', base_address >> 4)))
 
-		fp = open(file_name, 'w')
+				# records of a block end at the 64k boundary or at the end of the segment
+				block_end = min(end, base_address | 0xffff)
+				fp.write(_format_block(address & 0xffff,
+				                       self.get_range(address, block_end).tobytes(),
+				                       record_size))
 
-		base_address = self.__start & ~0xffff
-		self._offset = self.__start & 0xffff
+				avrlog.progress('.' * ((block_end - address + 1) >> 8))
+				address = block_end + 1
 
-		rec = HexRecord()
-		rec.set_length(2)
-		rec.set_offset(0)
-		rec.set_type(0x02)
-		rec._data[1] = 0x00
-		rec._data[0] = base_address >> 12
-		self._write_record(fp, rec)
+		fp.write(_format_record(0x01, 0, ''))
 
-		rec = HexRecord()
-		rec.set_length(self.__size)
-		data_pos = 0
-		while base_address + self._offset + data_pos <= self.__end:
-			rec._data[data_pos] = self.__data[base_address + self._offset + data_pos]
-			data_pos += 1
+		fp.close()
+		avrlog.progress('\n')
+
+
+	def write_binary(self, file_name):
+		"""
+			Writes a raw binary image from address 0 to the end of the
+			used range, so file offsets are device addresses. The buffer
+			is written directly, without formatting.
+		"""
+
+		fp = open(file_name, 'wb')
+		if self.get_range_start() <= self.get_range_end():
+			fp.write(self.get_range(0, self.get_range_end()))
+		fp.close()
 
-			# check if we need to write out the current data record
-			#	reached 64k boundary or
-			#	data record full or
-			#	end of used range reached
-			if self._offset + data_pos >= 0x10000 or \
-			   data_pos >= 16 or \
-			   base_address + self._offset + data_pos > self.__end:
-				rec.set_length(data_pos)
-				rec.set_offset(self._offset)
-				rec.set_type(0x00)
 
-				if data_pos % 256 == 0:
-					avrlog.progress('.')
+	def write_srec(self, file_name, record_size=16):
+		"""
+			Writes the used range as Motorola S-records, using S1, S2 or S3
+			data records depending on the highest address.
+		"""
 
-				self._write_record(fp, rec)
+		if record_size < 1 or record_size > 250:
+			raise RuntimeError('Invalid record size! Must be 1 to 250 bytes.')
 
-				self._offset += data_pos
-				data_pos = 0
+		address_size = 2
+		for start, end in self.get_segments():
+			if end > 0xffffff:
+				address_size = 4
+			elif end > 0xffff:
+				address_size = max(address_size, 3)
 
-			# check if we have passed a 64k boundary
-			if self._offset + data_pos >= 0x10000:
-				# update address pointers
-				self._offset -= 0x10000
-				base_address += 0x10000
+		data_type = address_size - 1				# S1, S2 or S3
 
-				# write new base address record to hex file
-				rec.set_length(2)
-				rec.set_offset(0)
-				rec.set_type(0x02)
-				# give 4k page index
-				rec._data[0] = base_address >> 12
-				rec._data[1] = 0x00
+		fp = open(file_name, 'w', 1 << 20)
+		fp.write(_format_srec(0, 0, 2, ''))
 
-				self._write_record(fp, rec)
+		for start, end in self.get_segments():
 
-		# write EOF record
-		rec.set_length(0)
-		rec.set_offset(0)
-		rec.set_type(0x01)
+			data = self.get_range(start, end).tobytes()
+			lines = []
+			for offset in range(0, len(data), record_size):
+				lines.append(_format_srec(data_type, start + offset, address_size,
+				                          data[offset:offset + record_size]))
+			fp.write(''.join(lines))
+			avrlog.progress('.' * (len(data) >> 8))
 
-		self._write_record(fp, rec)
+		fp.write(_format_srec(10 - data_type, 0, address_size, ''))
 
 		fp.close()
 		avrlog.progress('\n')
 
 
+	def write_encrypted(self, file_name, key=ENCRYPTION_KEY, record_size=16):
+		"""
+			Writes the used range as an encrypted hex file, with the same
+			records write_file would produce.
+		"""
+
+		if record_size < 1 or record_size > 255:
+			raise RuntimeError('Invalid record size! Must be 1 to 255 bytes.')
+
+		linear = False
+		for start, end in self.get_segments():
+			if end > 0xfffff:
+				linear = True
+
+		records = []
+		base_address = -1
+		for start, end in self.get_segments():
+
+			address = start
+			while address <= end:
+
+				if address & ~0xffff != base_address:
+					base_address = address & ~0xffff
+					if linear:
+						records.append((0x04, 0, struct.pack('>H', base_address >> 16)))
+					else:
+						records.append((0x02, 0, struct.pack('>H', base_address >> 4)))
+
+				block_end = min(end, base_address | 0xffff)
+				data = self.get_range(address, block_end).tobytes()
+				for offset in range(0, len(data), record_size):
+					records.append((0x00, (address + offset) & 0xffff,
+					                data[offset:offset + record_size]))
+
+				address = block_end + 1
+
+		records.append((0x01, 0, ''))
+
+		fp = open(file_name, 'w', 1 << 20)
+		fp.write('\n'.join(_format_encrypted_records(records, key)) + '\n')
+		fp.close()
+
+
+	def write_image(self, file_name, record_size=16):
+		"""
+			Writes an Intel HEX, S-record or raw binary file, chosen by the
+			file name extension. Unknown extensions get Intel HEX.
+		"""
+
+		image_format = _image_format(file_name, False)
+		if image_format == 'srec':
+			self.write_srec(file_name, record_size)
+		elif image_format == 'binary':
+			self.write_binary(file_name)
+		else:
+			self.write_file(file_name, record_size)
+
+
 	def set_used_range(self, start, end):
 
 		if start < 0 or end >= self.__size or start > end:
@@ -426,8 +1196,7 @@ class HexFile():
 
 	def clear_all(self, value=0xff):
 
-		for i in range(0, self.__size):
-			self.__data[i] = chr((value & 0xff))
+		self.fill_range(0, self.__size - 1, value)
 
 
 	def get_range_start(self):
@@ -457,115 +1226,626 @@ class HexFile():
 		self.__data[address] = value[0]
 
 
+	def get_range(self, start, end):
+		"""
+			Returns a memoryview of the buffer from start to end, inclusive.
+		"""
+
+		if start < 0 or end >= self.__size or start > end + 1:
+			raise RuntimeError('Address outside valid range!')
+		return memoryview(self.__data)[start:end + 1]
+
+
+	def set_range(self, start, data):
+
+		if start < 0 or start + len(data) > self.__size:
+			raise RuntimeError('Address outside valid range!')
+		self.__data[start:start + len(data)] = data
+
+
+	def fill_range(self, start, end, value=0xff):
+		"""
+			Sets the memory from start to end, inclusive, to value.
+		"""
+
+		if start < 0 or end >= self.get_size() or start > end + 1:
+			raise RuntimeError('Address outside valid range!')
+		self.set_range(start, chr(value & 0xff) * (end - start + 1))
+
+
+	def copy_from(self, other, start=-1, end=-1):
+		"""
+			Copies the populated memory of other from start to end,
+			inclusive, into this file. The default range is the used
+			range of other. The used range of this file is unchanged.
+		"""
+
+		if start < 0:
+			start = other.get_range_start()
+		if end < 0:
+			end = other.get_range_end()
+
+		for seg_start, seg_end in other.get_segments():
+			first = max(seg_start, start)
+			last = min(seg_end, end)
+			if first <= last:
+				self.set_range(first, other.get_range(first, last))
+
+
+	def find_first_difference(self, other, start, end):
+		"""
+			Returns the first address from start to end, inclusive, where
+			this file and other differ, or -1 if they are equal there.
+			The range is compared a window at a time.
+		"""
+
+		for address in range(start, end + 1, COMPARE_WINDOW):
+			last = min(address + COMPARE_WINDOW - 1, end)
+			a = self.get_range(address, last).tobytes()
+			b = other.get_range(address, last).tobytes()
+			if a != b:
+				return address + _first_difference(a, b)
+
+		return -1
+
+
+	def get_differences(self, other, start, end, gap=MISMATCH_GAP):
+		"""
+			Returns the bytes from start to end, inclusive, where this
+			file and other differ as a list of (start, end, count)
+			tuples. Differences less than gap bytes apart share a range,
+			count is the number of differing bytes in it.
+		"""
+
+		ranges = []
+		for address in range(start, end + 1, COMPARE_WINDOW):
+			last = min(address + COMPARE_WINDOW - 1, end)
+			a = self.get_range(address, last).tobytes()
+			b = other.get_range(address, last).tobytes()
+			if a == b:
+				continue
+
+			for first, final, count in difference_ranges(a, b, address, gap):
+				if len(ranges) > 0 and first - ranges[-1][1] <= gap:
+					ranges[-1] = (ranges[-1][0], final, ranges[-1][2] + count)
+				else:
+					ranges.append((first, final, count))
+
+		return ranges
+
+
+	def get_buffer(self):
+		"""
+			Returns a writable memoryview of the whole memory.
+		"""
+
+		return memoryview(self.__data)
+
+
+	def get_array(self):
+		"""
+			Returns the whole memory as a writable numpy uint8 array
+			sharing the buffer of get_buffer.
+		"""
+
+		if numpy == None:
+			raise RuntimeError('HexFile.get_array() requires numpy.')
+		return numpy.frombuffer(self.__data, dtype=numpy.uint8)
+
+
+	def get_segments(self):
+		"""
+			Returns the populated memory inside the used range as a list
+			of (start, end) tuples. All of the used range is populated.
+		"""
+
+		if self.__start < 0 or self.__start > self.__end:
+			return []
+		return [(self.__start, self.__end)]
+
+
+	def _page_parts(self, page_size):
+		"""
+			Yields (page, first, last) for every page touched by a
+			segment, with first and last clipped to that segment.
+		"""
+
+		for start, end in self.get_segments():
+			for page in range(start // page_size, end // page_size + 1):
+				yield (page, max(page * page_size, start),
+				       min((page + 1) * page_size - 1, end))
+
+
+	def get_changed_pages(self, other, page_size):
+		"""
+			Returns the indexes of the populated pages whose contents
+			differ from other. Pages not fully inside the used range of
+			other count as changed.
+		"""
+
+		pages = []
+		for page, first, last in self._page_parts(page_size):
+			if len(pages) > 0 and pages[-1] == page:
+				continue
+
+			if first < other.get_range_start() or last > other.get_range_end() or \
+			   self.get_range(first, last).tobytes() != other.get_range(first, last).tobytes():
+				pages.append(page)
+
+		return pages
+
+
+	def get_populated_pages(self, page_size):
+		"""
+			Returns the indexes of the pages holding populated memory.
+		"""
+
+		pages = []
+		for page, first, last in self._page_parts(page_size):
+			if len(pages) == 0 or pages[-1] != page:
+				pages.append(page)
+		return pages
+
+
+	def get_unwritable_pages(self, other, page_size):
+		"""
+			Returns the indexes of the populated pages that cannot be
+			programmed over other without erasing them first, because
+			some bit must go from 0 to 1. Pages not fully inside the used
+			range of other count as unwritable.
+		"""
+
+		pages = []
+		for page, first, last in self._page_parts(page_size):
+			if len(pages) > 0 and pages[-1] == page:
+				continue
+
+			if first < other.get_range_start() or last > other.get_range_end() or \
+			   needs_erase(self.get_range(first, last).tobytes(),
+			               other.get_range(first, last).tobytes()):
+				pages.append(page)
+
+		return pages
+
+
+	def get_occupied_pages(self, page_size, value=0xff):
+		"""
+			Returns the indexes of the populated pages holding at least
+			one byte other than value, i.e. the pages that must be
+			programmed on an erased device.
+		"""
+
+		blank = chr(value & 0xff) * page_size
+		pages = []
+		for page, first, last in self._page_parts(page_size):
+			if len(pages) > 0 and pages[-1] == page:
+				continue
+
+			if self.get_range(first, last).tobytes() != blank[:last - first + 1]:
+				pages.append(page)
+
+		return pages
+
+
 	def get_size(self):
 
 		return self.__size
 
 
-class EncryptedHexFile(HexFile):
-	
-	def __init__(self, buffersize, value=0x00ff):
+class SparseHexFile(HexFile):
+	"""
+		SparseHexFile class.
+		A HexFile that stores only the populated memory, as a sorted
+		list of contiguous segments. Addresses outside the segments
+		read as the fill value and are left out of get_segments(), so
+		gaps between the segments are not programmed or verified.
+	"""
 
-		raise RuntimeError('Encrypted Hex file not implemented.')
-		import xtea
+	def __init__(self, buffersize, value=0xff):
 
+		self.__starts = []				# segment start addresses, sorted
+		self.__segments = []			# segment data, bytearrays
+		self.__value = value & 0xff
 		self.__start = -1
 		self.__end = -1
-		self.__default_value = value
 		self.__size = buffersize
-		self.__base_address = -1
-		self.__records = {}
-		self.__keys = []
 
 
-	def _parse_record(self, hex_line):	# returns EncryptedHexRecord
+	def _load_records(self, records):
 
-		hex_rec = EncryptedHexRecord()
-		hex_rec.from_string(hex_line.strip())
-		return hex_rec
+		self.__start = self.__size
+		self.__end = 0
+		for address, data in records:
 
+			if address + len(data) > self.__size:
+				raise RuntimeError('Hex file defines data outside buffer limits.')
 
-	def _add_record(self, ehex_rec):
+			self.set_range(address, data)
 
-		self.__records[ehex_rec.get_offset()] = ehex_rec
-		self.__keys = self.__records.keys()
-		self.__keys.sort()
+			if address < self.__start:
+				self.__start = address
 
+			if address + len(data) - 1 > self.__end:
+				self.__end = address + len(data) - 1
 
-	def read_file(self, file_name):
 
-		fp = open(file_name, 'r')
+	def set_used_range(self, start, end):
+
+		if start < 0 or end >= self.__size or start > end:
+			raise RuntimeError('Invalid range! Start must be 0 or greater, ' +
+			                   'end must be inside allowed memory range.')
+		self.__start = start
+		self.__end = end
+
+
+	def clear_all(self, value=0xff):
+
+		self.__value = value & 0xff
+		for segment in self.__segments:
+			segment[:] = chr(self.__value) * len(segment)
+
+
+	def get_range_start(self):
+
+		return self.__start
+
+
+	def get_range_end(self):
+
+		return self.__end
+
+
+	def _find_segment(self, address):
+		"""
+			Returns the index of the last segment starting at or before
+			address, or -1.
+		"""
+
+		return bisect.bisect_right(self.__starts, address) - 1
+
+
+	def get_data(self, address):
+
+		if address < 0 or address >= self.__size:
+			raise RuntimeError('Address outside valid range!')
+
+		i = self._find_segment(address)
+		if i >= 0 and address < self.__starts[i] + len(self.__segments[i]):
+			return self.__segments[i][address - self.__starts[i]]
+		return self.__value
+
+
+	def set_data(self, address, value):
+
+		if type(value) != types.StringType or len(value) != 1:
+			raise RuntimeError('HexFile.set_data() invalid value.')
+
+		if address < 0 or address >= self.__size:
+			raise RuntimeError('Address outside valid range!')
+		self.set_range(address, value)
+
+
+	def get_range(self, start, end):
+		"""
+			Returns a memoryview of the memory from start to end,
+			inclusive. A range inside one segment is a view of it; a
+			range over a gap is a copy, with the gap read as the fill
+			value, and the segments are left as they are.
+		"""
+
+		if start < 0 or end >= self.__size or start > end + 1:
+			raise RuntimeError('Address outside valid range!')
+
+		if start > end:
+			return memoryview(bytearray())
+
+		i = self._find_segment(start)
+		if i < 0 or end >= self.__starts[i] + len(self.__segments[i]):
+			data = bytearray(chr(self.__value) * (end - start + 1))
+			for j in range(0, len(self.__starts)):
+				seg_start = self.__starts[j]
+				segment = self.__segments[j]
+				first = max(seg_start, start)
+				last = min(seg_start + len(segment) - 1, end)
+				if first <= last:
+					data[first - start:last - start + 1] = \
+					    segment[first - seg_start:last - seg_start + 1]
+			return memoryview(data)
+
+		offset = start - self.__starts[i]
+		return memoryview(self.__segments[i])[offset:offset + end - start + 1]
+
+
+	def set_range(self, start, data):
+
+		end = start + len(data)			# exclusive
+		if start < 0 or end > self.__size:
+			raise RuntimeError('Address outside valid range!')
+		if len(data) == 0:
+			return
+
+		# extend the segment that overlaps or touches start, or add one
+		i = self._find_segment(start)
+		if i >= 0 and self.__starts[i] + len(self.__segments[i]) >= start:
+			segment = self.__segments[i]
+			offset = start - self.__starts[i]
+			segment[offset:offset + len(data)] = data
+		else:
+			i += 1
+			segment = bytearray(data)
+			self.__starts.insert(i, start)
+			self.__segments.insert(i, segment)
+
+		# merge the following segments that now overlap or touch it
+		seg_end = self.__starts[i] + len(segment)
+		while i + 1 < len(self.__starts) and self.__starts[i + 1] <= seg_end:
+			next_start = self.__starts.pop(i + 1)
+			next_segment = self.__segments.pop(i + 1)
+			if next_start + len(next_segment) > seg_end:
+				segment.extend(next_segment[seg_end - next_start:])
+				seg_end = self.__starts[i] + len(segment)
+
+
+	def get_buffer(self):
+
+		raise RuntimeError('SparseHexFile has no contiguous buffer, use get_range().')
+
+
+	def get_array(self):
+
+		raise RuntimeError('SparseHexFile has no contiguous buffer, use get_range().')
+
+
+	def _get_all_segments(self):
+
+		return [(self.__starts[i], self.__starts[i] + len(self.__segments[i]) - 1)
+		        for i in range(0, len(self.__starts))]
+
+
+	def get_segments(self):
+		"""
+			Returns the populated memory inside the used range as a list
+			of (start, end) tuples.
+		"""
+
+		segments = []
+		for start, end in self._get_all_segments():
+			if start <= self.__end and end >= self.__start:
+				segments.append((max(start, self.__start), min(end, self.__end)))
+		return segments
+
+
+	def get_size(self):
+
+		return self.__size
+
+
+class LazyHexFile(HexFile):
+	"""
+		LazyHexFile class.
+		A HexFile for reading or patching a few addresses of a large hex
+		file. read_file memory maps the file and indexes the line offset,
+		address and length of each data record; records are decoded and
+		checked only when their data is needed, and the most recently
+		used ones are kept. Changes are kept apart from the file, as
+		sorted runs of patched bytes, until write_file, so views
+		returned by get_range are copies.
+	"""
+
+	def __init__(self, buffersize, value=0xff, cache_records=256):
+
+		self.__addresses = array.array('I')	# record addresses, sorted
+		self.__lengths = array.array('B')
+		self.__offsets = array.array('I')	# file offset of each record line
+		self.__order = None					# line numbers if not in address order
+		self.__records = collections.OrderedDict()
+		self.__cache_records = cache_records
+		self.__patch_starts = []			# patched run start addresses, sorted
+		self.__patches = []					# patched runs, bytearrays
+		self.__file = None
+		self.__map = None
+		self.__value = value & 0xff
+		self.__start = -1
+		self.__end = -1
+		self.__size = buffersize
+
+
+	def read_file(self, file_name, jobs=1):
+
+		self.close()
+		self.__records.clear()
+		self.__patch_starts = []
+		self.__patches = []
+
+		self.__file = open(file_name, 'rb')
+		size = os.fstat(self.__file.fileno()).st_size
+		if size == 0:
+			raise RuntimeError('Premature EOF encountered. ' +
+			                   'Make sure file contains an EOF record.')
+		self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		addresses = array.array('I')
+		lengths = array.array('B')
+		offsets = array.array('I')
+
+		order = None
+		index = None
+		if numpy != None:
+			index = _index_lines_numpy(self.__map, size)
+		if index != None:
+			(found_addresses, found_lengths, found_offsets) = index
+			if numpy.any(found_addresses + found_lengths > self.__size):
+				raise RuntimeError('Hex file defines data outside buffer limits.')
+			if numpy.any(found_addresses[1:] < found_addresses[:-1]):
+				order = numpy.argsort(found_addresses, kind='mergesort')
+				(found_addresses, found_lengths, found_offsets) = \
+					(found_addresses[order], found_lengths[order], found_offsets[order])
+				order = array.array('I', order.astype(numpy.uint32).tostring())
+			addresses.fromstring(found_addresses.astype(numpy.uint32).tostring())
+			lengths.fromstring(found_lengths.astype(numpy.uint8).tostring())
+			offsets.fromstring(found_offsets.astype(numpy.uint32).tostring())
+
+		# otherwise index the file a window of whole lines at a time
 		base_address = 0
+		position = 0
+		eof = index != None
+		while position < size and not eof:
+
+			window_end = size
+			if position + 0x100000 < size:
+				window_end = self.__map.rfind('\n', position, position + 0x100000) + 1
+				if window_end <= position:			# a line longer than the window
+					window_end = self.__map.find('\n', position + 0x100000) + 1
+					if window_end == 0:
+						window_end = size
+
+			raw_lines = self.__map[position:window_end].split('\n')
+			if raw_lines[-1] == '':
+				raw_lines.pop()
+
+			(base_address, eof) = self._index_lines(raw_lines, position, base_address,
+			                                        addresses, lengths, offsets)
+			position = window_end
+			avrlog.progress('.')
+
+		avrlog.progress('\n')
+		if not eof:
+			raise RuntimeError('Premature EOF encountered. ' +
+			                   'Make sure file contains an EOF record.')
+
+		# records are usually in address order already, then the line
+		# order is the index order
+		if index == None:
+			for i in range(1, len(addresses)):
+				if addresses[i] < addresses[i - 1]:
+					order = sorted(range(0, len(addresses)), key=addresses.__getitem__)
+					addresses = array.array('I', [addresses[j] for j in order])
+					lengths = array.array('B', [lengths[j] for j in order])
+					offsets = array.array('I', [offsets[j] for j in order])
+					order = array.array('I', order)
+					break
+
+		self.__addresses = addresses
+		self.__lengths = lengths
+		self.__offsets = offsets
+		self.__order = order
+
 		self.__start = self.__size
 		self.__end = 0
-		lines = fp.readlines()
-		for line in lines:
+		if index != None and len(addresses) > 0:
+			self.__start = addresses[0]
+			self.__end = int(numpy.max(index[0] + index[1])) - 1
+		elif len(addresses) > 0:
+			self.__start = addresses[0]
+			self.__end = max([address + length for address, length in zip(addresses, lengths)]) - 1
 
-			avrlog.progress('.')
 
-			rec = self._parse_record(line.strip())
-			if rec.get_type() == 0x00:
-				if (base_address + rec.get_offset() + rec.get_length()) > self.__size:
-					raise RuntimeError('Hex file defines data outside buffer limits. %s' % line.strip())
+	def _index_lines(self, raw_lines, position, base_address, addresses, lengths, offsets):
+		"""
+			Adds the data records of raw_lines, which start at file offset
+			position, to the index. The record headers of all lines are
+			decoded in one call. Returns the base address after the lines
+			and whether an EOF record was found.
+		"""
 
-				if self.__base_address + rec.get_offset() < self.__start:
-					self.__start = self.__base_address + rec.get_offset()
+		lines = [line.strip() for line in raw_lines]
+		try:
+			if len(lines) == 0 or min([len(line) for line in lines]) < 11 or \
+			   [line[0:1] for line in lines].count(':') != len(lines):
+				raise ValueError
+			headers = struct.unpack('>' + 'BHB' * len(lines),
+			                        binascii.a2b_hex(''.join([line[1:9] for line in lines])))
+		except (TypeError, ValueError):
+			headers = None
+
+		for i in range(0, len(lines)):
+
+			line = lines[i]
+			if headers == None:
+				if len(line) < 11:
+					raise RuntimeError('Incorrect Hex file format, missing fields. ' +
+					                   'Line from file (%s)' % (line))
+				if line[0] != ':':
+					raise RuntimeError('Incorrect Hex file format, does not start with a colon. ' +
+					                   'Line from file (%s)' % (line))
+				try:
+					(length, offset, rec_type) = struct.unpack('>BHB', binascii.a2b_hex(line[1:9]))
+				except (TypeError, ValueError):
+					raise RuntimeError('Incorrect Hex file format, invalid data. ' +
+					                   'Line from file (%s)' % (line))
+			else:
+				(length, offset, rec_type) = headers[i * 3:i * 3 + 3]
 
-				if self.__base_address + rec.get_offset() + rec.get_length() > self.__end:
-					self.__end = self.__base_address + rec.get_offset() + rec.get_length() - 1
+			if len(line) < length * 2 + 11:
+				raise RuntimeError('Incorrect Hex file format, missing field. ' +
+				                   'Line from file (%s)' % (line))
 
-			elif rec.get_type() == 0x01:
-				fp.close()
-				avrlog.progress('\n')
-				return
-			elif rec.get_type() == 0x02:
-				self.__base_address =  (rec._data[0] << 8) | rec._data[1]
-				self.__base_address <<= 4
-			elif rec.get_type() == 0x03:
-				pass
-			elif rec.get_type() == 0x04:
-				self.__base_address =  (rec._data[0] << 8) | rec._data[1]
-				self.__base_address <<= 16
-			elif rec.get_type() == 0x05:
-				pass
-			else:
+			if rec_type == 0x00:
+				if base_address + offset + length > self.__size:
+					raise RuntimeError('Hex file defines data outside buffer limits.')
+				addresses.append(base_address + offset)
+				lengths.append(length)
+				if raw_lines[i][0:1] == ':':
+					offsets.append(position)
+				else:
+					offsets.append(position + raw_lines[i].index(':'))
+			elif rec_type == 0x01:
+				return (base_address, True)
+			elif rec_type == 0x02:
+				base_address = int(line[9:13], 16) << 4
+			elif rec_type == 0x04:
+				base_address = int(line[9:13], 16) << 16
+			elif rec_type != 0x03 and rec_type != 0x05:
 				raise RuntimeError('Incorrect Hex file format, unsupported format. ' +
-				                   'Line from file (%s)' % (hex_line))
+				                   'Line from file (%s)' % (line))
 
-			self._add_record(rec)
+			position += len(raw_lines[i]) + 1
+
+		return (base_address, False)
 
-		raise RuntimeError('Premature EOF encountered. ' +
-		                   'Make sure file contains an EOF record.')
 
+	def close(self):
+		"""
+			Releases the memory map of the file. Patches are kept.
+		"""
 
-	def write_file(self, file_name):
+		if self.__map != None:
+			self.__map.close()
+			self.__file.close()
+		self.__map = None
+		self.__file = None
 
-		fp = open(file_name, 'w')
 
-		rec = EncryptedHexRecord()
-		rec.set_length(2)
-		rec.set_offset(0)
-		rec.set_type(0x02)
-		rec._data[1] = 0x00
-		rec._data[0] = self.__base_address >> 12
-		self._write_record(fp, rec)
+	def _load_records(self, records):
 
-		for rec_oset in self.__keys():
-			rec = self.__records[rec_oset]
-			self._write_record(fp, rec)
+		raise RuntimeError('LazyHexFile reads Intel HEX files only.')
 
-			if data_pos % 256 == 0:
-				avrlog.progress('.')
 
-		# write EOF record
-		rec.set_length(0)
-		rec.set_offset(0)
-		rec.set_type(0x01)
+	def _get_record(self, i):
+		"""
+			Returns the data of record i, decoding it if it is not among
+			the recently used records.
+		"""
+
+		data = self.__records.pop(i, None)
+		if data == None:
+			offset = self.__offsets[i]
+			line = self.__map[offset:offset + self.__lengths[i] * 2 + 11]
+			try:
+				raw = bytearray(binascii.a2b_hex(line[1:]))
+			except (TypeError, ValueError):
+				raise RuntimeError('Incorrect Hex file format, invalid data. ' +
+				                   'Line from file (%s)' % (line))
+			if sum(raw) & 0xff:
+				raise RuntimeError('Incorrect Hex file format, invalid checksum. ' +
+				                   'Line from file (%s)' % (line))
+			data = raw[4:-1]
 
-		self._write_record(fp, rec)
+			if len(self.__records) >= self.__cache_records:
+				self.__records.popitem(False)
 
-		fp.close()
-		avrlog.progress('\n')
+		self.__records[i] = data
+		return data
 
 
 	def set_used_range(self, start, end):
@@ -579,9 +1859,7 @@ class EncryptedHexFile(HexFile):
 
 	def clear_all(self, value=0xff):
 
-		# TODO
-		for i in range(0, self.__size):
-			self.__data[i] = chr((value & 0xff))
+		self.__value = value & 0xff
 
 
 	def get_range_start(self):
@@ -594,48 +1872,130 @@ class EncryptedHexFile(HexFile):
 		return self.__end
 
 
-	def _find_record_offset(self, address):
+	def get_data(self, address):
+
+		if address < 0 or address >= self.__size:
+			raise RuntimeError('Address outside valid range!')
+		return self._get_bytes(address, address)[0]
+
 
-		i = bisect.bisect_right(self.__keys, address)
-		if i == len(self.__keys) and address >= self.__size:
-			raise RuntimeError('Address not found. Hex file address: 0x%04X' % address)
+	def set_data(self, address, value):
 
-		key = self.__keys[i-1]
-		rec = self.__records[key]
-		offset = address - rec.get_offset()
-		if offset < 0:
-			raise RuntimeError('Address error. Data not found at 0x%04X' % address)
+		if type(value) != types.StringType or len(value) != 1:
+			raise RuntimeError('HexFile.set_data() invalid value.')
 
-		return (rec, offset)
+		self.set_range(address, value)
 
 
-	def get_data(self, address):	# returns from byte array
+	def get_range(self, start, end):
+		"""
+			Returns a memoryview of a copy of the memory from start to end,
+			inclusive. Only the records overlapping the range are decoded.
+		"""
 
-		if address < 0 or address >= self.__size:
+		if start < 0 or end >= self.__size or start > end + 1:
 			raise RuntimeError('Address outside valid range!')
 
-		rec, offset = self._find_record_offset(address)
+		return memoryview(self._get_bytes(start, end))
 
-		try:
-			return rec._data[offset]
-		except Exception, exc:
-			raise RuntimeError('EncryptedHexFile.get_data: %s' % exc.message)
 
+	def _get_bytes(self, start, end):
 
-	def set_data(self, address, value):
+		data = bytearray(chr(self.__value) * (end - start + 1))
+		if start > end:
+			return data
 
-		if type(value) != types.StringType or len(value) != 1:
-			raise RuntimeError('HexFile.set_data() invalid value.')
+		# a record holds at most 255 bytes, so none starts before start - 254
+		first = bisect.bisect_left(self.__addresses, start - 254)
+		last = bisect.bisect_right(self.__addresses, end)
+		hits = [i for i in range(first, last)
+		        if self.__addresses[i] + self.__lengths[i] > start]
+		if self.__order != None:
+			hits.sort(key=self.__order.__getitem__)
 
-		if address < 0 or address >= self.__size:
+		for i in hits:
+			address = self.__addresses[i]
+			record = self._get_record(i)
+			lo = max(address, start)
+			hi = min(address + len(record) - 1, end)
+			data[lo - start:hi - start + 1] = record[lo - address:hi - address + 1]
+
+		i = max(bisect.bisect_right(self.__patch_starts, start) - 1, 0)
+		while i < len(self.__patch_starts) and self.__patch_starts[i] <= end:
+			address = self.__patch_starts[i]
+			patch = self.__patches[i]
+			lo = max(address, start)
+			hi = min(address + len(patch) - 1, end)
+			if lo <= hi:
+				data[lo - start:hi - start + 1] = patch[lo - address:hi - address + 1]
+			i += 1
+
+		return data
+
+
+	def set_range(self, start, data):
+
+		if start < 0 or start + len(data) > self.__size:
 			raise RuntimeError('Address outside valid range!')
 
-		rec, offset = self._find_record_offset(address)
+		end = start + len(data)			# exclusive
+		if len(data) == 0:
+			return
 
-		try:
-			rec._data[offset] = value
-		except Exception, exc:
-			raise RuntimeError('EncryptedHexFile.set_data: %s' % exc.message)
+		# extend the run that overlaps or touches start, or add one
+		i = bisect.bisect_right(self.__patch_starts, start) - 1
+		if i >= 0 and self.__patch_starts[i] + len(self.__patches[i]) >= start:
+			patch = self.__patches[i]
+			offset = start - self.__patch_starts[i]
+			patch[offset:offset + len(data)] = data
+		else:
+			i += 1
+			patch = bytearray(data)
+			self.__patch_starts.insert(i, start)
+			self.__patches.insert(i, patch)
+
+		# merge the following runs that now overlap or touch it
+		patch_end = self.__patch_starts[i] + len(patch)
+		while i + 1 < len(self.__patch_starts) and self.__patch_starts[i + 1] <= patch_end:
+			next_start = self.__patch_starts.pop(i + 1)
+			next_patch = self.__patches.pop(i + 1)
+			if next_start + len(next_patch) > patch_end:
+				patch.extend(next_patch[patch_end - next_start:])
+				patch_end = self.__patch_starts[i] + len(patch)
+
+
+	def get_buffer(self):
+
+		raise RuntimeError('LazyHexFile has no contiguous buffer, use get_range().')
+
+
+	def get_array(self):
+
+		raise RuntimeError('LazyHexFile has no contiguous buffer, use get_range().')
+
+
+	def get_segments(self):
+		"""
+			Returns the populated memory inside the used range as a list
+			of (start, end) tuples, from the record index and patches.
+		"""
+
+		spans = [(self.__addresses[i], self.__addresses[i] + self.__lengths[i] - 1)
+		         for i in range(0, len(self.__addresses))]
+		spans.extend([(self.__patch_starts[i], self.__patch_starts[i] + len(self.__patches[i]) - 1)
+		              for i in range(0, len(self.__patch_starts))])
+		spans.sort()
+
+		segments = []
+		for start, end in spans:
+			if len(segments) > 0 and start <= segments[-1][1] + 1:
+				if end > segments[-1][1]:
+					segments[-1] = (segments[-1][0], end)
+			else:
+				segments.append((start, end))
+
+		return [(max(start, self.__start), min(end, self.__end)) for start, end in segments
+		        if start <= self.__end and end >= self.__start]
 
 
 	def get_size(self):
@@ -643,6 +2003,27 @@ class EncryptedHexFile(HexFile):
 		return self.__size
 
 
+class EncryptedHexFile(SparseHexFile):
+	"""
+		EncryptedHexFile class.
+		A SparseHexFile that reads and writes encrypted hex files.
+	"""
+	def __init__(self, buffersize, value=0xff, key=ENCRYPTION_KEY):
+		SparseHexFile.__init__(self, buffersize, value)
+
+		self.__key = key
+
+
+	def read_file(self, file_name, jobs=1):
+
+		self.read_encrypted(file_name, self.__key)
+
+
+	def write_file(self, file_name, record_size=16):
+
+		self.write_encrypted(file_name, self.__key, record_size)
+
+
 if __name__ == "__main__":
 
 	import sys
@@ -669,14 +2050,15 @@ if __name__ == "__main__":
 	lines = fp.readlines()
 	fp.close()
 
-	fp = open(out_name, 'w')
-
+	# keep the records of the input file, enciphered in one batch
+	records = []
 	rec = HexRecord()
-	erec = EncryptedHexRecord()
 	for l in lines:
 		rec.from_string(l.strip())
-		erec.from_record(rec)
-		fp.write('%s\n' % str(erec))
+		records.append((rec.get_type(), rec.get_offset(), rec.get_data()[0:rec.get_length()]))
+
+	fp = open(out_name, 'w')
+	fp.write('\n'.join(_format_encrypted_records(records, ENCRYPTION_KEY)) + '\n')
 	fp.close()
 
 
@@ -3,13 +3,19 @@
 	The module to interface with the user and invoke commands.
 """
 import os
+import re
+import copy
+import glob
 import getopt
 import sys
-import serial
+import time
+from multiprocessing.pool import ThreadPool
 import avrlog
 import avrprog
 import avrdev
-from hex_util import HexFile
+import avrtransport
+import avrasync
+from hex_util import HexFile, SparseHexFile
 
 class JobInfo():
 	"""
@@ -73,6 +79,25 @@ class JobInfo():
 		self.search_path = ''
 
 		self.encrypted = False
+		self.pipeline_depth = 1
+		self.parse_jobs = 1
+
+		self.diff_flash = False
+		self.shadow_file_flash = ''
+
+		self.record_size = 16
+
+		self.profile_file = ''
+
+		self.stream_verify = False
+		self.fail_fast = True
+		self.flash_mismatches = []
+		self.eeprom_mismatches = []
+
+		self.device = None				# shared AVRDevice, gang mode and daemon
+		self.image_cache = None			# shared input images, gang mode and daemon
+		self.gang_results = []
+		self.async_gang = False
 
 
 	def parse_command_line(self, argv):
@@ -89,12 +114,14 @@ class JobInfo():
 		                   (self.search_path, os.pathsep, own_path, os.sep)
 
 		try:
-			optlist, args = getopt.getopt(argv[1:], "b:c:ed:E:f:F:gG:h?l:L:nO:qsx:yY:z", ['af=', 'ae=', 'if=', 'ie=', 'of=', 'oe=', 'O#=', 'pf', 'pe', 'pb', 'rf', 're', 'rb', 'Sf=', 'Se=', 'vf', 've', 'vb'])
+			optlist, args = getopt.getopt(argv[1:], "b:c:ed:E:f:F:gG:h?j:l:L:nO:qsw:x:yY:z", ['af=', 'ae=', 'async', 'diff', 'if=', 'ie=', 'of=', 'oe=', 'O#=', 'pf', 'pe', 'pb', 'rf', 're', 'rb', 'report', 'rs=', 'Sf=', 'Se=', 'shadow=', 'stream', 'vf', 've', 'vb'])
 			for (x, y) in optlist:
 				if x == '--af':
 					self.flash_start_address, self.flash_end_address = y.split(':')
 				elif x == '--ae':
 					self.eeprom_start_address, self.eeprom_end_address = y.split(':')
+				elif x == '--async':
+					self.async_gang = True
 				elif x == '-b':
 					if y == 'h':
 						self.get_hw_revision = True
@@ -106,6 +133,8 @@ class JobInfo():
 					self.com_port_name = y
 				elif x == '-d':
 					self.device_name = y
+				elif x == '--diff':
+					self.diff_flash = True
 				elif x == '-e':
 					self.chip_erase = True
 				elif x == '-E':
@@ -124,6 +153,8 @@ class JobInfo():
 					self.input_file_flash = y
 				elif x == '--ie':
 					self.input_file_eeprom = y
+				elif x == '-j':
+					self.parse_jobs = int(y)
 				elif x == '-l':
 					self.program_lock_bits = int(y, 16)
 				elif x == '-L':
@@ -156,12 +187,22 @@ class JobInfo():
 				elif x == '--rb':
 					self.read_flash = True
 					self.read_eeprom = True
+				elif x == '--report':
+					self.stream_verify = True
+					self.fail_fast = False
+				elif x == '--rs':
+					self.record_size = int(y)
 				elif x == '-s':
 					self.read_signature = True
 				elif x == '--Sf':
 					self.osccal_flash_address = int(y, 16)
 				elif x == '--Se':
 					self.osccal_eeprom_address = int(y, 16)
+				elif x == '--stream':
+					self.stream_verify = True
+				elif x == '--shadow':
+					self.diff_flash = True
+					self.shadow_file_flash = y
 				elif x == '--vf':
 					self.verify_flash = True
 				elif x == '--ve':
@@ -169,6 +210,8 @@ class JobInfo():
 				elif x == '--vb':
 					self.verify_flash = True
 					self.verify_eeprom = True
+				elif x == '-w':
+					self.pipeline_depth = int(y)
 				elif x == '-x':
 					self.memory_fill_pattern = int(y, 16)
 				elif x == '-y':
@@ -206,18 +249,52 @@ class JobInfo():
 			self.usage()
 			return
 
-		port = None
-		prog = None
-		if len(self.com_port_name) > 0:
-			port = serial.Serial(port=self.com_port_name, baudrate=self.baud,
-			                     timeout=self.timeout, writeTimeout=self.timeout)
-			prog = avrprog.AVRProgrammer.instance(port)
-		else:
+		if len(self.com_port_name) == 0:
 			avrlog.avrlog(avrlog.LOG_ERR, 'Serial port not specified.')
-
-		if prog == None:
 			raise RuntimeError('AVR Programmer not found.')
 
+		ports = self._gang_ports()
+		if len(ports) != 1 or ports[0] != self.com_port_name or self.async_gang:
+			self._do_gang(ports)
+			return
+
+		port, prog = self._open_programmer()
+		done = False
+		try:
+			self._do_programmer(prog)
+			done = True
+		finally:
+			self._close_programmer(port, prog, done)
+
+
+	def _open_programmer(self):
+		"""
+			Opens the port and returns it with its programmer.
+		"""
+
+		port = avrtransport.open_transport(self.com_port_name, self.baud, self.timeout,
+		                                   self.device_name, self.search_path)
+		try:
+			return port, avrprog.AVRProgrammer.connect(port)
+		except:
+			port.close()
+			raise
+
+
+	def _close_programmer(self, port, prog, done):
+		"""
+			Closes the port after a job, done tells if it succeeded.
+		"""
+
+		port.close()
+
+
+	def _do_programmer(self, prog):
+
+		prog.set_pipeline_depth(self.pipeline_depth)
+		if len(self.profile_file) > 0:
+			prog.set_profile(self.profile_file)
+
 		if self.rc_calibrate:
 			if not prog.rc_calibrate():
 				avrlog.avrlog(avrlog.LOG_ERR, 'RC calibrate failed.')
@@ -253,24 +330,187 @@ class JobInfo():
 			avrlog.avrlog(avrlog.LOG_ERR, 'Device name not specified.')
 			return
 
-		device = avrdev.AVRDevice(self.device_name)
-		device.read_avr_parameters(self.search_path)
+		device = self.device
+		if device == None:
+			device = avrdev.AVRDevice(self.device_name)
+			device.read_avr_parameters(self.search_path)
 
 		sig0, sig1, sig2 = device.get_signature()
 		if not prog.check_signature(sig0, sig1, sig2):
 			avrlog.avrlog(avrlog.LOG_ERR, 'Signature does not match device.')
 
+		skipped = prog.skipped_addresses
 		self._do_device_dependent(prog, device)
 
 		prog.leave_programming_mode()
+		avrlog.avrlog(avrlog.LOG_INFO, 'Skipped %d redundant address commands.' %
+		              (prog.skipped_addresses - skipped))
+
+
+	def _gang_ports(self):
+		"""
+			Returns the ports named by -c: a comma separated list in
+			which serial port names may be glob patterns.
+		"""
+
+		ports = []
+		for name in self.com_port_name.split(','):
+			name = name.strip()
+			if len(name) == 0:
+				continue
+			if re.search('[*?[]', name) and not re.match('[a-z]+:', name):
+				matches = sorted(glob.glob(name))
+				if len(matches) == 0:
+					raise RuntimeError('No serial ports match %s.' % name)
+				ports.extend(matches)
+			else:
+				ports.append(name)
+		return ports
 
-		if port != None:
-			port.close()
+
+	def _do_gang(self, ports):
+		"""
+			Runs the job on every port at once, one thread and
+			programmer per port, or all ports from one thread with
+			--async. The device file and input images are read only
+			once and shared by the ports.
+		"""
+
+		if len(ports) == 0:
+			raise RuntimeError('AVR Programmer not found.')
+		if len(self.device_name) == 0:
+			raise RuntimeError('Gang programming needs a device name.')
+
+		avrlog.set_progress(False)		# the dots of several ports would mix
+
+		if self.device == None:
+			self.device = avrdev.AVRDevice(self.device_name)
+			self.device.read_avr_parameters(self.search_path)
+
+		if self.image_cache == None:
+			self.image_cache = {}
+		if self.program_flash or self.verify_flash:
+			self._cached_image(self.input_file_flash, False, self.device.get_flash_size())
+		if self.program_eeprom or self.verify_eeprom:
+			self._cached_image(self.input_file_eeprom, True, self.device.get_eeprom_size())
+
+		avrlog.avrlog(avrlog.LOG_INFO, 'Programming %d ports...' % len(ports))
+		started = time.time()
+		if self.async_gang:
+			self.gang_results = self._run_async(ports)
+		else:
+			self.gang_results = self._run_threads(ports)
+		elapsed = time.time() - started
+
+		failed = 0
+		for name, error, seconds in self.gang_results:
+			if error == None:
+				status = 'OK'
+			else:
+				status = 'FAILED: %s' % error
+				failed += 1
+			avrlog.avrlog(avrlog.LOG_ERR, '%-24s %6.1f s  %s\n' % (name, seconds, status),
+			              False)
+
+		avrlog.avrlog(avrlog.LOG_ERR, '%d of %d ports passed in %.1f s.\n' %
+		              (len(ports) - failed, len(ports), elapsed), False)
+		if failed > 0:
+			raise RuntimeError('Gang programming failed on %d ports.' % failed)
+
+
+	def _run_threads(self, ports):
+
+		jobs = []
+		for name in ports:
+			job = copy.copy(self)
+			job.com_port_name = name
+			job.output_file_flash = _port_file(self.output_file_flash, name)
+			job.output_file_eeprom = _port_file(self.output_file_eeprom, name)
+			job.shadow_file_flash = _port_file(self.shadow_file_flash, name)
+			jobs.append(job)
+
+		pool = ThreadPool(len(jobs))
+		try:
+			return pool.map(_run_port_job, jobs)
+		finally:
+			pool.close()
+
+
+	def _run_async(self, ports):
+		"""
+			Erases, programs and verifies all ports from this thread
+			with avrasync coroutines. Returns the results as
+			_run_port_job does.
+		"""
+
+		if self.read_signature or self.get_sw_revision or self.rc_calibrate or \
+		   self.read_flash or self.read_eeprom or self.read_lock_bits or \
+		   self.read_fuse_bits or self.diff_flash or self.memory_fill_pattern != -1 or \
+		   self.flash_end_address != -1 or self.eeprom_end_address != -1 or \
+		   self.program_lock_bits != -1 or self.verify_lock_bits != -1 or \
+		   self.program_fuse_bits != -1 or self.verify_fuse_bits != -1 or \
+		   self.program_extended_fuse_bits != -1 or self.verify_extended_fuse_bits != -1 or \
+		   self.osccal_parameter != -1 or self.osccal_flash_address != -1 or \
+		   self.osccal_eeprom_address != -1:
+			raise RuntimeError('--async can only erase, program and verify.')
+
+		write = []
+		verify = []
+		if self.program_flash or self.verify_flash:
+			flash = self._cached_image(self.input_file_flash, False,
+			                           self.device.get_flash_size())
+			if self.program_flash:
+				write.append(('F', flash))
+			if self.verify_flash:
+				verify.append(('F', flash))
+		if self.program_eeprom or self.verify_eeprom:
+			eeprom = self._cached_image(self.input_file_eeprom, True,
+			                            self.device.get_eeprom_size())
+			if self.program_eeprom:
+				write.append(('E', eeprom))
+			if self.verify_eeprom:
+				verify.append(('E', eeprom))
+
+		results = []
+		transports = []
+		loop = avrasync.Loop()
+		try:
+			for name in ports:
+				try:
+					port = avrtransport.open_transport(name, self.baud, self.timeout,
+					                                   self.device_name, self.search_path)
+				except RuntimeError, exc:
+					results.append((name, str(exc), 0.0))
+					continue
+				transports.append(port)
+				prog = avrasync.AsyncBootloader(port)
+				results.append(loop.spawn(avrasync.program_device(prog, self.device,
+				                          self.chip_erase, write, verify, self.fail_fast), name))
+			loop.run()
+		finally:
+			for port in transports:
+				port.close()
+
+		for i in range(0, len(results)):
+			task = results[i]
+			if isinstance(task, tuple):
+				continue
+			error = None
+			if task.error != None:
+				error = str(task.error) or task.error.__class__.__name__
+			else:
+				for memory, hex_file in verify:
+					if len(task.result[memory]) > 0:
+						error = 'verify failed at 0x%X' % task.result[memory][0][0]
+						break
+			results[i] = (task.name, error, task.elapsed)
+		return results
 
 
 	def _do_device_dependent(self, prog, device):
 
 		prog.set_page_size(device.get_page_size())
+		erased = False
 
 		if self.flash_end_address != -1:
 			if self.flash_end_address >= device.get_flash_size():
@@ -302,7 +542,7 @@ class JobInfo():
 				raise RuntimeError('Flash read is not supported by this programmer.')
 
 			avrlog.avrlog(avrlog.LOG_INFO, 'Writing Hex output file...')
-			hexf.write_file(self.output_file_flash)
+			self._write_output(hexf, self.output_file_flash)
 
 		if self.read_eeprom:
 
@@ -318,7 +558,7 @@ class JobInfo():
 				raise RuntimeError('EEPROM read is not supported by the programmer.')
 
 			avrlog.avrlog(avrlog.LOG_INFO, 'Writing Hex output file...')
-			hexf.write_file(self.output_file_eeprom)
+			self._write_output(hexf, self.output_file_eeprom)
 
 		if self.read_lock_bits:
 
@@ -357,6 +597,7 @@ class JobInfo():
 
 			if not prog.chip_erase():
 				raise RuntimeError('Chip erase is not supported by this programmer.')
+			erased = True
 
 		if self.program_flash or self.verify_flash:
 
@@ -364,14 +605,15 @@ class JobInfo():
 				raise RuntimeError(
 				      'Cannot program or verify flash without a file specified.')
 
-			hexf = HexFile(device.get_flash_size())
-
 			if self.memory_fill_pattern != -1:
+				hexf = HexFile(device.get_flash_size())
 				hexf.clear_all(self.memory_fill_pattern)
+			else:
+				hexf = SparseHexFile(device.get_flash_size())
 
 			avrlog.avrlog(avrlog.LOG_INFO, 'Reading hex input file for flash operation...')
 
-			hexf.read_file(self.input_file_flash)
+			self._read_input(hexf, self.input_file_flash, False)
 
 			if hexf.get_range_start() > self.flash_end_address or \
 			   hexf.get_range_end() < self.flash_start_address:
@@ -395,7 +637,54 @@ class JobInfo():
 				hexf.set_used_range(self.flash_start_address,
 				                   self.osccal_flash_address_tiny)
 
-		if self.program_flash:
+		if self.program_flash and erased:
+
+			# The device is blank, pages holding only 0xff need not be sent.
+			pages = hexf.get_occupied_pages(device.get_page_size())
+			total = len(hexf.get_populated_pages(device.get_page_size()))
+
+			avrlog.avrlog(avrlog.LOG_INFO, 'Programming flash contents...')
+			avrlog.avrlog(avrlog.LOG_DEBUG, 'Skipping %d of %d blank flash pages.' %
+			              (total - len(pages), total))
+			if not prog.write_flash_pages(hexf, pages):
+				raise RuntimeError(
+				      'Flash programming is not supported by this programmer.')
+
+			if len(self.shadow_file_flash) > 0:
+				hexf.write_file(self.shadow_file_flash)
+
+		elif self.program_flash and self.diff_flash:
+
+			started = time.time()
+			shadow = HexFile(device.get_flash_size())
+			if len(self.shadow_file_flash) > 0 and os.path.exists(self.shadow_file_flash):
+				avrlog.avrlog(avrlog.LOG_INFO, 'Reading flash shadow file...')
+				shadow.read_file(self.shadow_file_flash)
+			else:
+				avrlog.avrlog(avrlog.LOG_INFO, 'Reading flash contents...')
+				shadow = self._new_readback(hexf)
+				if not prog.read_flash(shadow):
+					raise RuntimeError('Flash read is not supported by this programmer.')
+
+			avrlog.avrlog(avrlog.LOG_INFO, 'Programming changed flash pages...')
+			writing = time.time()
+			written, skipped = prog.write_flash_diff(hexf, shadow)
+			elapsed = time.time() - writing
+
+			avrlog.avrlog(avrlog.LOG_INFO, '%d of %d flash pages changed, %d skipped.' %
+			              (written, written + skipped, skipped))
+			if written > 0:
+				# against writing every page, counting the readback or shadow file
+				saved = elapsed / written * (written + skipped) - (time.time() - started)
+				if saved > 0:
+					avrlog.avrlog(avrlog.LOG_INFO, 'About %.1f s saved.' % saved)
+				else:
+					avrlog.avrlog(avrlog.LOG_INFO, 'No time saved, about %.1f s lost.' % -saved)
+
+			if len(self.shadow_file_flash) > 0:
+				hexf.write_file(self.shadow_file_flash)
+
+		elif self.program_flash:
 
 			avrlog.avrlog(avrlog.LOG_INFO, 'Programming flash contents...')
 			if not prog.write_flash(hexf):
@@ -403,31 +692,24 @@ class JobInfo():
 				      'Flash programming is not supported by this programmer.')
 
 
-		if self.verify_flash:
+		if self.verify_flash and self.stream_verify:
 
-			hexv = HexFile(device.get_flash_size())
+			avrlog.avrlog(avrlog.LOG_INFO, 'Verifying flash contents...')
+			self.flash_mismatches = prog.verify_flash(hexf, self.fail_fast)
+			self._report_stream(self.flash_mismatches)
 
-			avrlog.avrlog(avrlog.LOG_INFO, 'Reading flash contents...')
+		elif self.verify_flash:
 
-			hexv.set_used_range(hexf.get_range_start(), hexf.get_range_end())
+			hexv = self._new_readback(hexf)
+
+			avrlog.avrlog(avrlog.LOG_INFO, 'Reading flash contents...')
 
 			if not prog.read_flash(hexv):
 				raise RuntimeError('Flash read is not supported by this programmer.')
 
 			avrlog.avrlog(avrlog.LOG_INFO, 'Comparing flash data...')
 
-			for pos in range(hexf.get_range_start(), hexf.get_range_end() + 1):
-
-				valf = hexf.get_data(pos)
-				valv = hexv.get_data(pos)
-				if valf != valv:
-					avrlog.avrlog(avrlog.LOG_ERR,
-					              'Unverified at 0x%X (0x%02X vs 0x%02X)\n' % (pos, valf, valv),
-					              False)
-					break
-
-			if pos >= hexf.get_range_end():
-				avrlog.avrlog(avrlog.LOG_ERR, 'Verified.\n', False)
+			self.flash_mismatches = self._compare(hexf, hexv)
 
 		if self.program_eeprom or self.verify_eeprom:
 
@@ -435,15 +717,16 @@ class JobInfo():
 				raise RuntimeError(
 				      'Cannot program or verify EEPROM without a file specified.')
 
-			hexf = HexFile(device.get_eeprom_size())
-
 			if self.memory_fill_pattern != -1:
+				hexf = HexFile(device.get_eeprom_size())
 				hexf.clear_all(self.memory_fill_pattern)
+			else:
+				hexf = SparseHexFile(device.get_eeprom_size())
 
 			avrlog.avrlog(avrlog.LOG_INFO,
 			              'Reading hex file for EEPROM operations...')
 
-			hexf.read_file(self.input_file_eeprom)
+			self._read_input(hexf, self.input_file_eeprom, True)
 
 			if hexf.get_range_start() > self.eeprom_end_address or \
 			   hexf.get_range_end() < self.eeprom_start_address:
@@ -465,31 +748,24 @@ class JobInfo():
 				raise RuntimeError(
 				      'EEPROM programming is not supported by this programmer.')
 
-		if self.verify_eeprom:
+		if self.verify_eeprom and self.stream_verify:
 
-			hexv = HexFile(device.get_eeprom_size())
+			avrlog.avrlog(avrlog.LOG_INFO, 'Verifying EEPROM contents...')
+			self.eeprom_mismatches = prog.verify_eeprom(hexf, self.fail_fast)
+			self._report_stream(self.eeprom_mismatches)
 
-			avrlog.avrlog(avrlog.LOG_INFO, 'Reading EEPROM contents...')
+		elif self.verify_eeprom:
 
-			hexv.set_used_range(hexf.get_range_start(), hexf.get_range_end())
+			hexv = self._new_readback(hexf)
+
+			avrlog.avrlog(avrlog.LOG_INFO, 'Reading EEPROM contents...')
 
 			if not prog.read_eeprom(hexv):
 				raise RuntimeError('EEPROM read is not supported by this programmer.')
 
 			avrlog.avrlog(avrlog.LOG_INFO, 'Comparing EEPROM data...')
 
-			for pos in range(hexf.get_range_start(), hexf.get_range_end() + 1):
-
-				valf = hexf.get_data(pos)
-				valv = hexv.get_data(pos)
-				if valf != valv:
-					avrlog.avrlog(avrlog.LOG_ERR,
-					              'Unverified at address 0x%X (0x%02X vs 0x%02X)\n' %
-					              (valf, valv), False)
-					break
-
-			if pos >= hexf.get_range_end():
-				avrlog.avrlog(avrlog.LOG_ERR, 'Verified.\n', False)
+			self.eeprom_mismatches = self._compare(hexf, hexv)
 
 
 		if self.program_lock_bits != -1:
@@ -610,6 +886,117 @@ class JobInfo():
 				      'EEPROM programming is not supported by this programmer.')
 
 
+	def _read_input(self, hexf, file_name, eeprom):
+		"""
+			Reads an input file into hexf, decrypting it with -n.
+			With a shared image cache the file is only read once.
+		"""
+
+		if self.image_cache != None:
+			image = self._cached_image(file_name, eeprom, hexf.get_size())
+			hexf.copy_from(image)
+			hexf.set_used_range(image.get_range_start(), image.get_range_end())
+		elif self.encrypted:
+			hexf.read_encrypted(file_name)
+		else:
+			hexf.read_image(file_name, eeprom, self.parse_jobs)
+
+
+	def _cached_image(self, file_name, eeprom, size):
+
+		try:
+			stat = os.stat(file_name)
+			stamp = (stat.st_mtime, stat.st_size)
+		except OSError:
+			stamp = None
+
+		key = (os.path.abspath(file_name), stamp, eeprom, self.encrypted, size)
+		if not key in self.image_cache:
+			image = SparseHexFile(size)
+			if self.encrypted:
+				image.read_encrypted(file_name)
+			else:
+				image.read_image(file_name, eeprom, self.parse_jobs)
+			self.image_cache[key] = image
+		return self.image_cache[key]
+
+
+	def _write_output(self, hexf, file_name):
+		"""
+			Writes an output file from hexf, encrypting it with -n.
+		"""
+
+		if self.encrypted:
+			hexf.write_encrypted(file_name, record_size=self.record_size)
+		else:
+			hexf.write_image(file_name, self.record_size)
+
+
+	def _compare(self, hexf, hexv):
+		"""
+			Compares the populated memory of hexf with the read back
+			hexv, reports the result and returns the mismatching ranges
+			as a list of (start, end, count) tuples.
+		"""
+
+		mismatches = []
+		for start, end in hexf.get_segments():
+			mismatches.extend(hexf.get_differences(hexv, start, end))
+
+		if len(mismatches) > 0:
+			pos = mismatches[0][0]
+			avrlog.avrlog(avrlog.LOG_ERR,
+			              'Unverified at 0x%X (0x%02X vs 0x%02X)\n' %
+			              (pos, hexf.get_data(pos), hexv.get_data(pos)), False)
+
+		self._report_mismatches(mismatches)
+		return mismatches
+
+
+	def _report_stream(self, mismatches):
+		"""
+			Reports the result of a streaming verify.
+		"""
+
+		if len(mismatches) > 0:
+			avrlog.avrlog(avrlog.LOG_ERR, 'Unverified at 0x%X\n' % mismatches[0][0],
+			              False)
+			if self.fail_fast:
+				avrlog.avrlog(avrlog.LOG_ERR, 'Stopped at the first bad block.\n', False)
+
+		self._report_mismatches(mismatches)
+
+
+	def _report_mismatches(self, mismatches):
+
+		if len(mismatches) == 0:
+			avrlog.avrlog(avrlog.LOG_ERR, 'Verified.\n', False)
+			return
+
+		total = 0
+		for start, end, count in mismatches:
+			avrlog.avrlog(avrlog.LOG_ERR,
+			              '  0x%X-0x%X: %d of %d bytes differ\n' %
+			              (start, end, count, end - start + 1), False)
+			total += count
+
+		avrlog.avrlog(avrlog.LOG_ERR, '%d bytes differ in %d ranges.\n' %
+		              (total, len(mismatches)), False)
+
+
+	def _new_readback(self, hexf):
+		"""
+			Returns a SparseHexFile with the same populated segments and
+			used range as hexf, to read the device contents into.
+		"""
+
+		hexv = SparseHexFile(hexf.get_size())
+		for start, end in hexf.get_segments():
+			hexv.set_range(start, chr(0xff) * (end - start + 1))
+		hexv.set_used_range(hexf.get_range_start(), hexf.get_range_end())
+		return hexv
+
+
 	def usage(self):
 
 		print "Command Line Switches:"
@@ -618,18 +1005,25 @@ class JobInfo():
 		print "        [-e] [--p[f|e|b]] [--r[f|e|b]] [--v[f|e|b]] [-l value] [-L value]"
 		print "        [-y] [-f value] [-E value] [-F value] [-G value] [-q] [-x value]"
 		print "        [--af start:stop] [--ae start:stop] [-c port] [-b h|s] [-g] [-z]"
-		print "        [-Y] [-n] [-h|?]"
+		print "        [-Y] [-n] [-w depth] [--diff] [--shadow file] [--rs size]"
+		print "        [--stream] [--report] [--async] [-j jobs]"
+		print "        [-h|?]"
 		print ""
 		print "Parameters:"
 		print "-d      Device name. Must be applied when programming the device."
 		print "--if    Name of FLASH input file. Required for programming or verification"
-		print "        of the FLASH memory. The file format is Intel Extended HEX."
+		print "        of the FLASH memory. See file formats below."
 		print "--ie    Name of EEPROM input file. Required for programming or verification"
-		print "        of the EEPROM memory. The file format is Intel Extended HEX."
+		print "        of the EEPROM memory. For ELF files the .eeprom section is used."
 		print "--of    Name of FLASH output file. Required for readout of the FLASH memory."
-		print "        The file format is Intel Extended HEX."
 		print "--oe    Name of EEPROM output file. Required for readout of the EEPROM"
-		print "        memory. The file format is Intel Extended HEX."
+		print "        memory."
+		print "        File formats are chosen by extension: Intel Extended HEX (.hex),"
+		print "        Motorola S-record (.srec, .s19, .s28, .s37), raw binary (.bin,"
+		print "        starting at address 0) and, for input only, AVR ELF (.elf). Other"
+		print "        input files are detected by content, other output files are HEX."
+		print "--rs    Number of data bytes per record in HEX or S-record output files"
+		print "        (1-255, 250 for S-records). The default is 16."
 		print "-s      Read signature bytes."
 		print "-O      Read oscillator calibration byte. 'index' is optional."
 		print "--O#    User-defined oscillator calibration value."
@@ -637,12 +1031,26 @@ class JobInfo():
 		print "--Se    Write oscillator cal. byte to EEPROM memory. 'addr' is byte address."
 		print "-e      Erase device. If applied with another programming parameter, the"
 		print "        device will be erased before any other programming takes place."
+		print "        Flash pages holding only 0xff are then not programmed."
 		print "-p      Program device; FLASH (f), EEPROM (e) or both (b). Corresponding"
 		print "        input files are required."
 		print "-r      Read out device; FLASH (f), EEPROM (e) or both (b). Corresponding"
 		print "        output files are required"
 		print "-v      Verify device; FLASH (f), EEPROM (e) or both (b). Can be used with"
 		print "        -p or alone. Corresponding input files are required."
+		print "--stream Used with -v, compare each block as it is read from the device"
+		print "        instead of reading all of it first. Stops at the first bad block."
+		print "--report Like --stream, but reads on and reports every mismatching range."
+		print "--diff  Used with --pf, program only the flash pages that differ from"
+		print "        the device contents, which are read back first. Refused if a"
+		print "        page needs an erase, unless the bootloader profile sets"
+		print "        erases_pages. Use -e to program the full image then."
+		print "--shadow Like --diff, but compare against a shadow file of the last"
+		print "        image programmed instead of reading the device, if it exists."
+		print "        The shadow file is updated after programming."
+		print "-j      Processes parsing Intel HEX input files. The default of 1"
+		print "        parses in this process; 0 uses one per CPU for files of 4 MB"
+		print "        or more."
 		print "-l      Set lock byte. 'value' is an 8-bit hex. value."
 		print "-L      Verify lock byte. 'value' is an 8-bit hex. value to verify against."
 		print "-y      Read back lock byte."
@@ -654,7 +1062,11 @@ class JobInfo():
 		print "-G      Verify extended fuse byte. 'value' is an 8-bit hex. value to"
 		print "        verify against."
 		print "-q      Read back fuse bytes."
-		print "-n      Send/receive encrypted hex files."
+		print "-n      Send/receive encrypted hex files. Applies to all input and"
+		print "        output files."
+		print "-w      Pipeline depth. Number of commands sent before waiting for their"
+		print "        acks. The default of 1 waits for every ack. The bootloader must"
+		print "        be able to buffer this many commands."
 		print "-x      Fill unspecified locations with a value (00-ff). The default is"
 		print "        to not program locations not specified in the input files."
 		print "--af    FLASH address range. Specifies the address range of operations. The"
@@ -663,6 +1075,14 @@ class JobInfo():
 		print "        The default is the entire EEPROM. Byte addresses in hex."
 		print "-c      Select communication port; 'COM1' to 'COM8', '/dev/tty0', /dev/ttyUSB0."
 		print "        Deprecated: It is suggested to use settings in the configuration file."
+		print "        Also tcp://host:port for a ser2net style server, pty:/dev/pts/N for"
+		print "        a terminal device and sim:[device] for the built-in bootloader"
+		print "        simulator."
+		print "        Several ports separated by commas, or a pattern such as"
+		print "        /dev/ttyUSB*, program the same image on all of them at once."
+		print "--async Drive all ports from one thread instead of one thread each."
+		print "        Only -e, -p and -v are supported and the bootloader must have"
+		print "        block mode."
 		print "-b      Get revisions; hardware revision (h) and software revision (s)."
 		print "-g      Silent operation."
 		print "-z      No progress indicator. E.g. if piping to a file for log purposes."
@@ -671,3 +1091,33 @@ class JobInfo():
 		print "-h|-?   Help information (overrides all other settings)."
 		print ""
 
+
+def _port_file(file_name, port_name):
+	"""
+		Returns file_name with the port name added before the
+		extension, so that the ports of a gang do not share files.
+	"""
+
+	if len(file_name) == 0:
+		return file_name
+	root, ext = os.path.splitext(file_name)
+	return '%s.%s%s' % (root, re.sub('[^A-Za-z0-9]+', '_', port_name).strip('_'), ext)
+
+
+def _run_port_job(job):
+	"""
+		Runs job on its port and returns (port, error, seconds), where
+		error is None if the job succeeded and verified.
+	"""
+
+	started = time.time()
+	error = None
+	try:
+		job.do_job()
+		if len(job.flash_mismatches) > 0 or len(job.eeprom_mismatches) > 0:
+			error = 'verify failed'
+	except SystemExit:
+		error = 'stopped'
+	except BaseException, exc:
+		error = str(exc) or exc.__class__.__name__
+	return (job.com_port_name, error, time.time() - started)
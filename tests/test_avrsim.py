@@ -0,0 +1,178 @@
+"""
+	test_avrsim.py
+	Programs and verifies flash on the AVR109 simulator through every
+	bootloader mode the programmer supports.
+	Run from the top directory with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avrlog
+import avrprog
+import avrtransport
+from hex_util import SparseHexFile
+
+PAGE_SIZE = 128
+
+# odd bounds, a page fully blank inside a segment, and a lone byte
+SEGMENTS = [(0x0011, 0x0310), (0x1001, 0x1100), (0x2005, 0x2005)]
+BLANK_PAGE = 4
+
+
+def make_image():
+	"""
+		Returns a SparseHexFile holding SEGMENTS, filled with a pattern
+		that is never 0xff except in page BLANK_PAGE.
+	"""
+
+	hexf = SparseHexFile(32768)
+	for start, end in SEGMENTS:
+		data = bytearray([(address * 7 + 3) % 0xff for address in range(start, end + 1)])
+		hexf.set_range(start, data)
+	hexf.set_range(BLANK_PAGE * PAGE_SIZE, bytearray(chr(0xff) * PAGE_SIZE))
+	hexf.set_used_range(SEGMENTS[0][0], SEGMENTS[-1][1])
+	return hexf
+
+
+def connect(options='', depth=1):
+	"""
+		Returns a bootloader talking to a fresh simulator and the
+		simulator itself.
+	"""
+
+	port = avrtransport.open_transport('sim:?' + options, 0, 1.0)
+	prog = avrprog.AVRBootloader(port)
+	prog.set_page_size(PAGE_SIZE)
+	prog.set_pipeline_depth(depth)
+	return prog, port.sim
+
+
+class SimulatorTest(unittest.TestCase):
+
+	def setUp(self):
+
+		avrlog.set_silent()
+		avrlog.set_progress(False)
+		self.image = make_image()
+
+
+	def assertFlash(self, sim, hexf):
+
+		for start, end in hexf.get_segments():
+			self.assertEqual(str(sim.flash[start:end + 1]), hexf.get_range(start, end).tobytes())
+
+
+	def test_write_verify_modes(self):
+
+		for block_size in (0, 64, 256):
+			for auto_increment in (1, 0):
+				for depth in (1, 4):
+					prog, sim = connect('block_size=%d&auto_increment=%d' %
+					                    (block_size, auto_increment), depth)
+					self.assertTrue(prog.write_flash(self.image))
+					self.assertFlash(sim, self.image)
+					self.assertEqual(prog.verify_flash(self.image), [])
+					self.assertEqual(sim.flash[0x10], 0xff)
+					self.assertEqual(sim.flash[0x1101], 0xff)
+					self.assertEqual(sim.commands.get('B', 0) > 0, block_size > 0)
+
+
+	def test_nak_mid_window(self):
+
+		# commands are A #1, c #2, C #3, c #4, C #5, ... from 0x10
+		for depth in (1, 4):
+			prog, sim = connect('block_size=0&nak=7', depth)
+			try:
+				prog.write_flash(self.image)
+				self.fail('NAK not reported')
+			except RuntimeError, exc:
+				self.assertEqual(str(exc), 'Write flash high byte failed! Programmer did not ' +
+				                 "ack command #7 ('C', address 0xA), got 0x3F.")
+
+		# A #1, c #2, C #3 for the odd first byte, B #4 up to 0x40, B #5
+		for depth in (1, 4):
+			prog, sim = connect('block_size=64&nak=5', depth)
+			try:
+				prog.write_flash(self.image)
+				self.fail('NAK not reported')
+			except RuntimeError, exc:
+				self.assertEqual(str(exc), 'Writing Flash block failed! Programmer did not ' +
+				                 "ack command #5 ('B', address 0x20), got 0x3F.")
+
+
+	def test_pipelined_acks(self):
+
+		prog, sim = connect('block_size=0', 4)
+		prog.write_flash(self.image)
+		self.assertFlash(sim, self.image)
+		prog.check_acks()
+		self.assertEqual(sim.pending(), 0)
+
+
+	def test_diff(self):
+
+		prog, sim = connect()
+		prog.write_flash(self.image)
+
+		shadow = make_image()
+		changed = make_image()
+		changed.set_data(0x1010, chr(changed.get_data(0x1010) & 0xf0))
+		written, skipped = prog.write_flash_diff(changed, shadow)
+		self.assertEqual((written, skipped), (1, len(changed.get_populated_pages(PAGE_SIZE)) - 1))
+		self.assertFlash(sim, changed)
+
+		flash = str(sim.flash)
+		shadow = changed
+		changed = make_image()
+		self.assertRaises(RuntimeError, prog.write_flash_diff, changed, shadow)
+		self.assertEqual(str(sim.flash), flash)
+
+
+	def test_blank_page_skip(self):
+
+		pages = self.image.get_occupied_pages(PAGE_SIZE)
+		self.assertFalse(BLANK_PAGE in pages)
+		self.assertEqual(len(pages), len(self.image.get_populated_pages(PAGE_SIZE)) - 1)
+
+		prog, sim = connect('block_size=128')
+		prog.write_flash(self.image)
+		blocks = sim.commands['B']
+
+		prog, sim = connect('block_size=128')
+		prog.write_flash_pages(self.image, pages)
+		self.assertFlash(sim, self.image)
+		self.assertEqual(sim.commands['B'], blocks - 1)
+
+
+	def test_streaming_verify(self):
+
+		prog, sim = connect()
+		prog.write_flash(self.image)
+		sim.flash[0x20] ^= 0x01
+		sim.flash[0x22] ^= 0x01
+		sim.flash[0x1080] = 0x00
+
+		self.assertEqual(prog.verify_flash(self.image), [(0x20, 0x22, 2)])
+		self.assertEqual(prog.verify_flash(self.image, False),
+		                 [(0x20, 0x22, 2), (0x1080, 0x1080, 1)])
+
+
+	def test_address_elision(self):
+
+		# each block leaves the address where the next one starts
+		prog, sim = connect('block_size=64')
+		prog.write_flash(self.image)
+		self.assertTrue(prog.skipped_addresses > 0)
+		self.assertTrue(sim.commands['A'] < sim.commands['B'])
+
+		# without autoincrement every word needs its own address
+		prog, sim = connect('block_size=0&auto_increment=0')
+		prog.write_flash(self.image)
+		self.assertTrue(sim.commands['A'] >= sim.commands['C'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,95 @@
+"""
+	test_eeprom.py
+	Programs EEPROM on the AVR109 simulator with and without block
+	support.
+	Run from the top directory with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avrlog
+import avrprog
+import avrtransport
+from hex_util import HexFile, SparseHexFile
+
+EEPROM_SIZE = 4096
+
+
+def connect(options=''):
+	"""
+		Returns a bootloader talking to a fresh simulator with 4 KB of
+		EEPROM, and the simulator itself.
+	"""
+
+	port = avrtransport.open_transport('sim:?eeprom_size=%d&%s' % (EEPROM_SIZE, options),
+	                                   0, 1.0)
+	return avrprog.AVRBootloader(port), port.sim
+
+
+def pattern(start, end):
+
+	return bytearray([(address * 13 + 5) & 0xff for address in range(start, end + 1)])
+
+
+class EEPROMTest(unittest.TestCase):
+
+	def setUp(self):
+
+		avrlog.set_silent()
+		avrlog.set_progress(False)
+
+
+	def test_block_4k(self):
+
+		hexf = HexFile(EEPROM_SIZE)
+		hexf.set_range(0, pattern(0, EEPROM_SIZE - 1))
+		hexf.set_used_range(0, EEPROM_SIZE - 1)
+
+		prog, sim = connect('block_size=128')
+		self.assertTrue(prog.write_eeprom(hexf))
+		self.assertEqual(str(sim.eeprom), hexf.get_range(0, EEPROM_SIZE - 1).tobytes())
+		self.assertEqual(sim.commands['B'], EEPROM_SIZE // 128)
+		self.assertEqual(sim.commands.get('D', 0), 0)
+		self.assertEqual(prog.verify_eeprom(hexf), [])
+
+
+	def test_byte_fallback(self):
+
+		hexf = HexFile(EEPROM_SIZE)
+		hexf.set_range(0x100, pattern(0x100, 0x4ff))
+		hexf.set_used_range(0x100, 0x4ff)
+
+		prog, sim = connect('block_size=0')
+		self.assertTrue(prog.write_eeprom(hexf))
+		self.assertEqual(str(sim.eeprom[0x100:0x500]), hexf.get_range(0x100, 0x4ff).tobytes())
+		self.assertEqual(sim.commands['D'], 0x400)
+		self.assertEqual(sim.commands.get('B', 0), 0)
+		self.assertRaises(RuntimeError, prog.write_eeprom_block, hexf)
+
+
+	def test_odd_and_multi_segment(self):
+
+		# an odd length segment, one shorter than a block, one spanning blocks
+		segments = [(0x003, 0x0ff), (0x201, 0x201), (0x7f1, 0x90e)]
+		hexf = SparseHexFile(EEPROM_SIZE)
+		for start, end in segments:
+			hexf.set_range(start, pattern(start, end))
+		hexf.set_used_range(segments[0][0], segments[-1][1])
+		self.assertEqual(hexf.get_segments(), segments)
+
+		for options in ('block_size=64', 'block_size=0', 'block_size=0&auto_increment=0'):
+			prog, sim = connect(options)
+			self.assertTrue(prog.write_eeprom(hexf))
+
+			expected = bytearray(chr(0xff) * EEPROM_SIZE)
+			for start, end in segments:
+				expected[start:end + 1] = pattern(start, end)
+			self.assertEqual(sim.eeprom, expected)
+			self.assertEqual(prog.verify_eeprom(hexf), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,104 @@
+"""
+	xtea.py
+	XTEA block cipher on 16-bit words, as used by encrypted hex files.
+
+	The cipher is XTEA scaled down to two 16-bit words per block, so a
+	small bootloader can decrypt it with 16-bit arithmetic:
+	the key is four 16-bit words taken from a 64-bit integer, least
+	significant word first; the round constant is 0x9E37 (the 16-bit
+	golden ratio); the shifts are 4 and 5 as in XTEA; the key word is
+	selected by sum & 3 and (sum >> 11) & 3; there are 32 rounds.
+"""
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+DELTA = 0x9e37
+ROUNDS = 32
+MASK = 0xffff
+
+def _key_words(key):
+
+	return [(key >> (16 * i)) & MASK for i in range(0, 4)]
+
+
+def encipher(v, key, rounds=ROUNDS):
+	"""
+		Enciphers the block v, a pair of 16-bit words, and returns the
+		enciphered pair.
+	"""
+
+	k = _key_words(key)
+	v0, v1 = int(v[0]) & MASK, int(v[1]) & MASK
+	s = 0
+	for i in range(0, rounds):
+		v0 = (v0 + ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ (s + k[s & 3]))) & MASK
+		s = (s + DELTA) & MASK
+		v1 = (v1 + ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ (s + k[(s >> 11) & 3]))) & MASK
+	return (v0, v1)
+
+
+def decipher(v, key, rounds=ROUNDS):
+	"""
+		Deciphers the block v, a pair of 16-bit words, and returns the
+		plain pair.
+	"""
+
+	k = _key_words(key)
+	v0, v1 = int(v[0]) & MASK, int(v[1]) & MASK
+	s = (DELTA * rounds) & MASK
+	for i in range(0, rounds):
+		v1 = (v1 - ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ (s + k[(s >> 11) & 3]))) & MASK
+		s = (s - DELTA) & MASK
+		v0 = (v0 - ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ (s + k[s & 3]))) & MASK
+	return (v0, v1)
+
+
+def encipher_words(words, key, rounds=ROUNDS):
+	"""
+		Enciphers a list of 16-bit words, taken as consecutive blocks,
+		and returns the enciphered words as a list. All blocks go
+		through each round together when numpy is available.
+	"""
+
+	if numpy == None:
+		result = []
+		for i in range(0, len(words), 2):
+			result.extend(encipher(words[i:i + 2], key, rounds))
+		return result
+
+	k = _key_words(key)
+	w = numpy.array(words, dtype=numpy.uint32).reshape(-1, 2)
+	v0 = w[:, 0].copy()
+	v1 = w[:, 1].copy()
+	s = 0
+	for i in range(0, rounds):
+		v0 = (v0 + ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ (s + k[s & 3]))) & MASK
+		s = (s + DELTA) & MASK
+		v1 = (v1 + ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ (s + k[(s >> 11) & 3]))) & MASK
+	return numpy.column_stack((v0, v1)).ravel().tolist()
+
+
+def decipher_words(words, key, rounds=ROUNDS):
+	"""
+		Deciphers a list of 16-bit words, taken as consecutive blocks,
+		and returns the plain words as a list.
+	"""
+
+	if numpy == None:
+		result = []
+		for i in range(0, len(words), 2):
+			result.extend(decipher(words[i:i + 2], key, rounds))
+		return result
+
+	k = _key_words(key)
+	w = numpy.array(words, dtype=numpy.uint32).reshape(-1, 2)
+	v0 = w[:, 0].copy()
+	v1 = w[:, 1].copy()
+	s = (DELTA * rounds) & MASK
+	for i in range(0, rounds):
+		v1 = (v1 - ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ (s + k[(s >> 11) & 3]))) & MASK
+		s = (s - DELTA) & MASK
+		v0 = (v0 - ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ (s + k[s & 3]))) & MASK
+	return numpy.column_stack((v0, v1)).ravel().tolist()